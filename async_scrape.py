@@ -0,0 +1,724 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from urllib import parse
+import json
+import os
+
+import aiohttp
+from tqdm import tqdm
+
+import utils
+import rate_limit
+import http_cache
+from http_cache import CachedResponse
+import scrape_util
+from http_util import RETRY_STATUS_CODES, backoff_delay
+from dir_index import DirectoryIndex
+from danbooru_post import DanbooruPost, LazyPost
+from scrape_util import (
+    DanbooruPostItem,
+    PagePlanner,
+    ScrapeResultCache,
+    MAX_POSTS_PER_PAGE,
+    PARTIAL_SUFFIX,
+    DOWNLOAD_CHUNK_SIZE,
+    DownloadVerifier,
+    DownloadVerificationError,
+    get_domain_and_post_id_from_url,
+    get_download_headers,
+    filter_page_posts,
+    DownloadTask,
+    plan_download_tasks,
+    materialize_download_task,
+    find_download_source,
+)
+from scrape_config import (
+    AVAIABLE_DOMAINS,
+    PAGINATION_MODE,
+    AuthConfig,
+    CacheConfig,
+    DownloadConfig,
+    HttpConfig,
+    PostListSubset,
+    QueryListSubset,
+    QuerySubset,
+    ScrapeConfig,
+    ScrapeSubset,
+    SearchResultFilterConfig,
+)
+from journal import ScrapeJournal, open_journal
+from tag_filter import compile_result_filter
+from query import (
+    QueryPlan,
+    describe_query_plan,
+    get_tag_limit,
+    plan_query,
+    search_key,
+)
+from tags import do_all_caption_post_process
+from cache_util import (
+    load_search_cache,
+    save_search_cache,
+    plan_search_cache_refresh,
+    apply_search_cache_refresh,
+    prepare_download_files,
+    get_reserved_tags,
+)
+
+
+class AsyncHttpClient:
+    session: aiohttp.ClientSession
+    max_retries: int
+    backoff_factor: float
+    max_backoff: float
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        max_retries: int = 5,
+        backoff_factor: float = 1.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.session = session
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+    @asynccontextmanager
+    async def get(self, url: str, headers: dict[str, str] | None = None):
+        attempt = 0
+
+        limiter = rate_limit.get_limiter(parse.urlparse(url).netloc)
+
+        while True:
+            if limiter is not None:
+                await limiter.acquire_async()
+
+            try:
+                response = await self.session.get(url, headers=headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(
+                    backoff_delay(attempt, self.backoff_factor, self.max_backoff)
+                )
+                attempt += 1
+                continue
+
+            if limiter is not None:
+                limiter.on_response(response.status)
+
+            if response.status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                break
+
+            wait = backoff_delay(
+                attempt,
+                self.backoff_factor,
+                self.max_backoff,
+                response.headers.get("Retry-After"),
+            )
+            response.release()
+            await asyncio.sleep(wait)
+            attempt += 1
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+
+class AsyncDanbooruScraper:
+    domain: AVAIABLE_DOMAINS
+    auth: AuthConfig | None
+    client: AsyncHttpClient
+
+    def __init__(
+        self,
+        client: AsyncHttpClient,
+        domain: AVAIABLE_DOMAINS = "danbooru.donmai.us",
+        auth: AuthConfig | None = None,
+        lazy_posts: bool = False,
+    ) -> None:
+        self.client = client
+        self.domain = domain
+        self.auth = auth
+        self.lazy_posts = lazy_posts
+
+    def _get_headers(self) -> dict[str, str]:
+        headers = {"User-Agent": "Danbooru Scraper"}
+        if self.auth is not None:
+            headers["Authorization"] = f"Basic {self.auth.basic_auth()}"
+        return headers
+
+    def _cache_key(self, url: str) -> str:
+        return f"{self.auth.username}@{url}" if self.auth is not None else url
+
+    async def _get_json(self, url: str, cacheable: bool = False):
+        headers = self._get_headers()
+
+        # キャッシュの読み書きはイベントループを止めないようにスレッドで行う
+        cache = http_cache.get_cache() if cacheable else None
+        entry = (
+            await asyncio.to_thread(cache.load, self._cache_key(url))
+            if cache is not None
+            else None
+        )
+
+        if entry is not None:
+            if cache.is_fresh(entry):
+                return json.loads(entry.body)
+            headers.update(entry.validators())
+
+        async with self.client.get(url, headers=headers) as response:
+            if response.status == 304 and entry is not None:
+                await asyncio.to_thread(cache.refresh, self._cache_key(url), entry)
+                return json.loads(entry.body)
+
+            text = await response.text()
+            if response.status != 200:
+                raise Exception("Error: " + str(response.status) + " " + text)
+
+            if cache is not None:
+                await asyncio.to_thread(
+                    cache.save,
+                    self._cache_key(url),
+                    CachedResponse(
+                        url,
+                        text,
+                        response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"),
+                    ),
+                )
+
+            return json.loads(text)
+
+    async def get_posts(
+        self, query: str, page: int | str = 1, limit_per_page: int = 20
+    ) -> list[DanbooruPost | LazyPost]:
+        url = f"https://{self.domain}/posts.json?tags={parse.quote(query)}&page={page}&limit={limit_per_page}"
+
+        data = await self._get_json(url, cacheable=True)
+
+        if self.lazy_posts:
+            return [LazyPost(post) for post in data]
+
+        return [DanbooruPost(**post) for post in data]
+
+    async def get_post(self, post_id: int) -> DanbooruPost:
+        url = f"https://{self.domain}/posts/{post_id}.json"
+
+        return DanbooruPost(**await self._get_json(url))
+
+    async def get_posts_by_ids(self, post_ids: list[int]) -> list[DanbooruPost]:
+        if len(post_ids) > MAX_POSTS_PER_PAGE:
+            raise Exception(f"Too many post ids: {len(post_ids)}")
+
+        query = f"id:{','.join(str(post_id) for post_id in post_ids)} status:any"
+
+        return await self.get_posts(query, 1, len(post_ids))
+
+    async def count_posts(self, query: str) -> int:
+        url = f"https://{self.domain}/counts/posts.json?tags={parse.quote(query)}"
+
+        return (await self._get_json(url, cacheable=True))["counts"]["posts"]
+
+
+async def get_posts(
+    scraper: AsyncDanbooruScraper,
+    query: str,
+    search_result_filter: SearchResultFilterConfig | None,
+    fallback_search_result_filter: SearchResultFilterConfig,
+    total_limit: int = 100,
+    limit_per_page: int = 200,
+    pagination: PAGINATION_MODE = "auto",
+    prefetch: int = 2,
+    journal: ScrapeJournal | None = None,
+    journal_key: str | None = None,
+) -> list[DanbooruPostItem]:
+    posts: list[DanbooruPostItem] = []
+    start_page: int | str = 1
+
+    # ドメインやフィルターが違う検索の途中経過を使わないように、呼び出し側で区別したキー
+    if journal_key is None:
+        journal_key = query
+
+    result_filter = compile_result_filter(
+        search_result_filter
+        if search_result_filter is not None
+        else fallback_search_result_filter
+    )
+
+    # 中断したところから再開する
+    if journal is not None:
+        state = await asyncio.to_thread(journal.load_search, journal_key)
+        if state is not None:
+            posts = [DanbooruPostItem(**item) for item in state.items]
+            if state.done or len(posts) >= total_limit:
+                return posts[:total_limit]
+            start_page = state.next_page
+
+    planner = PagePlanner(
+        query,
+        total_limit,
+        limit_per_page,
+        pagination,
+        depth=prefetch,
+        start_page=start_page,
+    )
+    pending: deque[tuple[int | str, asyncio.Task]] = deque()
+
+    def submit(page: int | str):
+        task = asyncio.create_task(scraper.get_posts(query, page, limit_per_page))
+        pending.append((page, task))
+
+    for page in planner.start():
+        submit(page)
+
+    try:
+        while len(pending) > 0 and len(posts) < total_limit:
+            page, task = pending.popleft()
+            page_posts = await task
+
+            if len(page_posts) == 0:
+                break
+
+            for next_page in planner.advance(page, page_posts, len(pending)):
+                submit(next_page)
+
+            new_posts = filter_page_posts(page_posts, result_filter)
+            posts.extend(new_posts)
+
+            if journal is not None:
+                await asyncio.to_thread(
+                    journal.record_page,
+                    journal_key,
+                    [item.dict() for item in new_posts],
+                    planner.resume_point(page, page_posts),
+                )
+    finally:
+        # 必要数に達したら残りのリクエストは捨てる
+        for _, task in pending:
+            task.cancel()
+
+    if journal is not None and len(posts) < total_limit:
+        # 最後まで取得した (空のページか、それ以上のページが無い)
+        await asyncio.to_thread(journal.record_page, journal_key, [], None)
+
+    return posts[:total_limit]
+
+
+async def resolve_post_urls(
+    client: AsyncHttpClient,
+    post_urls: list[str],
+    auth: AuthConfig | None,
+) -> list[DanbooruPostItem]:
+    targets = [get_domain_and_post_id_from_url(url) for url in post_urls]
+
+    post_ids_by_domain: dict[AVAIABLE_DOMAINS, list[int]] = {
+        domain: list(dict.fromkeys(post_id for d, post_id in targets if d == domain))
+        for domain in dict.fromkeys(domain for domain, _ in targets)
+    }
+
+    async def resolve(domain: AVAIABLE_DOMAINS, post_ids: list[int]):
+        scraper = AsyncDanbooruScraper(client, domain, auth)
+        return domain, await scraper.get_posts_by_ids(post_ids)
+
+    results = await asyncio.gather(
+        *[
+            resolve(domain, post_ids[i : i + MAX_POSTS_PER_PAGE])
+            for domain, post_ids in post_ids_by_domain.items()
+            for i in range(0, len(post_ids), MAX_POSTS_PER_PAGE)
+        ]
+    )
+
+    found: dict[tuple[AVAIABLE_DOMAINS, int], DanbooruPost] = {
+        (domain, post.id): post for domain, posts in results for post in posts
+    }
+
+    items: list[DanbooruPostItem] = []
+    for target in targets:
+        if target not in found:
+            print(f"Post not found! (skipped: ID {target[1]})")
+            continue
+        items.append(DanbooruPostItem.new(found[target]))
+
+    return items
+
+
+async def download_image(
+    client: AsyncHttpClient,
+    url: str,
+    output_dir: str | Path,
+    filename: str,
+    extension: str,
+    headers: dict[str, str],
+    md5: str | None = None,
+    file_size: int | None = None,
+    max_attempts: int = 3,
+    index: DirectoryIndex | None = None,
+) -> None:
+    output_path = Path(output_dir) / f"{filename}.{extension}"
+
+    # ファイルの操作はイベントループを止めないようにスレッドで行う
+    exists = index.exists if index is not None else os.path.exists
+    if await asyncio.to_thread(exists, output_path):
+        return
+
+    # 一時ファイルに書き込んで、検証できたらリネームする
+    partial_path = output_path.with_name(output_path.name + PARTIAL_SUFFIX)
+
+    try:
+        for attempt in range(max_attempts):
+            async with client.get(url, headers=headers) as response:
+                if response.status != 200:
+                    raise Exception("Error: " + str(response.status))
+
+                verifier = DownloadVerifier(md5, file_size)
+                f = await asyncio.to_thread(open, partial_path, "wb")
+
+                try:
+                    async for chunk in response.content.iter_chunked(
+                        DOWNLOAD_CHUNK_SIZE
+                    ):
+                        verifier.update(chunk)
+                        await asyncio.to_thread(f.write, chunk)
+                    verifier.verify()
+                except (
+                    DownloadVerificationError,
+                    aiohttp.ClientError,
+                    asyncio.TimeoutError,
+                ) as e:
+                    print(
+                        f"Retrying download ({attempt + 1}/{max_attempts}): {url} ({e})"
+                    )
+                    continue
+                finally:
+                    await asyncio.to_thread(f.close)
+
+            await asyncio.to_thread(os.replace, partial_path, output_path)
+            return
+
+        raise Exception(f"Failed to download {url} after {max_attempts} attempts")
+    finally:
+        # 失敗やキャンセルで書きかけのファイルを残さない (リネーム済みなら何もしない)
+        await asyncio.to_thread(partial_path.unlink, missing_ok=True)
+
+
+async def download_post_task(
+    client: AsyncHttpClient,
+    task: DownloadTask,
+    headers: dict[str, str],
+    download_config: DownloadConfig,
+    index: DirectoryIndex | None = None,
+) -> None:
+    targets = task.pending_targets(index)
+    if len(targets) == 0:
+        return
+
+    download_file = task.download_file
+    if download_file is None:
+        for item, _ in targets:
+            print(f"file_url is None! (skipped: ID {item.post.id})")
+        return
+
+    paths = [task.output_path(item, cache) for item, cache in targets]
+
+    # 出力先のディレクトリを初めて読むときやリンクを作るときはファイルシステムを触るので、スレッドで行う
+    source, destination, paths = await asyncio.to_thread(
+        find_download_source, task, paths, download_config, index
+    )
+    if source is None:
+        source = destination
+        await download_image(
+            client,
+            download_file.url,
+            destination.parent,
+            destination.stem,
+            download_file.file_ext,
+            headers,
+            md5=download_file.md5 if download_config.verify else None,
+            file_size=download_file.file_size if download_config.verify else None,
+            max_attempts=download_config.max_attempts,
+            index=index,
+        )
+
+    await asyncio.to_thread(materialize_download_task, source, paths, targets, index)
+
+
+async def download_caches(
+    client: AsyncHttpClient,
+    caches: list[ScrapeResultCache],
+    config: ScrapeConfig,
+    index: DirectoryIndex | None = None,
+) -> None:
+    if index is None:
+        index = DirectoryIndex()
+
+    for cache in caches:
+        index.ensure_dir(cache.output_path)
+
+    # 複数のサブセットに含まれる投稿は一度だけダウンロードして、残りはリンクする
+    tasks = plan_download_tasks(
+        [item for cache in caches for item in cache.items],
+        [cache for cache in caches for _ in cache.items],
+    )
+
+    remaining = scrape_util.drop_completed_tasks(tasks, index)
+    if len(remaining) < len(tasks):
+        print(f"Skipping {len(tasks) - len(remaining)} files already saved")
+    tasks = remaining
+
+    queue: asyncio.Queue[DownloadTask] = asyncio.Queue()
+    for task in scrape_util.sort_download_tasks(tasks):
+        queue.put_nowait(task)
+
+    headers = get_download_headers(config.auth)
+    failures: list[tuple[DownloadTask, Exception]] = []
+
+    with tqdm(total=sum(len(task.targets) for task in tasks)) as pbar:
+
+        async def worker():
+            while not queue.empty():
+                task = queue.get_nowait()
+
+                try:
+                    await download_post_task(
+                        client, task, headers, config.download, index
+                    )
+                except Exception as e:
+                    failures.append((task, e))
+                    item, _ = task.targets[0]
+                    print(f"Failed to download ID {item.post.id}: {e}")
+
+                pbar.update(len(task.targets))
+
+        await asyncio.gather(*[worker() for _ in range(config.max_workers)])
+
+    scrape_util.report_download_failures(failures)
+
+
+# 検索クエリに移したフィルターと、減ったページ数の見積もりを表示する
+async def report_query_plan(
+    scraper: AsyncDanbooruScraper, plan: QueryPlan, total_limit: int
+) -> None:
+    if len(plan.pushed) == 0:
+        return
+
+    # 1 ページで足りるなら、見積もりのために件数を数えない
+    if total_limit <= MAX_POSTS_PER_PAGE:
+        print(f"Pushed down {len(plan.pushed)} filter tags (Query: {plan.query})")
+        return
+
+    try:
+        base_count, planned_count = await asyncio.gather(
+            scraper.count_posts(plan.base_query), scraper.count_posts(plan.query)
+        )
+    except Exception as e:
+        print(f"Pushed down {len(plan.pushed)} filter tags (Query: {plan.query}): {e}")
+        return
+
+    print(
+        describe_query_plan(
+            plan, base_count, planned_count, total_limit, MAX_POSTS_PER_PAGE
+        )
+    )
+
+
+# キャッシュより新しい投稿だけを検索して足す (できないクエリなら None)
+async def refresh_search_cache(
+    scraper: AsyncDanbooruScraper,
+    plan: QueryPlan,
+    posts: list[DanbooruPostItem],
+    config: ScrapeConfig,
+    cache_config: CacheConfig,
+    subset: QuerySubset | QueryListSubset,
+) -> list[DanbooruPostItem] | None:
+    refresh = plan_search_cache_refresh(
+        plan, posts, cache_config.recheck_recent, get_tag_limit(config.auth)
+    )
+    if refresh is None:
+        print(f"Cannot refresh the cache incrementally (Query: {plan.query})")
+        return None
+
+    async def search(query: str, limit: int) -> list[DanbooruPostItem]:
+        return await get_posts(
+            scraper,
+            query,
+            plan.result_filter,
+            config.search_result_filter,
+            total_limit=limit,
+            limit_per_page=200,
+            pagination=config.pagination,
+            prefetch=0,
+        )
+
+    new_posts, *rechecked = await asyncio.gather(
+        search(refresh.since_query, subset.limit),
+        *[search(query, limit) for query, limit in refresh.recheck_queries],
+    )
+
+    return await asyncio.to_thread(
+        apply_search_cache_refresh,
+        refresh,
+        subset.output_path,
+        search_key(scraper.domain, plan),
+        posts,
+        new_posts,
+        [item for items in rechecked for item in items],
+        subset.limit,
+    )
+
+
+async def search_subset(
+    client: AsyncHttpClient,
+    config: ScrapeConfig,
+    cache_config: CacheConfig | None,
+    subset: QuerySubset | QueryListSubset,
+    query: str,
+) -> ScrapeResultCache:
+    scraper = AsyncDanbooruScraper(
+        client, subset.domain or config.domain, config.auth, config.lazy_posts
+    )
+
+    plan = plan_query(
+        query,
+        subset.search_filter,
+        config.search_filter,
+        subset.search_result_filter,
+        config.search_result_filter,
+        config.auth,
+        get_reserved_tags(cache_config),
+    )
+    query = plan.query
+    key = search_key(scraper.domain, plan)
+
+    # キャッシュから
+    posts = await asyncio.to_thread(
+        load_search_cache, subset.output_path, key, limit=subset.limit
+    )
+
+    if posts is not None and cache_config is not None and cache_config.refresh:
+        posts = await refresh_search_cache(
+            scraper, plan, posts, config, cache_config, subset
+        )
+
+    if posts is not None:
+        posts = posts[: subset.limit]
+        print(f"Found {len(posts)} posts in cache (Query: {query})")
+    else:
+        await report_query_plan(scraper, plan, subset.limit)
+
+        posts = await get_posts(
+            scraper,
+            query,
+            plan.result_filter,
+            config.search_result_filter,
+            total_limit=subset.limit,
+            limit_per_page=200,
+            pagination=config.pagination,
+            prefetch=config.prefetch_pages,
+            journal=await asyncio.to_thread(open_journal, subset.save_state_path),
+            journal_key=str(key),
+        )
+        print(f"Found {len(posts)} posts (Query: {query})")
+
+        if cache_config is not None and cache_config.search_result:
+            await asyncio.to_thread(save_search_cache, subset.output_path, key, posts)
+
+    return ScrapeResultCache(posts, subset)
+
+
+async def load_subset(
+    client: AsyncHttpClient,
+    config: ScrapeConfig,
+    cache_config: CacheConfig | None,
+    subset: ScrapeSubset,
+) -> list[ScrapeResultCache]:
+    if isinstance(subset, QuerySubset):
+        return [await search_subset(client, config, cache_config, subset, subset.query)]
+    elif isinstance(subset, QueryListSubset):
+        queries = utils.load_file_lines(subset.query_list_file)
+        return list(
+            await asyncio.gather(
+                *[
+                    search_subset(client, config, cache_config, subset, query)
+                    for query in queries
+                ]
+            )
+        )
+    elif isinstance(subset, PostListSubset):
+        post_urls = utils.load_file_lines(subset.post_url_list_file)
+
+        posts = await asyncio.to_thread(scrape_util.load_post_list_state, subset)
+        if posts is None:
+            posts = await resolve_post_urls(client, post_urls, config.auth)
+            await asyncio.to_thread(scrape_util.save_post_list_state, subset, posts)
+        print(f"Found {len(posts)} posts")
+        return [ScrapeResultCache(posts, subset)]
+    else:
+        raise Exception("Invalid subset type")
+
+
+def create_session(config: ScrapeConfig) -> aiohttp.ClientSession:
+    http_config: HttpConfig = config.http
+
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=http_config.limit_per_host or config.max_workers,
+    )
+    # requests と同じく、接続と読み込みのそれぞれの待ち時間 (大きなファイルの全体の時間は制限しない)
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=http_config.timeout, sock_read=http_config.timeout
+    )
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def main(config: ScrapeConfig, cache_config: CacheConfig | None) -> None:
+    async with create_session(config) as session:
+        client = AsyncHttpClient(
+            session,
+            max_retries=config.http.max_retries,
+            backoff_factor=config.http.backoff_factor,
+            max_backoff=config.http.max_backoff,
+        )
+
+        print("Searching...")
+        caches: list[ScrapeResultCache] = [
+            cache
+            for subset_caches in await asyncio.gather(
+                *[
+                    load_subset(client, config, cache_config, subset)
+                    for subset in config.subsets
+                ]
+            )
+            for cache in subset_caches
+        ]
+
+        # caption post process
+        print("Analyzing captions...")
+        for cache in caches:
+            for item in cache.items:
+                if cache.caption is not None:
+                    item = do_all_caption_post_process(item, cache.caption)
+                # fallback
+                item = do_all_caption_post_process(item, config.caption)
+
+        # 出力先のディレクトリは一度だけ読んで、ファイルごとの stat を避ける
+        index = DirectoryIndex()
+
+        for cache in caches:
+            prepare_download_files(cache, config.download)
+
+            await asyncio.to_thread(
+                scrape_util.save_post_captions,
+                cache.items,
+                [cache] * len(cache.items),
+                config.caption,
+                index,
+            )
+
+        print(f"Downloading {sum(len(cache.items) for cache in caches)} images...")
+        await download_caches(client, caches, config, index)
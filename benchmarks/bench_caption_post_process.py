@@ -0,0 +1,78 @@
+import random
+import sys
+import time
+
+sys.path.append(".")
+
+from tags import compile_caption_config
+from scrape_util import DanbooruPostItem
+from danbooru_post import PostSummary
+from scrape_config import (
+    CaptionConfig,
+    CaptionPostProcessConfig,
+    DeleteConfig,
+    ReplaceConfig,
+)
+from default_tags import VIOLENCE_TAGS_FILE
+
+# 以前の実装はテストに写した元の tags.py の実装を使う
+from tests.test_tags import legacy_all_caption_post_process
+
+NUM_POSTS = 10_000
+VOCABULARY_SIZE = 20_000
+TAGS_PER_POST = 30
+
+
+def make_items(vocabulary: list[str]) -> list[DanbooruPostItem]:
+    rng = random.Random(0)
+    return [
+        DanbooruPostItem(
+            post=PostSummary(
+                id=i,
+                file_ext="png",
+                file_size=1000,
+                rating=rng.choice(["g", "s", "q", "e"]),
+                score=rng.randrange(100),
+            ),
+            artist_tags=[rng.choice(vocabulary)],
+            character_tags=[rng.choice(vocabulary)],
+            copyright_tags=[rng.choice(vocabulary)],
+            general_tags=rng.sample(vocabulary, TAGS_PER_POST),
+            meta_tags=["highres", "absurdres", "commentary_request"],
+        )
+        for i in range(NUM_POSTS)
+    ]
+
+
+def main():
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+
+    # デフォルト設定 (meta はファイルのタグだけ残す) に、ファイル指定の削除と置換を加える
+    config = CaptionConfig(
+        general=CaptionPostProcessConfig(
+            replaces=[ReplaceConfig(tags=vocabulary[:100], to="replaced")],
+            deletes=[DeleteConfig(tags=VIOLENCE_TAGS_FILE)],
+        ),
+        quality={"masterpiece": 80, "best quality": 50},
+    )
+
+    items = make_items(vocabulary)
+    start = time.perf_counter()
+    legacy = [legacy_all_caption_post_process(item, config).dict() for item in items]
+    legacy_time = time.perf_counter() - start
+
+    items = make_items(vocabulary)
+    start = time.perf_counter()
+    plan = compile_caption_config(config)
+    compiled = [plan(item).dict() for item in items]
+    compiled_time = time.perf_counter() - start
+
+    assert legacy == compiled
+
+    print(f"posts: {NUM_POSTS}")
+    print(f"legacy:   {legacy_time:.3f}s")
+    print(f"compiled: {compiled_time:.3f}s ({legacy_time / compiled_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
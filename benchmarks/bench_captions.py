@@ -0,0 +1,145 @@
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(".")
+
+import utils
+from scrape_util import (
+    DanbooruPostItem,
+    ScrapeResultCache,
+    compose_captions,
+    save_post_captions,
+)
+from danbooru_post import PostSummary
+from scrape_config import CaptionConfig, ScrapeSubset
+from default_tags import PERSON_TAGS_FILE
+
+NUM_POSTS = 50_000
+VOCABULARY_SIZE = 20_000
+TAGS_PER_POST = 30
+
+PERSON_TAGS = utils.load_file_lines(PERSON_TAGS_FILE)
+
+
+# 以前の _compose_tags_nai_style と同じ処理
+def legacy_compose_tags(item: DanbooruPostItem, category_separator: str) -> str:
+    person_tags = [tag for tag in item.general_tags if tag in PERSON_TAGS]
+    other_tags = [tag for tag in item.general_tags if tag not in PERSON_TAGS]
+    return category_separator.join(
+        [
+            category
+            for category in (
+                ", ".join([tag for tag in tags if tag.strip() != ""])
+                for tags in [
+                    person_tags,
+                    item.artist_tags,
+                    item.character_tags,
+                    item.copyright_tags,
+                    other_tags,
+                    item.meta_tags,
+                    item.quality_tags,
+                    item.rating_tags,
+                ]
+            )
+            if category.strip() != ""
+        ]
+    )
+
+
+# 以前の scrape_util.save_caption
+def legacy_save_caption(
+    caption: str, output_dir: str | Path, filename: str, extension: str, overwrite: bool
+) -> None:
+    output_path = Path(output_dir) / f"{filename}.{extension}"
+
+    if output_path.exists() and not overwrite:
+        return
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(caption)
+
+
+# 以前の save_post_captions と同じ、1 件ごとに mkdir と書き込みをする処理
+def legacy_save_post_captions(cache: ScrapeResultCache, config: CaptionConfig):
+    for item in cache.items:
+        Path(cache.output_path).mkdir(parents=True, exist_ok=True)
+        legacy_save_caption(
+            legacy_compose_tags(item, config.category_separator),
+            cache.output_path,
+            str(item.post.id),
+            config.extension,
+            config.overwrite,
+        )
+
+
+def make_cache(output_path: str, vocabulary: list[str]) -> ScrapeResultCache:
+    rng = random.Random(0)
+    items = [
+        DanbooruPostItem(
+            post=PostSummary(
+                id=i, file_ext="png", file_size=1000, rating="g", score=10
+            ),
+            artist_tags=[rng.choice(vocabulary)],
+            character_tags=[rng.choice(vocabulary)],
+            copyright_tags=[rng.choice(vocabulary)],
+            general_tags=["1girl"] + rng.sample(vocabulary, TAGS_PER_POST),
+            meta_tags=["highres"],
+            quality_tags=["best quality"],
+            rating_tags=["general"],
+        )
+        for i in range(NUM_POSTS)
+    ]
+    return ScrapeResultCache(items, ScrapeSubset(output_path=output_path))
+
+
+def main():
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+    config = CaptionConfig(category_order="naidv3", overwrite=True)
+
+    # キャプションを作る部分 (CPU)
+    cache = make_cache("", vocabulary)
+    start = time.perf_counter()
+    legacy = [legacy_compose_tags(item, ", ") for item in cache.items]
+    legacy_compose_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = compose_captions(cache.items, ", ", "naidv3")
+    batch_compose_time = time.perf_counter() - start
+
+    assert legacy == batch
+
+    # 書き込みまで
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_cache = make_cache(str(Path(tmp_dir) / "legacy"), vocabulary)
+        start = time.perf_counter()
+        legacy_save_post_captions(legacy_cache, config)
+        legacy_time = time.perf_counter() - start
+
+        cache = make_cache(str(Path(tmp_dir) / "batch"), vocabulary)
+        start = time.perf_counter()
+        save_post_captions(cache.items, [cache] * len(cache.items), config)
+        batch_time = time.perf_counter() - start
+
+        for post_id in random.Random(1).sample(range(NUM_POSTS), 100):
+            assert (Path(tmp_dir) / "legacy" / f"{post_id}.txt").read_text(
+                encoding="utf-8"
+            ) == (Path(tmp_dir) / "batch" / f"{post_id}.txt").read_text(
+                encoding="utf-8"
+            )
+
+    print(f"posts: {NUM_POSTS}")
+    print(
+        f"compose: per post {legacy_compose_time:.3f}s, batch {batch_compose_time:.3f}s"
+        f" ({legacy_compose_time / batch_compose_time:.1f}x)"
+    )
+    print(
+        f"write:   per post {legacy_time:.3f}s, batch {batch_time:.3f}s"
+        f" ({legacy_time / batch_time:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
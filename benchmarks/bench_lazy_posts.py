@@ -0,0 +1,73 @@
+import json
+import random
+import sys
+import time
+
+sys.path.append(".")
+
+from bench_post_memory import make_response
+from danbooru_post import DanbooruPost, LazyPost
+from scrape_util import filter_page_posts
+from scrape_config import SearchResultFilterConfig
+from tag_filter import CompiledResultFilter
+
+NUM_PAGES = 50
+POSTS_PER_PAGE = 200
+VOCABULARY_SIZE = 20_000
+NUM_EXCLUSION_TAGS = 1_500
+
+
+def main():
+    random.seed(0)
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+
+    # posts.json と同じ、1 ページ 200 件の配列
+    pages = [
+        "["
+        + ",".join(
+            make_response(page * POSTS_PER_PAGE + i, vocabulary)
+            for i in range(POSTS_PER_PAGE)
+        )
+        + "]"
+        for page in range(NUM_PAGES)
+    ]
+
+    # 大半の投稿が除外されるフィルター
+    result_filter = CompiledResultFilter(
+        SearchResultFilterConfig(
+            exclude_any=[
+                tag.replace("_", " ")
+                for tag in random.sample(vocabulary, NUM_EXCLUSION_TAGS)
+            ]
+        )
+    )
+
+    start = time.perf_counter()
+    validated = [
+        item.dict()
+        for page in pages
+        for item in filter_page_posts(
+            [DanbooruPost(**post) for post in json.loads(page)], result_filter
+        )
+    ]
+    validated_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lazy = [
+        item.dict()
+        for page in pages
+        for item in filter_page_posts(
+            [LazyPost(post) for post in json.loads(page)], result_filter
+        )
+    ]
+    lazy_time = time.perf_counter() - start
+
+    assert validated == lazy
+
+    print(f"posts: {NUM_PAGES * POSTS_PER_PAGE}, kept: {len(lazy)}")
+    print(f"validated: {validated_time:.3f}s")
+    print(f"lazy:      {lazy_time:.3f}s ({validated_time / lazy_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
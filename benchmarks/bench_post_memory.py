@@ -0,0 +1,153 @@
+import gc
+import json
+import random
+import sys
+import tracemalloc
+
+from pydantic import BaseModel
+
+sys.path.append(".")
+
+from danbooru_post import DanbooruPost
+from scrape_util import DanbooruPostItem, parse_general_tags, parse_other_tags
+
+NUM_POSTS = 20_000
+VOCABULARY_SIZE = 20_000
+TAGS_PER_POST = 30
+
+
+# 以前の DanbooruPostItem と同じ、投稿とタグの文字列をそのまま持つもの
+class LegacyPostItem(BaseModel):
+    post: DanbooruPost
+
+    artist_tags: list[str] = []
+    character_tags: list[str] = []
+    copyright_tags: list[str] = []
+    general_tags: list[str] = []
+    meta_tags: list[str] = []
+
+    quality_tags: list[str] = []
+
+    rating_tags: list[str] = []
+
+    @staticmethod
+    def new(post: DanbooruPost):
+        return LegacyPostItem(
+            post=post,
+            artist_tags=parse_other_tags(post.tag_string_artist),
+            character_tags=parse_other_tags(post.tag_string_character),
+            copyright_tags=parse_other_tags(post.tag_string_copyright),
+            general_tags=parse_general_tags(post.tag_string_general),
+            meta_tags=parse_other_tags(post.tag_string_meta),
+        )
+
+
+def make_response(post_id: int, vocabulary: list[str]) -> str:
+    general = " ".join(random.sample(vocabulary, TAGS_PER_POST))
+    variants = [
+        {
+            "type": type,
+            "url": f"https://cdn.donmai.us/{type}/{post_id}.jpg",
+            "width": size,
+            "height": size,
+            "file_ext": "jpg",
+        }
+        for type, size in [
+            ("180x180", 180),
+            ("360x360", 360),
+            ("720x720", 720),
+            ("sample", 850),
+            ("original", 2000),
+        ]
+    ]
+    return json.dumps(
+        {
+            "id": post_id,
+            "created_at": "2024-01-01T00:00:00.000+09:00",
+            "uploader_id": 1,
+            "score": 10,
+            "source": "https://example.com/" + str(post_id),
+            "rating": "g",
+            "image_width": 2000,
+            "image_height": 2000,
+            "tag_string": general,
+            "fav_count": 0,
+            "file_ext": "jpg",
+            "has_children": False,
+            "tag_count_general": TAGS_PER_POST,
+            "tag_count_artist": 1,
+            "tag_count_character": 1,
+            "tag_count_copyright": 1,
+            "file_size": 1000,
+            "up_score": 10,
+            "down_score": 0,
+            "is_pending": False,
+            "is_flagged": False,
+            "is_deleted": False,
+            "tag_count": TAGS_PER_POST + 3,
+            "updated_at": "2024-01-01T00:00:00.000+09:00",
+            "is_banned": False,
+            "has_active_children": False,
+            "bit_flags": 0,
+            "tag_count_meta": 0,
+            "has_large": True,
+            "has_visible_children": False,
+            "media_asset": {
+                "id": post_id,
+                "created_at": "2024-01-01T00:00:00.000+09:00",
+                "updated_at": "2024-01-01T00:00:00.000+09:00",
+                "md5": f"{post_id:032x}",
+                "file_ext": "jpg",
+                "file_size": 1000,
+                "image_width": 2000,
+                "image_height": 2000,
+                "status": "active",
+                "is_public": True,
+                "pixel_hash": f"{post_id:032x}",
+                "variants": variants,
+            },
+            "tag_string_general": general,
+            "tag_string_character": random.choice(vocabulary),
+            "tag_string_copyright": random.choice(vocabulary),
+            "tag_string_artist": random.choice(vocabulary),
+            "tag_string_meta": "",
+            "md5": f"{post_id:032x}",
+            "file_url": f"https://cdn.donmai.us/original/{post_id}.jpg",
+            "large_file_url": f"https://cdn.donmai.us/sample/{post_id}.jpg",
+        }
+    )
+
+
+# レスポンスを読み込んだあとに残っているメモリ
+def measure(responses: list[str], new_item) -> tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+
+    items = [new_item(DanbooruPost(**json.loads(response))) for response in responses]
+
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del items
+    return current, peak
+
+
+def main():
+    random.seed(0)
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+    responses = [make_response(i, vocabulary) for i in range(NUM_POSTS)]
+
+    legacy, legacy_peak = measure(responses, LegacyPostItem.new)
+    compact, compact_peak = measure(responses, DanbooruPostItem.new)
+
+    print(f"posts: {NUM_POSTS}")
+    print(f"legacy:  {legacy / 2**20:.1f} MiB (peak {legacy_peak / 2**20:.1f} MiB)")
+    print(
+        f"compact: {compact / 2**20:.1f} MiB (peak {compact_peak / 2**20:.1f} MiB)"
+        f" ({legacy / compact:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import json
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(".")
+
+from bench_post_memory import make_response
+from danbooru_post import DanbooruPost
+from scrape_util import DanbooruPostItem
+from post_store import PostStore
+from query import SearchKey
+
+NUM_POSTS = 10_000
+NUM_QUERIES = 200
+POSTS_PER_QUERY = 1_000
+VOCABULARY_SIZE = 20_000
+# サブセットの limit が小さくなった場合
+LOAD_LIMIT = 100
+
+
+def directory_size(directory: Path) -> int:
+    return sum(path.stat().st_size for path in directory.rglob("*") if path.is_file())
+
+
+def main():
+    random.seed(0)
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+
+    items = [
+        DanbooruPostItem.new(DanbooruPost(**json.loads(make_response(i, vocabulary))))
+        for i in range(NUM_POSTS)
+    ]
+    items = [item.dict() for item in items]
+
+    # 関連するクエリは同じ投稿を多く含む
+    queries = {
+        SearchKey("danbooru.donmai.us", f"query_{i}", ""): sorted(
+            random.sample(items, POSTS_PER_QUERY), key=lambda item: -item["post"]["id"]
+        )
+        for i in range(NUM_QUERIES)
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_dir = Path(tmp_dir) / "json"
+        json_dir.mkdir()
+
+        # 以前の形式: クエリごとに全件を JSON で保存する
+        for i, (query, query_items) in enumerate(queries.items()):
+            with open(json_dir / f"{i}.json", "w", encoding="utf-8") as f:
+                json.dump(query_items, f)
+
+        store = PostStore(Path(tmp_dir) / "store" / "posts.sqlite")
+        for query, query_items in queries.items():
+            store.save(query, query_items)
+        store.close()
+
+        json_size = directory_size(json_dir)
+        store_size = directory_size(Path(tmp_dir) / "store")
+
+        start = time.perf_counter()
+        for i in range(NUM_QUERIES):
+            with open(json_dir / f"{i}.json", "r", encoding="utf-8") as f:
+                json_items = json.load(f)
+        json_time = (time.perf_counter() - start) / NUM_QUERIES
+
+        store = PostStore(Path(tmp_dir) / "store" / "posts.sqlite")
+        start = time.perf_counter()
+        for query in queries:
+            store_items = store.load(query)
+        store_time = (time.perf_counter() - start) / NUM_QUERIES
+
+        start = time.perf_counter()
+        for query in queries:
+            limited_items = store.load(query, LOAD_LIMIT)
+        limited_time = (time.perf_counter() - start) / NUM_QUERIES
+        store.close()
+
+    assert json_items == store_items
+    assert json_items[:LOAD_LIMIT] == limited_items
+
+    print(f"posts: {NUM_POSTS}, queries: {NUM_QUERIES} x {POSTS_PER_QUERY}")
+    print(f"json:  {json_size / 2**20:.1f} MiB, {json_time * 1000:.1f} ms/query")
+    print(
+        f"store: {store_size / 2**20:.1f} MiB ({json_size / store_size:.1f}x smaller), "
+        f"{store_time * 1000:.1f} ms/query ({json_time / store_time:.1f}x)"
+    )
+    print(
+        f"store (limit {LOAD_LIMIT}): {limited_time * 1000:.1f} ms/query"
+        f" ({json_time / limited_time:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(".")
+
+from tag_filter import CompiledResultFilter
+from scrape_config import SearchResultFilterConfig
+
+NUM_POSTS = 100_000
+NUM_EXCLUSION_TAGS = 1_000
+VOCABULARY_SIZE = 20_000
+TAGS_PER_POST = 30
+
+
+# 以前の get_posts と同じ、リストに対する判定
+def legacy_match(post, result_filter: SearchResultFilterConfig) -> bool:
+    all_tags = [
+        *post.artist_tags,
+        *post.copyright_tags,
+        *post.character_tags,
+        *post.general_tags,
+        *post.meta_tags,
+    ]
+
+    if result_filter.include_any != [] and all(
+        tag not in result_filter.include_any for tag in all_tags
+    ):
+        return False
+    if result_filter.exclude_any != [] and any(
+        tag in result_filter.exclude_any for tag in all_tags
+    ):
+        return False
+
+    return True
+
+
+def main():
+    random.seed(0)
+    vocabulary = [f"tag_{i}" for i in range(VOCABULARY_SIZE)]
+
+    posts = [
+        SimpleNamespace(
+            artist_tags=[random.choice(vocabulary)],
+            copyright_tags=[random.choice(vocabulary)],
+            character_tags=[random.choice(vocabulary)],
+            general_tags=random.sample(vocabulary, TAGS_PER_POST),
+            meta_tags=[random.choice(vocabulary)],
+        )
+        for _ in range(NUM_POSTS)
+    ]
+
+    config = SearchResultFilterConfig(
+        exclude_any=random.sample(vocabulary, NUM_EXCLUSION_TAGS),
+    )
+
+    start = time.perf_counter()
+    legacy = [post for post in posts if legacy_match(post, config)]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result_filter = CompiledResultFilter(config)
+    compiled = [post for post in posts if result_filter.match(post)]
+    compiled_time = time.perf_counter() - start
+
+    assert legacy == compiled
+
+    print(f"posts: {NUM_POSTS}, exclusion tags: {NUM_EXCLUSION_TAGS}")
+    print(f"matched: {len(compiled)}")
+    print(f"list:     {legacy_time:.3f}s")
+    print(f"compiled: {compiled_time:.3f}s ({legacy_time / compiled_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+from pathlib import Path
+
+import utils
+import post_store
+from post_store import PostStore
+from query import plan_query, search_key
+from scrape_config import (
+    QueryListSubset,
+    QuerySubset,
+    load_scrape_config,
+)
+from cache_util import (
+    get_cache_config,
+    gc_config_caches,
+    import_legacy_search_cache,
+)
+
+
+def gc(config_file: str, ttl: float | None, max_bytes: int | None) -> None:
+    config = load_scrape_config(config_file)
+    cache_config = get_cache_config(config)
+    if cache_config is None:
+        print("Cache is disabled")
+        return
+
+    if ttl is not None:
+        cache_config.search_result_ttl = ttl
+    if max_bytes is not None:
+        cache_config.search_result_max_bytes = max_bytes
+
+    # まだ無ければ作らない
+    path = Path(cache_config.search_result_path)
+    post_store.configure(
+        path if cache_config.search_result and path.exists() else None,
+        cache_config.search_result_ttl,
+    )
+
+    result = gc_config_caches(config, cache_config)
+    post_store.configure(None)
+
+    print(
+        f"Removed {result.removed} cached searches"
+        f" ({result.freed / 2**20:.1f} MiB freed, {result.size / 2**20:.1f} MiB left)"
+    )
+
+
+# 以前の形式のファイル名はクエリ (結果のフィルターを移す前) のハッシュなので、設定ファイルのクエリから探す
+def migrate(config_file: str) -> None:
+    config = load_scrape_config(config_file)
+    cache_config = get_cache_config(config)
+    if cache_config is None or not cache_config.search_result:
+        print("Search result cache is disabled")
+        return
+
+    store = PostStore(cache_config.search_result_path)
+    imported = 0
+
+    for subset in config.subsets:
+        if isinstance(subset, QuerySubset):
+            queries = [subset.query]
+        elif isinstance(subset, QueryListSubset):
+            queries = utils.load_file_lines(subset.query_list_file)
+        else:
+            continue
+
+        for query in queries:
+            plan = plan_query(
+                query,
+                subset.search_filter,
+                config.search_filter,
+                subset.search_result_filter,
+                config.search_result_filter,
+                config.auth,
+            )
+            key = search_key(subset.domain or config.domain, plan)
+            if import_legacy_search_cache(store, subset.output_path, key):
+                imported += 1
+
+    store.close()
+
+    print(f"Imported {imported} cached searches")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the search result cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gc_parser = subparsers.add_parser(
+        "gc", help="Remove expired or least recently used search results"
+    )
+    gc_parser.add_argument("config", help="The scrape config file")
+    gc_parser.add_argument("--ttl", type=float, help="Override search_result_ttl")
+    gc_parser.add_argument(
+        "--max-bytes", type=int, help="Override search_result_max_bytes"
+    )
+
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Import <output_path>/cache/<hash>.json files into the store"
+    )
+    migrate_parser.add_argument("config", help="The scrape config file")
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        gc(args.config, args.ttl, args.max_bytes)
+    elif args.command == "migrate":
+        migrate(args.config)
@@ -1,8 +1,32 @@
 from pathlib import Path
 from hashlib import sha256
+from functools import partial
+from typing import Callable
 import json
+import os
+import re
+import time
 
-from scrape_util import DanbooruPostItem
+import post_store
+from post_store import PostStore
+from scrape_util import (
+    DanbooruPostItem,
+    DownloadFile,
+    ScrapeResultCache,
+    MAX_POSTS_PER_PAGE,
+    assign_download_files,
+    merge_refreshed_posts,
+)
+from scrape_config import CacheConfig, DownloadConfig, ScrapeConfig
+from query import QueryPlan, SearchKey, can_refresh, post_ids_query, since_id_query
+
+# 選んだバリアントの記録
+DOWNLOAD_FILES_CACHE_NAME = "download_files"
+
+
+# 以前の形式の検索結果のファイル名 (<hash>.json)
+# (出力先ごとのファイルなので、ドメインやフィルターは入れずにクエリだけのハッシュ)
+QUERY_HASH_PATTERN = re.compile(r"[0-9a-f]{16}")
 
 
 def _calc_query_hash(search_query: str) -> str:
@@ -42,40 +66,312 @@ def save_cache(directory: str | Path, hash: str, data, tmp_dirname: str = "cache
         json.dump(data, f)
 
 
+# limit を指定すると先頭からその件数だけを読む
 def load_search_cache(
-    directory: str | Path, search_query: str, tmp_dirname: str = "cache"
+    directory: str | Path,
+    key: SearchKey,
+    tmp_dirname: str = "cache",
+    limit: int | None = None,
 ) -> list[DanbooruPostItem] | None:
     if isinstance(directory, str):
         directory = Path(directory)
 
-    query_hash = _calc_query_hash(search_query)
+    store = post_store.get_store()
+    result = store.load(key, limit) if store is not None else None
 
-    result = load_cache(
-        directory,
-        query_hash,
-        tmp_dirname=tmp_dirname,
-    )
+    # 以前の形式 (<output_path>/cache/<hash>.json)
+    if result is None:
+        query_hash = _calc_query_hash(key.query)
+        cache_file = directory / tmp_dirname / f"{query_hash}.json"
+
+        if store is not None and store.ttl is not None and cache_file.exists():
+            if time.time() - cache_file.stat().st_mtime >= store.ttl:
+                return None
+
+        result = load_cache(
+            directory,
+            query_hash,
+            tmp_dirname=tmp_dirname,
+        )
+
+        if result is not None and store is not None:
+            # このサブセットのキーでストアに移して、次からはそちらを読む
+            store.save(key, result)
+            cache_file.unlink()
+        elif result is not None:
+            # 最後に使った時刻として atime を更新する (mtime は保存した時刻のまま)
+            os.utime(cache_file, (time.time(), cache_file.stat().st_mtime))
 
     if result is None:
         return None
 
-    return [DanbooruPostItem(**item) for item in result]
+    return [DanbooruPostItem(**item) for item in result[:limit]]
 
 
+# replace_prefix を指定すると、キャッシュの先頭からその件数だけを items で置き換える
 def save_search_cache(
     directory: str | Path,
-    search_query: str,
+    key: SearchKey,
     items: list[DanbooruPostItem],
     tmp_dirname: str = "cache",
+    replace_prefix: int | None = None,
 ):
     if isinstance(directory, str):
         directory = Path(directory)
 
-    query_hash = _calc_query_hash(search_query)
+    store = post_store.get_store()
+    if store is not None:
+        store.save(key, [item.dict() for item in items], replace_prefix)
+        return
+
+    query_hash = _calc_query_hash(key.query)
+
+    if replace_prefix is not None:
+        cached = load_cache(directory, query_hash, tmp_dirname=tmp_dirname) or []
+        post_ids = set(item.post.id for item in items)
+        tail = [
+            item
+            for item in cached[replace_prefix:]
+            if item["post"]["id"] not in post_ids
+        ]
+    else:
+        tail = []
 
     save_cache(
         directory,
         query_hash,
-        [item.dict() for item in items],
+        [item.dict() for item in items] + tail,
         tmp_dirname=tmp_dirname,
     )
+
+
+# キャッシュを更新するために検索するクエリ (同期と非同期のエンジンで共通)
+class SearchCacheRefresh:
+    since_query: str
+    recheck_queries: list[tuple[str, int]]
+    checked_ids: list[int]
+
+    def __init__(
+        self,
+        since_query: str,
+        recheck_queries: list[tuple[str, int]],
+        checked_ids: list[int],
+    ) -> None:
+        self.since_query = since_query
+        self.recheck_queries = recheck_queries
+        self.checked_ids = checked_ids
+
+
+# キャッシュより新しい投稿だけを検索するクエリを作る (できないクエリなら None)
+def plan_search_cache_refresh(
+    plan: QueryPlan,
+    posts: list[DanbooruPostItem],
+    recheck_recent: int,
+    tag_limit: int,
+) -> SearchCacheRefresh | None:
+    if not can_refresh(plan.query, tag_limit):
+        return None
+
+    since_id = max((item.post.id for item in posts), default=0)
+
+    # 最近の投稿はスコアやタグが変わりやすいので取得し直す
+    checked_ids = [item.post.id for item in posts[:recheck_recent]]
+    recheck_queries = []
+    for i in range(0, len(checked_ids), MAX_POSTS_PER_PAGE):
+        post_ids = checked_ids[i : i + MAX_POSTS_PER_PAGE]
+        recheck_queries.append((post_ids_query(plan.query, post_ids), len(post_ids)))
+
+    return SearchCacheRefresh(
+        since_id_query(plan.query, since_id), recheck_queries, checked_ids
+    )
+
+
+# 検索した結果をキャッシュに反映して保存する
+def apply_search_cache_refresh(
+    refresh: SearchCacheRefresh,
+    directory: str | Path,
+    key: SearchKey,
+    posts: list[DanbooruPostItem],
+    new_posts: list[DanbooruPostItem],
+    rechecked: list[DanbooruPostItem],
+    limit: int,
+) -> list[DanbooruPostItem]:
+    print(
+        f"Found {len(new_posts)} new posts, rechecked {len(refresh.checked_ids)} posts"
+        f" (Query: {key.query})"
+    )
+
+    # 間にまだ取得していない投稿があるかもしれないので、古いキャッシュは使わない
+    if len(new_posts) >= limit:
+        save_search_cache(directory, key, new_posts)
+        return new_posts
+
+    merged = merge_refreshed_posts(
+        posts,
+        new_posts,
+        rechecked,
+        set(refresh.checked_ids),
+        len(new_posts) + len(posts),
+    )
+
+    # 読み込まなかったキャッシュの残りはそのまま後ろに残す
+    save_search_cache(directory, key, merged, replace_prefix=len(posts))
+    return merged
+
+
+# 以前の形式のファイルがあればストアに移す
+def import_legacy_search_cache(
+    store: PostStore,
+    directory: str | Path,
+    key: SearchKey,
+    tmp_dirname: str = "cache",
+) -> bool:
+    query_hash = _calc_query_hash(key.query)
+    result = load_cache(directory, query_hash, tmp_dirname=tmp_dirname)
+    if result is None:
+        return False
+
+    store.save(key, result)
+    (Path(directory) / tmp_dirname / f"{query_hash}.json").unlink()
+    return True
+
+
+def load_download_files(
+    directory: str | Path, tmp_dirname: str = "cache"
+) -> dict[str, DownloadFile]:
+    result = load_cache(directory, DOWNLOAD_FILES_CACHE_NAME, tmp_dirname=tmp_dirname)
+
+    if result is None:
+        return {}
+
+    return {post_id: DownloadFile(**file) for post_id, file in result.items()}
+
+
+def save_download_files(
+    directory: str | Path,
+    files: dict[str, DownloadFile],
+    tmp_dirname: str = "cache",
+):
+    save_cache(
+        directory,
+        DOWNLOAD_FILES_CACHE_NAME,
+        {post_id: file.dict() for post_id, file in files.items()},
+        tmp_dirname=tmp_dirname,
+    )
+
+
+# 再実行しても同じファイルを選ぶように、選んだバリアントを記録しておく
+def prepare_download_files(
+    cache: ScrapeResultCache,
+    download_config: DownloadConfig,
+    tmp_dirname: str = "cache",
+):
+    if download_config.variant == "original":
+        return
+
+    files = assign_download_files(
+        cache.items,
+        download_config,
+        load_download_files(cache.output_path, tmp_dirname=tmp_dirname),
+    )
+
+    save_download_files(cache.output_path, files, tmp_dirname=tmp_dirname)
+
+
+def get_cache_config(config: ScrapeConfig) -> CacheConfig | None:
+    if isinstance(config.cache, CacheConfig):
+        return config.cache
+    return CacheConfig() if config.cache == True else None
+
+
+# キャッシュを更新するなら、id のメタタグを足せるように検索クエリのタグをひとつ空けておく
+def get_reserved_tags(cache_config: CacheConfig | None) -> int:
+    return 1 if cache_config is not None and cache_config.refresh else 0
+
+
+class CacheGcResult:
+    removed: int
+    freed: int
+    size: int
+
+    def __init__(self, removed: int, freed: int, size: int) -> None:
+        self.removed = removed
+        self.freed = freed
+        self.size = size
+
+
+def _remove_file(path: Path) -> int:
+    size = path.stat().st_size
+    path.unlink()
+    return size
+
+
+def _legacy_search_cache_files(
+    directory: str | Path, tmp_dirname: str = "cache"
+) -> list[Path]:
+    tmp_dir = Path(directory) / tmp_dirname
+    if not tmp_dir.exists():
+        return []
+
+    # download_files.json などは対象にしない
+    return [
+        path
+        for path in tmp_dir.glob("*.json")
+        if QUERY_HASH_PATTERN.fullmatch(path.stem)
+    ]
+
+
+# 期限切れの検索結果を消し、合計が max_bytes を超えていれば最後に使ったのが古いものから消す
+def gc_search_caches(
+    store: PostStore | None,
+    directories: list[str | Path],
+    ttl: float | None,
+    max_bytes: int | None,
+    tmp_dirname: str = "cache",
+) -> CacheGcResult:
+    now = time.time()
+    size = 0
+
+    # (最後に使った時刻, 保存した時刻, 消す関数)
+    entries: list[tuple[float, float, Callable[[], int]]] = []
+
+    if store is not None:
+        size += store.size()
+        for entry in store.queries():
+            entries.append(
+                (entry.accessed_at, entry.updated_at, partial(store.remove, entry.id))
+            )
+
+    for directory in dict.fromkeys(str(directory) for directory in directories):
+        for path in _legacy_search_cache_files(directory, tmp_dirname):
+            stat = path.stat()
+            size += stat.st_size
+            entries.append((stat.st_atime, stat.st_mtime, partial(_remove_file, path)))
+
+    entries.sort(key=lambda entry: entry[0])
+
+    removed = 0
+    freed = 0
+    for accessed_at, updated_at, remove in entries:
+        expired = ttl is not None and now - updated_at >= ttl
+        over = max_bytes is not None and size - freed > max_bytes
+        if not expired and not over:
+            continue
+
+        freed += remove()
+        removed += 1
+
+    if store is not None and removed > 0:
+        store.vacuum()
+
+    return CacheGcResult(removed, freed, size - freed)
+
+
+# 設定ファイルの出力先すべてと、共有のストアを対象にする
+def gc_config_caches(config: ScrapeConfig, cache_config: CacheConfig) -> CacheGcResult:
+    return gc_search_caches(
+        post_store.get_store(),
+        [subset.output_path for subset in config.subsets],
+        cache_config.search_result_ttl,
+        cache_config.search_result_max_bytes,
+    )
@@ -108,3 +108,192 @@ class DanbooruPost(BaseModel):
     pixiv_id: int | None = None
     parent_id: int | None = None
     approver_id: int | None = None
+
+
+class VariantSummary:
+    __slots__ = ("type", "url", "width", "height", "file_ext")
+
+    type: VariantTypeEnum
+    url: str
+    width: int
+    height: int
+    file_ext: FileEXT
+
+    def __init__(
+        self,
+        type: VariantTypeEnum | str,
+        url: str,
+        width: int,
+        height: int,
+        file_ext: FileEXT | str,
+    ) -> None:
+        self.type = VariantTypeEnum(type)
+        self.url = url
+        self.width = width
+        self.height = height
+        self.file_ext = FileEXT(file_ext)
+
+    def dict(self) -> dict:
+        return {
+            "type": self.type.value,
+            "url": self.url,
+            "width": self.width,
+            "height": self.height,
+            "file_ext": self.file_ext.value,
+        }
+
+
+# DanbooruPost のうち、タグ付けとダウンロードで使うフィールドだけを持つ
+class PostSummary:
+    __slots__ = (
+        "id",
+        "md5",
+        "file_url",
+        "large_file_url",
+        "file_ext",
+        "file_size",
+        "rating",
+        "score",
+        "created_at",
+        "variants",
+    )
+
+    id: int
+    md5: str | None
+    file_url: str | None
+    large_file_url: str | None
+    file_ext: FileEXT
+    file_size: int
+    rating: Rating
+    score: int
+    created_at: str | None
+    variants: tuple[VariantSummary, ...]
+
+    def __init__(
+        self,
+        id: int,
+        file_ext: FileEXT | str,
+        file_size: int,
+        rating: Rating | str,
+        score: int,
+        md5: str | None = None,
+        file_url: str | None = None,
+        large_file_url: str | None = None,
+        created_at: str | None = None,
+        variants: tuple[VariantSummary, ...] = (),
+    ) -> None:
+        self.id = id
+        self.md5 = md5
+        self.file_url = file_url
+        self.large_file_url = large_file_url
+        self.file_ext = FileEXT(file_ext)
+        self.file_size = file_size
+        self.rating = Rating(rating)
+        self.score = score
+        self.created_at = created_at
+        self.variants = variants
+
+    @staticmethod
+    def from_post(post: DanbooruPost):
+        return PostSummary(
+            id=post.id,
+            md5=post.md5,
+            file_url=post.file_url,
+            large_file_url=post.large_file_url,
+            file_ext=post.file_ext,
+            file_size=post.file_size,
+            rating=post.rating,
+            score=post.score,
+            created_at=post.created_at,
+            variants=tuple(
+                VariantSummary(
+                    variant.type,
+                    variant.url,
+                    variant.width,
+                    variant.height,
+                    variant.file_ext,
+                )
+                for variant in post.media_asset.variants
+            ),
+        )
+
+    # 以前のキャッシュ (DanbooruPost をそのまま保存したもの) も読めるようにする
+    @staticmethod
+    def from_dict(data: dict):
+        if "variants" in data:
+            variants = data["variants"]
+        else:
+            variants = (data.get("media_asset") or {}).get("variants", [])
+
+        return PostSummary(
+            id=data["id"],
+            md5=data.get("md5"),
+            file_url=data.get("file_url"),
+            large_file_url=data.get("large_file_url"),
+            file_ext=data["file_ext"],
+            file_size=data["file_size"],
+            rating=data["rating"],
+            score=data["score"],
+            created_at=data.get("created_at"),
+            variants=tuple(VariantSummary(**variant) for variant in variants),
+        )
+
+    @staticmethod
+    def parse(value: "PostSummary | DanbooruPost | LazyPost | dict"):
+        if isinstance(value, PostSummary):
+            return value
+        if isinstance(value, DanbooruPost):
+            return PostSummary.from_post(value)
+        if isinstance(value, LazyPost):
+            return PostSummary.from_dict(value.data)
+        return PostSummary.from_dict(value)
+
+    def dict(self) -> dict:
+        return {
+            "id": self.id,
+            "md5": self.md5,
+            "file_url": self.file_url,
+            "large_file_url": self.large_file_url,
+            "file_ext": self.file_ext.value,
+            "file_size": self.file_size,
+            "rating": self.rating.value,
+            "score": self.score,
+            "created_at": self.created_at,
+            "variants": [variant.dict() for variant in self.variants],
+        }
+
+
+# JSON のまま持ち、参照されたフィールドだけ変換する (検証は validate でまとめて行う)
+class LazyPost:
+    __slots__ = ("data",)
+
+    data: dict
+
+    def __init__(self, data: dict) -> None:
+        self.data = data
+
+    def __getattr__(self, name: str):
+        try:
+            return self.data[name]
+        except KeyError:
+            pass
+
+        field = DanbooruPost.__fields__.get(name)
+        if field is not None and not field.required:
+            return field.default
+        raise AttributeError(name)
+
+    @property
+    def rating(self) -> Rating:
+        return Rating(self.data["rating"])
+
+    @property
+    def file_ext(self) -> FileEXT:
+        return FileEXT(self.data["file_ext"])
+
+    @property
+    def media_asset(self) -> MediaAsset:
+        return MediaAsset(**self.data["media_asset"])
+
+    def validate(self) -> DanbooruPost:
+        return DanbooruPost(**self.data)
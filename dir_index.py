@@ -0,0 +1,50 @@
+from pathlib import Path
+import os
+import threading
+
+
+# 出力先のディレクトリごとに一度だけ os.scandir して、あるファイルの名前を覚えておく
+# (ネットワークファイルシステムではファイルごとに stat すると遅い)
+class DirectoryIndex:
+    def __init__(self) -> None:
+        self._names: dict[str, set[str]] = {}
+        self._created: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _load(self, directory: str) -> set[str]:
+        directory = os.path.normpath(directory)
+        names = self._names.get(directory)
+        if names is not None:
+            return names
+
+        with self._lock:
+            names = self._names.get(directory)
+            if names is None:
+                try:
+                    with os.scandir(directory) as entries:
+                        names = set(entry.name for entry in entries)
+                except FileNotFoundError:
+                    names = set()
+                self._names[directory] = names
+            return names
+
+    def exists(self, path: str | Path) -> bool:
+        directory, name = os.path.split(path)
+        return name in self._load(directory)
+
+    # 書き込んだファイルを登録する (まだ読んでいないディレクトリなら、読むときに見つかる)
+    def add(self, path: str | Path) -> None:
+        directory, name = os.path.split(path)
+        names = self._names.get(os.path.normpath(directory))
+        if names is not None:
+            names.add(name)
+
+    def ensure_dir(self, directory: str | Path) -> None:
+        directory = os.path.normpath(directory)
+        if directory in self._created:
+            return
+
+        with self._lock:
+            if directory not in self._created:
+                os.makedirs(directory, exist_ok=True)
+                self._created.add(directory)
@@ -0,0 +1,103 @@
+from pathlib import Path
+from hashlib import sha256
+import json
+import os
+import threading
+import time
+
+
+class CachedResponse:
+    url: str
+    body: str
+    etag: str | None
+    last_modified: str | None
+    fetched_at: float
+
+    def __init__(
+        self,
+        url: str,
+        body: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        fetched_at: float | None = None,
+    ) -> None:
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+
+    # 条件付きリクエストのヘッダー
+    def validators(self) -> dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+# posts.json などのレスポンスをページ単位で保存する
+class ResponseCache:
+    directory: Path
+    max_age: float | None
+
+    def __init__(self, directory: str | Path, max_age: float | None = None) -> None:
+        self.directory = Path(directory)
+        self.max_age = max_age
+
+    def _path(self, key: str) -> Path:
+        digest = sha256(key.encode("utf-8")).hexdigest()
+        return self.directory / digest[:2] / f"{digest}.json"
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        if self.max_age is None:
+            return True
+        return time.time() - entry.fetched_at < self.max_age
+
+    def load(self, key: str) -> CachedResponse | None:
+        path = self._path(key)
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return CachedResponse(**json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            return None
+
+    def save(self, key: str, entry: CachedResponse) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # 書き込み途中のファイルを読まないように、一時ファイルからリネームする
+        tmp_path = path.with_name(
+            f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "url": entry.url,
+                    "body": entry.body,
+                    "etag": entry.etag,
+                    "last_modified": entry.last_modified,
+                    "fetched_at": entry.fetched_at,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
+
+    # 304 が返ってきたときは取得時刻だけ更新する
+    def refresh(self, key: str, entry: CachedResponse) -> None:
+        entry.fetched_at = time.time()
+        self.save(key, entry)
+
+
+_cache: ResponseCache | None = None
+
+
+def configure(directory: str | Path | None, max_age: float | None = None) -> None:
+    global _cache
+    _cache = ResponseCache(directory, max_age) if directory is not None else None
+
+
+def get_cache() -> ResponseCache | None:
+    return _cache
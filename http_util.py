@@ -0,0 +1,159 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib import parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import rate_limit
+
+# リトライ対象のステータスコード
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if value is None:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    # HTTP-date 形式
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int,
+    backoff_factor: float,
+    max_backoff: float,
+    retry_after: str | None = None,
+) -> float:
+    # Retry-After があればそちらを優先する
+    retry_after_seconds = parse_retry_after(retry_after)
+    if retry_after_seconds is not None:
+        return min(retry_after_seconds, max_backoff)
+
+    return min(backoff_factor * (2**attempt), max_backoff)
+
+
+class HttpClient:
+    pool_size: int
+    max_retries: int
+    backoff_factor: float
+    max_backoff: float
+    timeout: float | None
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        max_retries: int = 5,
+        backoff_factor: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float | None = 60.0,
+    ) -> None:
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        # スレッドごとに keep-alive なセッションを持つ
+        self._local = threading.local()
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=0,  # リトライはこちらで制御する
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._new_session()
+            self._local.session = session
+        return session
+
+    def backoff(self, attempt: int, response: requests.Response | None = None) -> float:
+        return backoff_delay(
+            attempt,
+            self.backoff_factor,
+            self.max_backoff,
+            response.headers.get("Retry-After") if response is not None else None,
+        )
+
+    def get(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+        stream: bool = False,
+    ) -> requests.Response:
+        attempt = 0
+
+        limiter = rate_limit.get_limiter(parse.urlparse(url).netloc)
+
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+
+            try:
+                response = self.session.get(
+                    url, headers=headers, stream=stream, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+
+            if limiter is not None:
+                limiter.on_response(response.status_code)
+
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt >= self.max_retries
+            ):
+                return response
+
+            wait = self.backoff(attempt, response)
+            response.close()
+            time.sleep(wait)
+            attempt += 1
+
+
+_client = HttpClient()
+
+
+def configure(
+    pool_size: int,
+    max_retries: int = 5,
+    backoff_factor: float = 1.0,
+    max_backoff: float = 60.0,
+    timeout: float | None = 60.0,
+) -> HttpClient:
+    global _client
+    _client = HttpClient(
+        pool_size=pool_size,
+        max_retries=max_retries,
+        backoff_factor=backoff_factor,
+        max_backoff=max_backoff,
+        timeout=timeout,
+    )
+    return _client
+
+
+def get(
+    url: str, headers: dict[str, str] | None = None, stream: bool = False
+) -> requests.Response:
+    return _client.get(url, headers=headers, stream=stream)
@@ -0,0 +1,210 @@
+from pathlib import Path
+import json
+import os
+import sqlite3
+import threading
+
+# まとめて書き込む件数
+FLUSH_INTERVAL = 256
+
+# PostListSubset の取得結果を記録するキーの接頭辞 (後ろにファイルパス)
+POST_LIST_JOURNAL_KEY = "post_list:"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    key TEXT PRIMARY KEY,
+    next_page TEXT,
+    done INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS search_items (
+    key TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (key, position)
+);
+CREATE TABLE IF NOT EXISTS completed (
+    kind TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    post_id INTEGER NOT NULL,
+    PRIMARY KEY (kind, output_path, post_id)
+);
+"""
+
+
+class SearchState:
+    items: list[dict]
+    next_page: int | str | None
+    done: bool
+
+    def __init__(
+        self, items: list[dict], next_page: int | str | None, done: bool
+    ) -> None:
+        self.items = items
+        self.next_page = next_page
+        self.done = done
+
+
+def _encode_page(page: int | str | None) -> str | None:
+    return None if page is None else str(page)
+
+
+def _decode_page(page: str | None) -> int | str | None:
+    if page is None:
+        return None
+    return int(page) if page.isdigit() else page
+
+
+# 検索の進み具合と、保存済みのファイルを記録する (save_state_path)
+class ScrapeJournal:
+    path: Path
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+        self._lock = threading.Lock()
+        self._item_counts: dict[str, int] = {}
+        self._completed: dict[tuple[str, str], set[int]] = {}
+        self._pending: list[tuple[str, str, int]] = []
+
+    def load_search(self, key: str) -> SearchState | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT next_page, done FROM searches WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            items = [
+                json.loads(item)
+                for (item,) in self._conn.execute(
+                    "SELECT item FROM search_items WHERE key = ? ORDER BY position",
+                    (key,),
+                )
+            ]
+            self._item_counts[key] = len(items)
+
+        return SearchState(items, _decode_page(row[0]), bool(row[1]))
+
+    # 1 ページ分の結果と、次に取得するページを記録する (None なら最後まで取得済み)
+    def record_page(
+        self, key: str, items: list[dict], next_page: int | str | None
+    ) -> None:
+        with self._lock:
+            if key not in self._item_counts:
+                (count,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM search_items WHERE key = ?", (key,)
+                ).fetchone()
+                self._item_counts[key] = count
+
+            offset = self._item_counts[key]
+
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO search_items (key, position, item) VALUES (?, ?, ?)",
+                    [
+                        (key, offset + i, json.dumps(item))
+                        for i, item in enumerate(items)
+                    ],
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO searches (key, next_page, done) VALUES (?, ?, ?)",
+                    (key, _encode_page(next_page), int(next_page is None)),
+                )
+
+            self._item_counts[key] = offset + len(items)
+
+    def save_search(self, key: str, items: list[dict]) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM search_items WHERE key = ?", (key,))
+            self._item_counts[key] = 0
+
+        self.record_page(key, items, None)
+
+    # 実行が最後まで終わったら、次の実行では検索し直すように途中経過を消す
+    def clear_searches(self) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM search_items")
+                self._conn.execute("DELETE FROM searches")
+            self._item_counts.clear()
+
+    def _load_completed(self, kind: str, output_path: str) -> set[int]:
+        completed = self._completed.get((kind, output_path))
+        if completed is None:
+            completed = set(
+                post_id
+                for (post_id,) in self._conn.execute(
+                    "SELECT post_id FROM completed WHERE kind = ? AND output_path = ?",
+                    (kind, output_path),
+                )
+            )
+            self._completed[(kind, output_path)] = completed
+        return completed
+
+    # kind は image や caption など
+    def is_completed(self, kind: str, output_path: str, post_id: int) -> bool:
+        with self._lock:
+            return post_id in self._load_completed(kind, output_path)
+
+    def mark_completed(self, kind: str, output_path: str, post_id: int) -> None:
+        with self._lock:
+            self._load_completed(kind, output_path).add(post_id)
+            self._pending.append((kind, output_path, post_id))
+
+            if len(self._pending) >= FLUSH_INTERVAL:
+                self._flush()
+
+    def _flush(self) -> None:
+        if len(self._pending) == 0:
+            return
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO completed (kind, output_path, post_id) VALUES (?, ?, ?)",
+                self._pending,
+            )
+        self._pending = []
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._conn.close()
+
+
+_journals: dict[str, ScrapeJournal] = {}
+_journals_lock = threading.Lock()
+
+
+# 同じパスを指定したサブセット同士では同じジャーナルを使う
+def open_journal(path: str | Path | None) -> ScrapeJournal | None:
+    if path is None:
+        return None
+
+    key = os.path.abspath(path)
+
+    with _journals_lock:
+        journal = _journals.get(key)
+        if journal is None:
+            journal = ScrapeJournal(path)
+            _journals[key] = journal
+        return journal
+
+
+def close_journals(clear_searches: bool = False) -> None:
+    with _journals_lock:
+        for journal in _journals.values():
+            if clear_searches:
+                journal.clear_searches()
+            journal.close()
+        _journals.clear()
@@ -0,0 +1,306 @@
+from pathlib import Path
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from query import SearchKey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    score INTEGER NOT NULL,
+    rating TEXT NOT NULL,
+    created_at TEXT,
+    item BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_score ON posts (score);
+CREATE INDEX IF NOT EXISTS posts_rating ON posts (rating);
+CREATE INDEX IF NOT EXISTS posts_created_at ON posts (created_at);
+CREATE TABLE IF NOT EXISTS queries (
+    id INTEGER PRIMARY KEY,
+    domain TEXT NOT NULL,
+    query TEXT NOT NULL,
+    filter TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    UNIQUE (domain, query, filter)
+);
+CREATE INDEX IF NOT EXISTS queries_accessed_at ON queries (accessed_at);
+CREATE TABLE IF NOT EXISTS query_posts (
+    query_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    post_id INTEGER NOT NULL,
+    PRIMARY KEY (query_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS query_posts_post_id ON query_posts (post_id);
+"""
+
+
+QUERY_COLUMNS = "id, domain, query, filter, count, updated_at, accessed_at"
+
+# 投稿の JSON の先頭 1 バイトで形式を表す
+ITEM_FORMAT_ZLIB = b"\x01"
+
+# 1 件ずつ圧縮すると小さくならないので、どの投稿にも出てくるキーや URL を辞書にする
+# (変えると保存済みのものが読めなくなる)
+ITEM_ZDICT = json.dumps(
+    {
+        "post": {
+            "id": 0,
+            "md5": "",
+            "file_url": "https://cdn.donmai.us/original/",
+            "large_file_url": "https://cdn.donmai.us/sample/",
+            "file_ext": "jpg",
+            "file_size": 0,
+            "rating": "g",
+            "score": 0,
+            "created_at": "2024-01-01T00:00:00.000+09:00",
+            "variants": [
+                {
+                    "type": type,
+                    "url": f"https://cdn.donmai.us/{type}/",
+                    "width": 0,
+                    "height": 0,
+                    "file_ext": "webp",
+                }
+                for type in ["180x180", "360x360", "720x720", "sample", "original"]
+            ],
+        },
+        "artist_tags": [],
+        "character_tags": [],
+        "copyright_tags": [],
+        "general_tags": ["1girl", "solo"],
+        "meta_tags": ["highres"],
+        "quality_tags": [],
+        "rating_tags": [],
+        "download_file": None,
+    }
+).encode("utf-8")
+
+
+def encode_item(item: dict) -> bytes:
+    compressor = zlib.compressobj(zdict=ITEM_ZDICT)
+    data = json.dumps(item).encode("utf-8")
+    return ITEM_FORMAT_ZLIB + compressor.compress(data) + compressor.flush()
+
+
+def decode_item(item: bytes) -> str:
+    if item[:1] != ITEM_FORMAT_ZLIB:
+        raise Exception(f"Error: Unknown item format: {item[:1]!r}")
+
+    return zlib.decompressobj(zdict=ITEM_ZDICT).decompress(item[1:]).decode("utf-8")
+
+
+class QueryEntry:
+    id: int
+    key: SearchKey
+    count: int
+    updated_at: float
+    accessed_at: float
+
+    def __init__(
+        self,
+        id: int,
+        domain: str,
+        query: str,
+        filter: str,
+        count: int,
+        updated_at: float,
+        accessed_at: float,
+    ) -> None:
+        self.id = id
+        self.key = SearchKey(domain, query, filter)
+        self.count = count
+        self.updated_at = updated_at
+        self.accessed_at = accessed_at
+
+
+# 検索結果の投稿を id ごとに一度だけ保存し、クエリごとには id の並びだけを持つ
+class PostStore:
+    path: Path
+    ttl: float | None
+
+    def __init__(self, path: str | Path, ttl: float | None = None) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+        self._lock = threading.Lock()
+
+    def get_query(self, key: SearchKey) -> QueryEntry | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {QUERY_COLUMNS} FROM queries"
+                " WHERE domain = ? AND query = ? AND filter = ?",
+                (key.domain, key.query, key.filter),
+            ).fetchone()
+        return QueryEntry(*row) if row is not None else None
+
+    def queries(self) -> list[QueryEntry]:
+        with self._lock:
+            return [
+                QueryEntry(*row)
+                for row in self._conn.execute(
+                    f"SELECT {QUERY_COLUMNS} FROM queries ORDER BY accessed_at"
+                )
+            ]
+
+    def is_expired(self, entry: QueryEntry, now: float | None = None) -> bool:
+        if self.ttl is None:
+            return False
+        return (now if now is not None else time.time()) - entry.updated_at >= self.ttl
+
+    # limit を指定すると先頭からその件数だけ読む
+    def load(self, key: SearchKey, limit: int | None = None) -> list[dict] | None:
+        entry = self.get_query(key)
+        if entry is None or self.is_expired(entry):
+            return None
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE queries SET accessed_at = ? WHERE id = ?",
+                (time.time(), entry.id),
+            )
+            rows = self._conn.execute(
+                """
+                SELECT posts.item FROM query_posts
+                JOIN posts ON posts.id = query_posts.post_id
+                WHERE query_posts.query_id = ?
+                ORDER BY query_posts.position
+                LIMIT ?
+                """,
+                (entry.id, limit if limit is not None else -1),
+            ).fetchall()
+
+        # 1 件ずつ読むより、配列としてまとめて読むほうが速い
+        return json.loads("[" + ",".join(decode_item(item) for (item,) in rows) + "]")
+
+    # replace_prefix を指定すると、保存済みの先頭からその件数だけを items で置き換え、残りは後ろに残す
+    def save(
+        self, key: SearchKey, items: list[dict], replace_prefix: int | None = None
+    ) -> None:
+        posts = [item["post"] for item in items]
+        now = time.time()
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO posts (id, score, rating, created_at, item) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        post["id"],
+                        post["score"],
+                        post["rating"],
+                        post.get("created_at"),
+                        encode_item(item),
+                    )
+                    for post, item in zip(posts, items)
+                ],
+            )
+
+            post_ids = [post["id"] for post in posts]
+
+            if replace_prefix is not None:
+                ids = set(post_ids)
+                post_ids += [
+                    post_id
+                    for (post_id,) in self._conn.execute(
+                        """
+                        SELECT post_id FROM query_posts
+                        JOIN queries ON queries.id = query_posts.query_id
+                        WHERE queries.domain = ? AND queries.query = ?
+                        AND queries.filter = ?
+                        ORDER BY query_posts.position
+                        LIMIT -1 OFFSET ?
+                        """,
+                        (key.domain, key.query, key.filter, replace_prefix),
+                    )
+                    if post_id not in ids
+                ]
+
+            self._conn.execute(
+                """
+                INSERT INTO queries (domain, query, filter, count, updated_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (domain, query, filter) DO UPDATE SET
+                    count = excluded.count,
+                    updated_at = excluded.updated_at,
+                    accessed_at = excluded.accessed_at
+                """,
+                (key.domain, key.query, key.filter, len(post_ids), now, now),
+            )
+            (query_id,) = self._conn.execute(
+                "SELECT id FROM queries WHERE domain = ? AND query = ? AND filter = ?",
+                (key.domain, key.query, key.filter),
+            ).fetchone()
+
+            self._conn.execute(
+                "DELETE FROM query_posts WHERE query_id = ?", (query_id,)
+            )
+            self._conn.executemany(
+                "INSERT INTO query_posts (query_id, position, post_id) VALUES (?, ?, ?)",
+                [(query_id, i, post_id) for i, post_id in enumerate(post_ids)],
+            )
+
+    # 保存している投稿の合計バイト数 (圧縮後)
+    def size(self) -> int:
+        with self._lock:
+            (size,) = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(item)), 0) FROM posts"
+            ).fetchone()
+        return size
+
+    # クエリを消し、どのクエリからも参照されなくなった投稿も消す。消したバイト数を返す
+    def remove(self, query_id: int) -> int:
+        with self._lock, self._conn:
+            orphans = """
+                SELECT DISTINCT post_id FROM query_posts AS removed
+                WHERE removed.query_id = :query_id AND NOT EXISTS (
+                    SELECT 1 FROM query_posts
+                    WHERE query_posts.post_id = removed.post_id
+                    AND query_posts.query_id != :query_id
+                )
+            """
+            params = {"query_id": query_id}
+
+            (freed,) = self._conn.execute(
+                f"SELECT COALESCE(SUM(LENGTH(item)), 0) FROM posts WHERE id IN ({orphans})",
+                params,
+            ).fetchone()
+            self._conn.execute(f"DELETE FROM posts WHERE id IN ({orphans})", params)
+            self._conn.execute(
+                "DELETE FROM query_posts WHERE query_id = ?", (query_id,)
+            )
+            self._conn.execute("DELETE FROM queries WHERE id = ?", (query_id,))
+
+        return freed
+
+    # 消した分だけファイルを小さくする
+    def vacuum(self) -> None:
+        with self._lock:
+            self._conn.execute("VACUUM")
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_store: PostStore | None = None
+
+
+def configure(path: str | Path | None, ttl: float | None = None) -> None:
+    global _store
+    if _store is not None:
+        _store.close()
+    _store = PostStore(path, ttl) if path is not None else None
+
+
+def get_store() -> PostStore | None:
+    return _store
@@ -2,15 +2,21 @@ from __future__ import annotations
 
 
 from typing import Literal, get_args
+import math
 
 from scrape_config import (
+    AuthConfig,
     SearchFilterConfig,
+    SearchResultFilterConfig,
     SortOrderConfig,
     SEARCH_RATING_TAG_ALL,
     SEARCH_RATING_ALIAS,
+    ACCOUNT_LEVEL,
 )
 from tags import FILETYPE
-
+from tag_lists import load_tag_set, resolve_tags
+from tag_filter import compile_result_filter
+from default_tags import KAOMOJI_TAGS_FILE
 
 DAY_UNIT = Literal["years", "months", "weeks", "days", "hours", "minutes", "seconds"]
 
@@ -195,3 +201,231 @@ def compose_query(
         )
 
     return " ".join(query)
+
+
+# アカウントのレベルごとに検索できるタグ数 (None は未ログイン)
+TAG_LIMITS: dict[ACCOUNT_LEVEL | None, int] = {
+    None: 2,
+    "member": 2,
+    "gold": 6,
+    "platinum": 12,
+}
+
+# タグ数に数えられないメタタグ
+FREE_METATAGS = ("order", "rating", "limit", "status")
+
+
+def get_tag_limit(auth: AuthConfig | None) -> int:
+    return TAG_LIMITS[auth.level if auth is not None else None]
+
+
+def count_query_tags(query: str) -> int:
+    count = 0
+    for term in query.split():
+        name, sep, _ = term.partition(":")
+        if sep != "" and name in FREE_METATAGS:
+            continue
+        count += 1
+    return count
+
+
+# 新しい順以外の並べ替えをするメタタグ
+ORDER_METATAGS = ("order", "ordfav", "ordpool", "ordfavgroup")
+
+
+# 新しい投稿から順に並ぶクエリで、id のメタタグをもうひとつ足せるか
+def can_refresh(query: str, tag_limit: int) -> bool:
+    for term in query.split():
+        name, sep, value = term.partition(":")
+        if sep != "" and name in ORDER_METATAGS and term != "order:id_desc":
+            return False
+    return count_query_tags(query) < tag_limit
+
+
+# キャッシュの最大 id より新しい投稿だけを検索する
+def since_id_query(query: str, since_id: int) -> str:
+    return f"{query} id:>{since_id}"
+
+
+# 指定した投稿のうち、まだクエリに一致するものだけを検索する
+def post_ids_query(query: str, post_ids: list[int]) -> str:
+    return f"{query} id:{','.join(str(post_id) for post_id in post_ids)}"
+
+
+# 取得後の判定と同じ結果になるタグだけを検索用の表記にする
+def to_query_tag(tag: str, kaomoji_tags: frozenset[str]) -> str | None:
+    if tag in kaomoji_tags:
+        return tag
+    if tag.strip() == "" or "_" in tag:
+        return None  # 取得後の判定では一致しない
+    if tag[0] in "-~" or any(c in tag for c in ":*"):
+        return None  # メタタグやワイルドカードとして解釈される
+    return tag.replace(" ", "_")
+
+
+class QueryPlan:
+    base_query: str
+    query: str
+    result_filter: SearchResultFilterConfig
+    pushed: list[str]
+    # 検索クエリに移す前のフィルターのハッシュ
+    filter_key: str
+
+    def __init__(
+        self,
+        base_query: str,
+        query: str,
+        result_filter: SearchResultFilterConfig,
+        pushed: list[str],
+        filter_key: str | None = None,
+    ) -> None:
+        self.base_query = base_query
+        self.query = query
+        self.result_filter = result_filter
+        self.pushed = pushed
+        self.filter_key = (
+            filter_key
+            if filter_key is not None
+            else compile_result_filter(result_filter).digest()
+        )
+
+
+# 検索結果のキャッシュやジャーナルのキー (同じクエリでもドメインやフィルターが違えば別の結果)
+class SearchKey:
+    domain: str
+    query: str
+    filter: str
+
+    def __init__(self, domain: str, query: str, filter: str) -> None:
+        self.domain = domain
+        self.query = query
+        self.filter = filter
+
+    def __str__(self) -> str:
+        return f"{self.domain} {self.filter} {self.query}"
+
+
+def search_key(domain: str, plan: QueryPlan) -> SearchKey:
+    return SearchKey(domain, plan.base_query, plan.filter_key)
+
+
+def _unique(tags: list[str]) -> list[str]:
+    return list(dict.fromkeys(tags))
+
+
+# タグ数の上限に収まるだけ SearchResultFilterConfig を検索クエリに移す
+def push_down_result_filter(
+    query: str, result_filter: SearchResultFilterConfig, tag_limit: int
+) -> QueryPlan:
+    filter_key = compile_result_filter(result_filter).digest()
+
+    if not result_filter.push_down:
+        return QueryPlan(query, query, result_filter, [], filter_key)
+
+    kaomoji_tags = load_tag_set(KAOMOJI_TAGS_FILE)
+    budget = tag_limit - count_query_tags(query)
+    pushed: list[str] = []
+
+    def push(terms: list[str]) -> bool:
+        nonlocal budget
+        if len(terms) > budget:
+            return False
+        pushed.extend(terms)
+        budget -= len(terms)
+        return True
+
+    include_all = []
+    for tag in _unique(resolve_tags(result_filter.include_all)):
+        query_tag = to_query_tag(tag, kaomoji_tags)
+        if query_tag is None or not push([query_tag]):
+            include_all.append(tag)
+
+    # 一部だけ ~tag にすると結果が変わるので、すべて入る場合だけ
+    include_any = _unique(resolve_tags(result_filter.include_any))
+    query_tags = [to_query_tag(tag, kaomoji_tags) for tag in include_any]
+    if len(include_any) > 0 and None not in query_tags:
+        if len(query_tags) == 1:
+            terms = query_tags
+        else:
+            terms = [f"~{query_tag}" for query_tag in query_tags]
+        if push(terms):
+            include_any = []
+
+    # 複数のタグをすべて含むものの除外はクエリで表せない
+    exclude_all = _unique(resolve_tags(result_filter.exclude_all))
+    if len(exclude_all) == 1:
+        query_tag = to_query_tag(exclude_all[0], kaomoji_tags)
+        if query_tag is not None and push([f"-{query_tag}"]):
+            exclude_all = []
+
+    exclude_any = []
+    for tag in _unique(resolve_tags(result_filter.exclude_any)):
+        query_tag = to_query_tag(tag, kaomoji_tags)
+        if query_tag is None or not push([f"-{query_tag}"]):
+            exclude_any.append(tag)
+
+    if len(pushed) == 0:
+        return QueryPlan(query, query, result_filter, [], filter_key)
+
+    return QueryPlan(
+        query,
+        " ".join([query, *pushed]),
+        SearchResultFilterConfig(
+            include_any=include_any,
+            include_all=include_all,
+            exclude_any=exclude_any,
+            exclude_all=exclude_all,
+            push_down=False,
+        ),
+        pushed,
+        filter_key,
+    )
+
+
+def plan_query(
+    base_query: str,
+    filter: bool | SearchFilterConfig | None,
+    fallback_filter: SearchFilterConfig,
+    result_filter: SearchResultFilterConfig | None,
+    fallback_result_filter: SearchResultFilterConfig,
+    auth: AuthConfig | None,
+    reserved_tags: int = 0,
+) -> QueryPlan:
+    # reserved_tags はあとから足すメタタグ (キャッシュの更新の id:) のために空けておく
+    return push_down_result_filter(
+        compose_query(base_query, filter, fallback_filter),
+        result_filter if result_filter is not None else fallback_result_filter,
+        get_tag_limit(auth) - reserved_tags,
+    )
+
+
+# 取得後の判定だけで total_limit 件を集める場合と比べて、減ったページ数の見積もり
+def estimate_saved_pages(
+    base_count: int, planned_count: int, total_limit: int, limit_per_page: int
+) -> int:
+    if base_count == 0:
+        return 0
+
+    if planned_count == 0:
+        scanned = base_count
+    else:
+        scanned = min(base_count, total_limit * base_count / planned_count)
+
+    pages_without = math.ceil(scanned / limit_per_page)
+    pages_with = math.ceil(min(planned_count, total_limit) / limit_per_page)
+
+    return max(pages_without - pages_with, 0)
+
+
+def describe_query_plan(
+    plan: QueryPlan,
+    base_count: int,
+    planned_count: int,
+    total_limit: int,
+    limit_per_page: int,
+) -> str:
+    saved = estimate_saved_pages(base_count, planned_count, total_limit, limit_per_page)
+    return (
+        f"Pushed down {len(plan.pushed)} filter tags, {base_count} -> {planned_count} posts"
+        f" (~{saved} pages saved, Query: {plan.query})"
+    )
@@ -0,0 +1,114 @@
+import asyncio
+import threading
+import time
+
+from scrape_config import RateLimitConfig
+
+# この応答が返ってきたら速度を落とす
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+
+# トークンバケット + AIMD (429/503 で乗算的に減速、成功で加算的に回復)
+class AdaptiveRateLimiter:
+    max_rate: float
+    rate: float
+    burst: int
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int = 1,
+        min_rate: float = 0.1,
+        decrease_factor: float = 0.5,
+        increase_step: float = 0.1,
+        cooldown: float = 1.0,
+    ) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.min_rate = min(min_rate, rate)
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.cooldown = cooldown
+
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._decreased_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    # トークンを予約して、使えるようになるまでの秒数を返す
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_response(self, status_code: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if status_code in THROTTLE_STATUS_CODES:
+                # 同時に返ってきた 429 でまとめて下がりすぎないようにする
+                if now - self._decreased_at < self.cooldown:
+                    return
+                self._decreased_at = now
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._tokens = min(self._tokens, 0.0)
+            elif status_code < 400:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+
+_config: RateLimitConfig | None = None
+_limiters: dict[str, AdaptiveRateLimiter] = {}
+_lock = threading.Lock()
+
+
+def configure(config: RateLimitConfig | None) -> None:
+    global _config
+    with _lock:
+        _config = config
+        _limiters.clear()
+
+
+# ホストごとにプロセス全体で共有する
+def get_limiter(host: str) -> AdaptiveRateLimiter | None:
+    if _config is None:
+        return None
+
+    with _lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            host_config = _config.hosts.get(host, _config)
+            if host_config.requests_per_second is None:
+                return None
+
+            limiter = AdaptiveRateLimiter(
+                host_config.requests_per_second,
+                burst=host_config.burst,
+                min_rate=_config.min_requests_per_second,
+                decrease_factor=_config.decrease_factor,
+                increase_step=_config.increase_step,
+            )
+            _limiters[host] = limiter
+
+        return limiter
@@ -1,16 +1,26 @@
 import argparse
+import asyncio
 
 from tqdm import tqdm
-import numpy as np
-
-from concurrent.futures import ThreadPoolExecutor
 
 from tags import do_all_caption_post_process
-from query import compose_query
+from query import (
+    QueryPlan,
+    describe_query_plan,
+    get_tag_limit,
+    plan_query,
+    search_key,
+)
 import utils
+import http_util
+import http_cache
+import post_store
+import rate_limit
 import scrape_util
+from dir_index import DirectoryIndex
 from scrape_util import (
     DanbooruScraper,
+    DanbooruPostItem,
     ScrapeResultCache,
 )
 from scrape_config import (
@@ -21,8 +31,114 @@ from scrape_config import (
     PostListSubset,
     CaptionConfig,
     CacheConfig,
+    RateLimitConfig,
+)
+from journal import open_journal, close_journals
+from cache_util import (
+    load_search_cache,
+    save_search_cache,
+    plan_search_cache_refresh,
+    apply_search_cache_refresh,
+    prepare_download_files,
+    get_cache_config,
+    gc_config_caches,
+    get_reserved_tags,
 )
-from cache_util import load_search_cache, save_search_cache
+
+
+# 検索クエリに移したフィルターと、減ったページ数の見積もりを表示する
+def report_query_plan(
+    scraper: DanbooruScraper, plan: QueryPlan, total_limit: int
+) -> None:
+    if len(plan.pushed) == 0:
+        return
+
+    # 1 ページで足りるなら、見積もりのために件数を数えない
+    if total_limit <= scrape_util.MAX_POSTS_PER_PAGE:
+        print(f"Pushed down {len(plan.pushed)} filter tags (Query: {plan.query})")
+        return
+
+    try:
+        base_count = scraper.count_posts(plan.base_query)
+        planned_count = scraper.count_posts(plan.query)
+    except Exception as e:
+        print(f"Pushed down {len(plan.pushed)} filter tags (Query: {plan.query}): {e}")
+        return
+
+    print(
+        describe_query_plan(
+            plan,
+            base_count,
+            planned_count,
+            total_limit,
+            scrape_util.MAX_POSTS_PER_PAGE,
+        )
+    )
+
+
+# キャッシュより新しい投稿だけを検索して足す (できないクエリなら None)
+def refresh_search_cache(
+    scraper: DanbooruScraper,
+    plan: QueryPlan,
+    posts: list[DanbooruPostItem],
+    config: ScrapeConfig,
+    cache_config: CacheConfig,
+    subset: QuerySubset | QueryListSubset,
+) -> list[DanbooruPostItem] | None:
+    refresh = plan_search_cache_refresh(
+        plan, posts, cache_config.recheck_recent, get_tag_limit(config.auth)
+    )
+    if refresh is None:
+        print(f"Cannot refresh the cache incrementally (Query: {plan.query})")
+        return None
+
+    def search(query: str, limit: int) -> list[DanbooruPostItem]:
+        return scrape_util.get_posts(
+            scraper,
+            query,
+            plan.result_filter,
+            config.search_result_filter,
+            total_limit=limit,
+            limit_per_page=200,
+            pagination=config.pagination,
+            prefetch=0,
+        )
+
+    new_posts = search(refresh.since_query, subset.limit)
+    rechecked = [
+        item
+        for query, limit in refresh.recheck_queries
+        for item in search(query, limit)
+    ]
+
+    return apply_search_cache_refresh(
+        refresh,
+        subset.output_path,
+        search_key(scraper.domain, plan),
+        posts,
+        new_posts,
+        rechecked,
+        subset.limit,
+    )
+
+
+# 実行の最後に、期限切れや上限を超えた検索結果のキャッシュを消す
+def close_caches(config: ScrapeConfig, cache_config: CacheConfig | None) -> None:
+    # 最後まで終わったので、次の実行では検索し直す (保存済みのファイルの記録は残す)
+    close_journals(clear_searches=True)
+
+    if cache_config is not None and (
+        cache_config.search_result_ttl is not None
+        or cache_config.search_result_max_bytes is not None
+    ):
+        result = gc_config_caches(config, cache_config)
+        if result.removed > 0:
+            print(
+                f"Removed {result.removed} cached searches"
+                f" ({result.freed / 2**20:.1f} MiB freed, {result.size / 2**20:.1f} MiB left)"
+            )
+
+    post_store.configure(None)
 
 
 def main(config: ScrapeConfig):
@@ -33,80 +149,162 @@ def main(config: ScrapeConfig):
         if config.caption:
             config.caption = CaptionConfig()
 
+    http_util.configure(
+        config.http.pool_size or config.max_workers,
+        max_retries=config.http.max_retries,
+        backoff_factor=config.http.backoff_factor,
+        max_backoff=config.http.max_backoff,
+        timeout=config.http.timeout,
+    )
+    rate_limit.configure(
+        config.rate_limit
+        if isinstance(config.rate_limit, RateLimitConfig)
+        else RateLimitConfig() if config.rate_limit == True else None
+    )
+
     print("Starting scrape...")
 
     # このキャッシュは後ろのキャッシュとは別
-    cache_config = (
-        config.cache
-        if isinstance(config.cache, CacheConfig)
-        else CacheConfig()
-        if config.cache == True
-        else None
+    cache_config = get_cache_config(config)
+
+    http_cache.configure(
+        (
+            cache_config.response_path
+            if cache_config is not None and cache_config.response
+            else None
+        ),
+        cache_config.response_max_age if cache_config is not None else None,
+    )
+    post_store.configure(
+        (
+            cache_config.search_result_path
+            if cache_config is not None and cache_config.search_result
+            else None
+        ),
+        cache_config.search_result_ttl if cache_config is not None else None,
     )
 
+    if config.engine == "async":
+        # aiohttp は async エンジンを使うときだけ必要
+        import async_scrape
+
+        asyncio.run(async_scrape.main(config, cache_config))
+        close_caches(config, cache_config)
+
+        print("Done")
+        return
+
     caches: list[ScrapeResultCache] = []
 
     for subset in config.subsets:
         if isinstance(subset, QuerySubset):
             print("Loading query...")
-            scraper = DanbooruScraper(subset.domain or config.domain, config.auth)
+            scraper = DanbooruScraper(
+                subset.domain or config.domain, config.auth, config.lazy_posts
+            )
 
-            query = compose_query(
-                subset.query, subset.search_filter, config.search_filter
+            plan = plan_query(
+                subset.query,
+                subset.search_filter,
+                config.search_filter,
+                subset.search_result_filter,
+                config.search_result_filter,
+                config.auth,
+                get_reserved_tags(cache_config),
             )
+            query = plan.query
+            key = search_key(scraper.domain, plan)
             print("Query: " + query)
 
             # キャッシュから
-            posts = load_search_cache(subset.output_path, query)
+            posts = load_search_cache(subset.output_path, key, limit=subset.limit)
+
+            if posts is not None and cache_config is not None and cache_config.refresh:
+                posts = refresh_search_cache(
+                    scraper, plan, posts, config, cache_config, subset
+                )
 
             if posts is not None:
                 posts = posts[: subset.limit]
                 print(f"Found {len(posts)} posts in cache")
             else:
+                report_query_plan(scraper, plan, subset.limit)
+
                 posts = scrape_util.get_posts(
                     scraper,
                     query,
-                    subset.search_result_filter,
+                    plan.result_filter,
                     config.search_result_filter,
                     total_limit=subset.limit,
                     limit_per_page=200,
+                    pagination=config.pagination,
+                    prefetch=config.prefetch_pages,
+                    journal=open_journal(subset.save_state_path),
+                    journal_key=str(key),
                 )
                 print(f"Found {len(posts)} posts")
 
                 if cache_config is not None and cache_config.search_result:
-                    save_search_cache(subset.output_path, query, posts)
+                    save_search_cache(subset.output_path, key, posts)
 
             caches.append(ScrapeResultCache(posts, subset))
         elif isinstance(subset, QueryListSubset):
             print("Loading query list...")
-            scraper = DanbooruScraper(subset.domain or config.domain, config.auth)
+            scraper = DanbooruScraper(
+                subset.domain or config.domain, config.auth, config.lazy_posts
+            )
             queries = utils.load_file_lines(subset.query_list_file)
 
             for query in queries:
-                query = compose_query(query, subset.search_filter, config.search_filter)
+                plan = plan_query(
+                    query,
+                    subset.search_filter,
+                    config.search_filter,
+                    subset.search_result_filter,
+                    config.search_result_filter,
+                    config.auth,
+                    get_reserved_tags(cache_config),
+                )
+                query = plan.query
+                key = search_key(scraper.domain, plan)
 
                 print("Query: " + query)
 
                 # キャッシュから
-                posts = load_search_cache(subset.output_path, query)
+                posts = load_search_cache(subset.output_path, key, limit=subset.limit)
+
+                if (
+                    posts is not None
+                    and cache_config is not None
+                    and cache_config.refresh
+                ):
+                    posts = refresh_search_cache(
+                        scraper, plan, posts, config, cache_config, subset
+                    )
 
                 if posts is not None:
                     posts = posts[: subset.limit]
                     print(f"Found {len(posts)} posts in cache")
                 else:
+                    report_query_plan(scraper, plan, subset.limit)
+
                     posts = scrape_util.get_posts(
                         scraper,
                         query,
-                        subset.search_result_filter,
+                        plan.result_filter,
                         config.search_result_filter,
                         total_limit=subset.limit,
                         limit_per_page=200,
+                        pagination=config.pagination,
+                        prefetch=config.prefetch_pages,
+                        journal=open_journal(subset.save_state_path),
+                        journal_key=str(key),
                     )
 
                     print(f"Found {len(posts)} posts")
 
                     if cache_config is not None and cache_config.search_result:
-                        save_search_cache(subset.output_path, query, posts)
+                        save_search_cache(subset.output_path, key, posts)
 
                 caches.append(ScrapeResultCache(posts, subset))
         elif isinstance(subset, PostListSubset):
@@ -115,13 +313,12 @@ def main(config: ScrapeConfig):
 
             print(f"Found {len(post_urls)} posts")
 
-            posts = []
-
-            for url in post_urls:
-                domain, post_id = scrape_util.get_domain_and_post_id_from_url(url)
-                scraper = DanbooruScraper(domain, config.auth)
-
-                posts.append(scraper.get_post(post_id))
+            posts = scrape_util.load_post_list_state(subset)
+            if posts is None:
+                posts = scrape_util.resolve_post_urls(
+                    post_urls, config.auth, config.max_workers
+                )
+                scrape_util.save_post_list_state(subset, posts)
 
             caches.append(ScrapeResultCache(posts, subset))
         else:
@@ -136,25 +333,45 @@ def main(config: ScrapeConfig):
             # fallback
             item = do_all_caption_post_process(item, config.caption)
 
+    # 出力先のディレクトリは一度だけ読んで、ファイルごとの stat を避ける
+    index = DirectoryIndex()
+
     for cache in caches:
-        chunks = np.array_split(cache.items, config.max_workers)
-
-        print(f"Downloading {len(cache.items)} images...")
-
-        with tqdm(total=len(cache.items)) as pbar:
-            with ThreadPoolExecutor(max_workers=config.max_workers) as executor:
-                futures = []
-                for chunk in chunks:
-                    executor.submit(
-                        scrape_util.save_from_cache,
-                        chunk,
-                        [cache] * len(chunk),
-                        config,
-                        pbar,
-                    )
+        prepare_download_files(cache, config.download)
+
+        print(f"Writing {len(cache.items)} captions...")
+        scrape_util.save_post_captions(
+            cache.items, [cache] * len(cache.items), config.caption, index
+        )
+
+    # 複数のサブセットに含まれる投稿は一度だけダウンロードして、残りはリンクする
+    items = [item for cache in caches for item in cache.items]
+    tasks = scrape_util.plan_download_tasks(
+        items, [cache for cache in caches for _ in cache.items]
+    )
+
+    remaining = scrape_util.drop_completed_tasks(tasks, index)
+    if len(remaining) < len(tasks):
+        print(f"Skipping {len(tasks) - len(remaining)} files already saved")
+    tasks = remaining
+
+    total = sum(len(task.targets) for task in tasks)
+
+    print(f"Downloading {total} images ({len(tasks)} unique files)...")
+
+    with tqdm(total=total) as pbar:
+        failures = scrape_util.download_post_tasks(
+            tasks,
+            config.auth,
+            pbar,
+            config.download,
+            index,
+            max_workers=config.max_workers,
+        )
+
+    scrape_util.report_download_failures(failures)
 
-                for future in futures:
-                    future.result()
+    close_caches(config, cache_config)
 
     print("Done")
 
@@ -6,7 +6,7 @@ import json
 import toml
 from base64 import b64encode
 
-import utils
+from tag_lists import load_tag_lines
 from default_tags import (
     SENSITIVE_TAGS_FILE,
     NSFW_PREFIX_FILE,
@@ -30,16 +30,25 @@ SEARCH_RATING_TAG_ALL = SEARCH_RATING_TAG | SEARCH_RATING_ALIAS
 
 CATEGORY_ORDER_STYLE = Literal["wd", "naidv3", "animaginexlv3"]
 
+# async は aiohttp を使う
+SCRAPE_ENGINE = Literal["thread", "async"]
+
+# auto: 上限ページを超えそうなら b<id / a<id 形式に切り替える
+PAGINATION_MODE = Literal["auto", "page", "cursor"]
+
 FILETYPE = Literal["jpg", "png", "gif", "webm", "mp4", "swf", "zip", "webp", "avif"]
 
+# 検索できるタグ数がアカウントのレベルで変わる
+ACCOUNT_LEVEL = Literal["member", "gold", "platinum"]
+
 
 # レーティング (nsfwなど) タグ設定
 class RatingTagConfig(BaseModel):
     type: RATING_TAG_ACTION = "by_tag"  # 推奨
 
     # by_tag (事前に設定したタグが含まれる場合のみ nsfw判定。投稿のレーティングは無視される)
-    nsfw_tags: str | list[str] = utils.load_file_lines(SENSITIVE_TAGS_FILE)
-    insert_tags: str | list[str] = utils.load_file_lines(NSFW_PREFIX_FILE)
+    nsfw_tags: str | list[str] = load_tag_lines(SENSITIVE_TAGS_FILE)
+    insert_tags: str | list[str] = load_tag_lines(NSFW_PREFIX_FILE)
 
     # こちらが指定されたらこっちを優先
     nsfw_tag_file_path: str | None = None
@@ -99,7 +108,7 @@ class CaptionConfig(BaseModel):
     general: bool | CaptionPostProcessConfig = True
     meta: bool | CaptionPostProcessConfig = CaptionPostProcessConfig(
         keeps=[
-            KeepConfig(tags=utils.load_file_lines(ALLOWED_META_TAGS_FILE)),
+            KeepConfig(tags=load_tag_lines(ALLOWED_META_TAGS_FILE)),
         ]
     )
 
@@ -179,11 +188,14 @@ class SearchResultFilterConfig(BaseModel):
     # 上から順に適用される
     include_any: str | list[str] = []  # どれかを含んでいなければならない
     include_all: str | list[str] = []  # すべてを含んでいなければならない
-    exclude_any: str | list[str] = utils.load_file_lines(
+    exclude_any: str | list[str] = load_tag_lines(
         EXCLUSION_TAGS_FILE
     )  # ひとつでも含んではいけない
     exclude_all: str | list[str] = []  # すべて含んでいるのはだめ
 
+    # タグ数の上限に収まる分は検索クエリ (-tag, ~tag) に含め、残りだけを取得後に判定する
+    push_down: bool = True
+
     # TODO: parent や children などの判定もする
 
 
@@ -263,12 +275,12 @@ class QueryListSubset(ScrapeSubset):
 # danbooru の post の url リストから取得する
 class PostListSubset(ScrapeSubset):
     post_url_list_file: str
-    # FIXME: 実装する
 
 
 class AuthConfig(BaseModel):
     username: str
     api_key: str
+    level: ACCOUNT_LEVEL = "member"
 
     def basic_auth(self) -> str:
         return b64encode(f"{self.username}:{self.api_key}".encode("utf-8")).decode(
@@ -278,6 +290,86 @@ class AuthConfig(BaseModel):
 
 class CacheConfig(BaseModel):
     search_result: bool = True
+    # 検索結果は投稿 id ごとにひとつの SQLite にまとめて保存する
+    search_result_path: str = "./cache/posts.sqlite"
+    # 秒。これより前に保存した検索結果は使わない (None なら期限なし)
+    search_result_ttl: float | None = None
+    # 検索結果のキャッシュ全体の上限。超えたら最後に使ったのが古いものから消す
+    search_result_max_bytes: int | None = None
+    # キャッシュがあっても、それより新しい投稿だけを検索して足す
+    refresh: bool = False
+    # refresh のとき、新しい順にこの件数の投稿のスコアやタグを取得し直す
+    recheck_recent: int = 0
+
+    # 検索結果のページ (posts.json) のレスポンスをそのまま保存する
+    response: bool = False
+    response_path: str = "./cache/responses"
+    # 秒。これより古いものは ETag / Last-Modified で再検証する (None なら期限なし)
+    response_max_age: float | None = 60 * 60 * 24
+
+
+# original: 常に元画像
+# smallest: min_side / min_pixels を満たす最小のバリアント (sample, 720x720 など)
+DOWNLOAD_VARIANT = Literal["original", "smallest"]
+
+
+# 画像のダウンロード設定
+class DownloadConfig(BaseModel):
+    variant: DOWNLOAD_VARIANT = "original"
+    min_side: int | None = None  # 短辺
+    min_pixels: int | None = None  # 幅 x 高さ
+
+    # md5 とファイルサイズを検証し、一致しなければダウンロードし直す
+    verify: bool = True
+    max_attempts: int = 3
+
+    # 指定すると、ファイルは <store_path>/ab/cd/<md5>.<ext> に一度だけ保存し、出力先にはリンクを作る
+    store_path: str | None = None
+
+    # 目標が無いと一番小さいサムネイルを選んでしまう
+    @root_validator
+    def check_variant_target(cls, values):
+        if (
+            values.get("variant") == "smallest"
+            and values.get("min_side") is None
+            and values.get("min_pixels") is None
+        ):
+            raise ValueError("variant: smallest requires min_side or min_pixels")
+        return values
+
+
+# ホストごとのリクエスト数の上限
+class HostRateLimitConfig(BaseModel):
+    requests_per_second: float | None = None  # None なら制限しない
+    burst: int = 1
+
+
+# リクエスト数の制限 (検索・投稿取得・ダウンロードで共有)
+class RateLimitConfig(HostRateLimitConfig):
+    requests_per_second: float | None = 10.0
+    burst: int = 10
+
+    # ホスト (danbooru.donmai.us, cdn.donmai.us など) ごとに上書きする
+    hosts: dict[str, HostRateLimitConfig] = {}
+
+    # 429/503 が返ってきたら decrease_factor 倍にして、成功するたびに increase_step ずつ戻す
+    min_requests_per_second: float = 0.5
+    decrease_factor: float = 0.5
+    increase_step: float = 0.1
+
+
+# HTTP 通信の設定
+class HttpConfig(BaseModel):
+    # None なら max_workers と同じ
+    pool_size: int | None = None
+
+    max_retries: int = 5
+    backoff_factor: float = 1.0  # 秒。リトライごとに倍になる
+    max_backoff: float = 60.0
+    timeout: float | None = 60.0
+
+    # async エンジンでのホストごとの同時接続数。None なら max_workers と同じ
+    limit_per_host: int | None = None
 
 
 # 全体の設定
@@ -295,8 +387,22 @@ class ScrapeConfig(BaseModel):
 
     max_workers: int = 10
 
+    # async の場合、max_workers は同時に処理するタスク数になる
+    engine: SCRAPE_ENGINE = "thread"
+
+    # 検索結果を検証せずに読み込み、フィルターを通った投稿だけ検証する
+    lazy_posts: bool = False
+
+    pagination: PAGINATION_MODE = "auto"
+    # 検索結果のフィルタリング中に先読みしておくページ数
+    prefetch_pages: int = 2
+
     cache: bool | CacheConfig = False
 
+    http: HttpConfig = HttpConfig()
+    rate_limit: bool | RateLimitConfig = False
+    download: DownloadConfig = DownloadConfig()
+
     @root_validator(pre=True)
     def set_default_values(cls, values):
         if "caption" not in values or values["caption"] is None:
@@ -1,34 +1,54 @@
 from pathlib import Path
-import requests
+from typing import Callable, Iterable
 from urllib import parse
+import hashlib
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+from itertools import chain
 import json
 
+import requests
 from tqdm import tqdm
 from pydantic import BaseModel
 
-import utils
-from danbooru_post import DanbooruPost
+from tag_lists import load_tag_set
+import http_util
+import http_cache
+from http_cache import CachedResponse
+from danbooru_post import DanbooruPost, LazyPost, PostSummary, FileEXT, VariantTypeEnum
 from scrape_config import (
     AVAIABLE_DOMAINS,
-    ScrapeConfig,
     ScrapeSubset,
     CaptionConfig,
+    DownloadConfig,
     SearchResultFilterConfig,
     AuthConfig,
     CATEGORY_ORDER_STYLE,
+    PAGINATION_MODE,
+    PostListSubset,
 )
 
+from journal import POST_LIST_JOURNAL_KEY, ScrapeJournal, open_journal
+from tag_filter import CompiledResultFilter, compile_result_filter
+from tag_vocab import VOCAB
+from dir_index import DirectoryIndex
 from default_tags import KAOMOJI_TAGS_FILE, PERSON_TAGS_FILE
 
-KAOMOJI_TAGS = utils.load_file_lines(KAOMOJI_TAGS_FILE)
-PERSON_TAGS = utils.load_file_lines(PERSON_TAGS_FILE)
+# 1 リクエストで取得できる投稿数の上限
+MAX_POSTS_PER_PAGE = 200
 
 
 # _ ありの空白区切りから _ なしの配列にする
 def parse_general_tags(tag_text: str) -> list[str]:
+    kaomoji_tags = load_tag_set(KAOMOJI_TAGS_FILE)
     tags = tag_text.split(" ")
     for i, tag in enumerate(tags):
-        if not tag in KAOMOJI_TAGS:
+        if not tag in kaomoji_tags:
             tags[i] = tag.replace("_", " ")
     return tags
 
@@ -42,10 +62,11 @@ def parse_other_tags(tag_text: str) -> list[str]:
 
 # 人物タグとそうじゃないタグに分離する
 def separate_person_tags(tags: list[str]):
+    person_tag_set = load_tag_set(PERSON_TAGS_FILE)
     person_tags = []
     not_person_tags = []
     for tag in tags:
-        if tag in PERSON_TAGS:
+        if tag in person_tag_set:
             person_tags.append(tag)
         else:
             not_person_tags.append(tag)
@@ -60,9 +81,11 @@ class DanbooruScraper:
         self,
         domain: AVAIABLE_DOMAINS = "danbooru.donmai.us",
         auth: AuthConfig | None = None,
+        lazy_posts: bool = False,
     ) -> None:
         self.domain = domain
         self.auth = auth
+        self.lazy_posts = lazy_posts
 
     def _get_headers(self) -> dict[str, str]:
         headers = {"User-Agent": "Danbooru Scraper"}
@@ -70,17 +93,55 @@ class DanbooruScraper:
             headers["Authorization"] = f"Basic {self.auth.basic_auth()}"
         return headers
 
-    def get_posts(
-        self, query: str, page: int = 1, limit_per_page: int = 20
-    ) -> list[DanbooruPost]:
-        url = f"https://{self.domain}/posts.json?tags={parse.quote(query)}&page={page}&limit={limit_per_page}"
+    # 見える投稿はユーザーによって変わるのでユーザー名もキーに含める
+    def _cache_key(self, url: str) -> str:
+        return f"{self.auth.username}@{url}" if self.auth is not None else url
+
+    # レスポンスキャッシュが有効なら、キャッシュを使うか条件付きで取得する
+    def _get_cached(self, url: str) -> str:
         headers = self._get_headers()
 
-        response = requests.get(url, headers=headers)
+        cache = http_cache.get_cache()
+        entry = cache.load(self._cache_key(url)) if cache is not None else None
+
+        if entry is not None:
+            if cache.is_fresh(entry):
+                return entry.body
+            headers.update(entry.validators())
+
+        response = http_util.get(url, headers=headers)
+
+        if response.status_code == 304 and entry is not None:
+            cache.refresh(self._cache_key(url), entry)
+            return entry.body
         if response.status_code != 200:
             raise Exception("Error: " + str(response.status_code) + " " + response.text)
 
-        posts = [DanbooruPost(**post) for post in json.loads(response.text)]
+        if cache is not None:
+            cache.save(
+                self._cache_key(url),
+                CachedResponse(
+                    url,
+                    response.text,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                ),
+            )
+
+        return response.text
+
+    # page は番号のほか b<id (その id より前) / a<id (その id より後) も指定できる
+    def get_posts(
+        self, query: str, page: int | str = 1, limit_per_page: int = 20
+    ) -> list[DanbooruPost | LazyPost]:
+        url = f"https://{self.domain}/posts.json?tags={parse.quote(query)}&page={page}&limit={limit_per_page}"
+
+        data = json.loads(self._get_cached(url))
+
+        if self.lazy_posts:
+            return [LazyPost(post) for post in data]
+
+        posts = [DanbooruPost(**post) for post in data]
 
         return posts
 
@@ -88,7 +149,7 @@ class DanbooruScraper:
         url = f"https://{self.domain}/posts/{post_id}.json"
         headers = self._get_headers()
 
-        response = requests.get(url, headers=headers)
+        response = http_util.get(url, headers=headers)
         if response.status_code != 200:
             raise Exception("Error: " + str(response.status_code) + " " + response.text)
 
@@ -96,113 +157,208 @@ class DanbooruScraper:
 
         return post
 
+    # id:1,2,3... でまとめて取得する (順序は保証されない)
+    def get_posts_by_ids(self, post_ids: list[int]) -> list[DanbooruPost]:
+        if len(post_ids) > MAX_POSTS_PER_PAGE:
+            raise Exception(f"Too many post ids: {len(post_ids)}")
 
-class DanbooruPostItem(BaseModel):
-    post: DanbooruPost
+        query = f"id:{','.join(str(post_id) for post_id in post_ids)} status:any"
 
-    artist_tags: list[str] = []
-    character_tags: list[str] = []
-    copyright_tags: list[str] = []
-    general_tags: list[str] = []
-    meta_tags: list[str] = []
+        return self.get_posts(query, 1, len(post_ids))
 
-    quality_tags: list[str] = []
+    def count_posts(self, query: str) -> int:
+        url = f"https://{self.domain}/counts/posts.json?tags={parse.quote(query)}"
 
-    rating_tags: list[str] = []
+        return json.loads(self._get_cached(url))["counts"]["posts"]
 
-    @staticmethod
-    def new(post: DanbooruPost):
-        return DanbooruPostItem(
-            post=post,
-            artist_tags=parse_other_tags(post.tag_string_artist),
-            character_tags=parse_other_tags(post.tag_string_character),
-            copyright_tags=parse_other_tags(post.tag_string_copyright),
-            general_tags=parse_general_tags(post.tag_string_general),
-            meta_tags=parse_other_tags(post.tag_string_meta),
-        )
 
-    def _compose_tags_wd_style(
-        self,
-        category_separator: str = ", ",
-    ):
-        return category_separator.join(
-            [
-                category
-                for category in (
-                    ", ".join([tag for tag in tags if tag.strip() != ""])
-                    for tags in [
-                        self.rating_tags,
-                        self.quality_tags,
-                        self.artist_tags,
-                        self.character_tags,
-                        self.general_tags,
-                        self.meta_tags,
-                    ]
-                )
-                if category.strip() != ""
-            ]
-        )
+# 実際にダウンロードするファイル (元画像またはバリアント)
+class DownloadFile(BaseModel):
+    type: str  # original, sample, 720x720 など
+    url: str
+    file_ext: str
+
+    # 元画像のときだけ検証に使える
+    md5: str | None = None
+    file_size: int | None = None
+
+
+def _tag_ids_property(name: str) -> property:
+    def getter(self) -> list[str]:
+        return VOCAB.tags(getattr(self, name))
+
+    def setter(self, tags: Iterable[str]) -> None:
+        setattr(self, name, VOCAB.ids(tags))
+
+    return property(getter, setter)
 
-    def _compose_tags_nai_style(
-        self,
-        category_separator: str = ", ",
-    ):
-        person_tags, other_tags = separate_person_tags(self.general_tags)
-        return category_separator.join(
-            [
-                category
-                for category in (
-                    ", ".join([tag for tag in tags if tag.strip() != ""])
-                    for tags in [
-                        person_tags,
-                        self.artist_tags,
-                        self.character_tags,
-                        self.copyright_tags,
-                        other_tags,
-                        self.meta_tags,
-                        self.quality_tags,
-                        self.rating_tags,
-                    ]
-                )
-                if category.strip() != ""
-            ]
-        )
 
-    def _compose_tags_animaginexl_style(
+# タグはカテゴリごとに語彙の id の配列で持ち、参照したときに文字列に戻す
+class DanbooruPostItem:
+    __slots__ = (
+        "post",
+        "_artist_tags",
+        "_character_tags",
+        "_copyright_tags",
+        "_general_tags",
+        "_meta_tags",
+        "_quality_tags",
+        "_rating_tags",
+        "download_file",
+    )
+
+    post: PostSummary
+
+    artist_tags = _tag_ids_property("_artist_tags")
+    character_tags = _tag_ids_property("_character_tags")
+    copyright_tags = _tag_ids_property("_copyright_tags")
+    general_tags = _tag_ids_property("_general_tags")
+    meta_tags = _tag_ids_property("_meta_tags")
+
+    quality_tags = _tag_ids_property("_quality_tags")
+
+    rating_tags = _tag_ids_property("_rating_tags")
+
+    # None なら元画像
+    download_file: DownloadFile | None
+
+    def __init__(
         self,
-        category_separator: str = ", ",
-    ):
-        person_tags, other_tags = separate_person_tags(self.general_tags)
-        return category_separator.join(
-            [
-                category
-                for category in (
-                    ", ".join([tag for tag in tags if tag.strip() != ""])
-                    for tags in [
-                        person_tags,
-                        self.character_tags,
-                        self.copyright_tags,
-                        other_tags,
-                        self.meta_tags,
-                        self.quality_tags,
-                        self.rating_tags,
-                    ]
-                )
-                if category.strip() != ""
-            ]
+        post: PostSummary | DanbooruPost | dict,
+        artist_tags: Iterable[str] = (),
+        character_tags: Iterable[str] = (),
+        copyright_tags: Iterable[str] = (),
+        general_tags: Iterable[str] = (),
+        meta_tags: Iterable[str] = (),
+        quality_tags: Iterable[str] = (),
+        rating_tags: Iterable[str] = (),
+        download_file: DownloadFile | dict | None = None,
+    ) -> None:
+        self.post = PostSummary.parse(post)
+
+        self.artist_tags = artist_tags
+        self.character_tags = character_tags
+        self.copyright_tags = copyright_tags
+        self.general_tags = general_tags
+        self.meta_tags = meta_tags
+        self.quality_tags = quality_tags
+        self.rating_tags = rating_tags
+
+        if isinstance(download_file, dict):
+            download_file = DownloadFile(**download_file)
+        self.download_file = download_file
+
+    @staticmethod
+    def parse_tags(post: DanbooruPost | LazyPost) -> dict[str, list[str]]:
+        return {
+            "artist_tags": parse_other_tags(post.tag_string_artist),
+            "character_tags": parse_other_tags(post.tag_string_character),
+            "copyright_tags": parse_other_tags(post.tag_string_copyright),
+            "general_tags": parse_general_tags(post.tag_string_general),
+            "meta_tags": parse_other_tags(post.tag_string_meta),
+        }
+
+    @staticmethod
+    def new(post: DanbooruPost | LazyPost):
+        return DanbooruPostItem(
+            post=PostSummary.parse(post), **DanbooruPostItem.parse_tags(post)
         )
 
+    def dict(self) -> dict:
+        return {
+            "post": self.post.dict(),
+            "artist_tags": self.artist_tags,
+            "character_tags": self.character_tags,
+            "copyright_tags": self.copyright_tags,
+            "general_tags": self.general_tags,
+            "meta_tags": self.meta_tags,
+            "quality_tags": self.quality_tags,
+            "rating_tags": self.rating_tags,
+            "download_file": (
+                self.download_file.dict() if self.download_file is not None else None
+            ),
+        }
+
     def compose_tags(
         self,
         category_separator: str = ", ",
         category_order: CATEGORY_ORDER_STYLE | None = None,
     ) -> str:
-        if category_order is None or category_order == "wd":
-            return self._compose_tags_wd_style(category_separator)
-        elif category_order == "naidv3":
-            return self._compose_tags_nai_style(category_separator)
-        elif category_order == "animaginexlv3":
-            return self._compose_tags_animaginexl_style(category_separator)
+        return compose_captions([self], category_separator, category_order)[0]
+
+
+# キャプションに並べるカテゴリの順番 (person と other は general を人物タグとそれ以外に分けたもの)
+CATEGORY_ORDERS: dict[CATEGORY_ORDER_STYLE, tuple[str, ...]] = {
+    "wd": ("rating", "quality", "artist", "character", "general", "meta"),
+    "naidv3": (
+        "person",
+        "artist",
+        "character",
+        "copyright",
+        "other",
+        "meta",
+        "quality",
+        "rating",
+    ),
+    "animaginexlv3": (
+        "person",
+        "character",
+        "copyright",
+        "other",
+        "meta",
+        "quality",
+        "rating",
+    ),
+}
+
+_person_tag_ids: tuple[frozenset[str], frozenset[int]] | None = None
+
+
+def get_person_tag_ids() -> frozenset[int]:
+    global _person_tag_ids
+
+    person_tags = load_tag_set(PERSON_TAGS_FILE)
+    if _person_tag_ids is None or _person_tag_ids[0] is not person_tags:
+        _person_tag_ids = (person_tags, VOCAB.id_set(person_tags))
+    return _person_tag_ids[1]
+
+
+# タグは id のまま並べ替えて、最後に文字列にする
+def compose_captions(
+    items: list[DanbooruPostItem],
+    category_separator: str = ", ",
+    category_order: CATEGORY_ORDER_STYLE | None = None,
+) -> list[str]:
+    order = CATEGORY_ORDERS.get(category_order or "wd")
+    if order is None:
+        raise Exception(f"Invalid category order: {category_order}")
+
+    person_ids = get_person_tag_ids() if "person" in order else frozenset()
+    blank_ids = VOCAB.blank_ids
+    to_tags = VOCAB.tags
+
+    captions = []
+    for item in items:
+        general_ids = item._general_tags
+
+        parts = []
+        for category in order:
+            if category == "person":
+                ids = [tag_id for tag_id in general_ids if tag_id in person_ids]
+            elif category == "other":
+                ids = [tag_id for tag_id in general_ids if tag_id not in person_ids]
+            else:
+                ids = getattr(item, f"_{category}_tags")
+
+            if len(blank_ids) > 0:
+                ids = [tag_id for tag_id in ids if tag_id not in blank_ids]
+
+            if len(ids) > 0:
+                parts.append(", ".join(to_tags(ids)))
+
+        captions.append(category_separator.join(parts))
+
+    return captions
 
 
 class ScrapeResultCache:
@@ -219,6 +375,202 @@ class ScrapeResultCache:
         self.caption = subset.caption
 
 
+# 番号指定で辿れるページの上限 (これより先は b<id / a<id 形式でしか取得できない)
+NUMBERED_PAGE_LIMIT = 1000
+
+
+def get_query_order(query: str) -> str | None:
+    for term in query.split(" "):
+        if term.lower().startswith("order:"):
+            return term[len("order:") :].lower()
+    return None
+
+
+# id 順以外のソートではカーソル (b<id / a<id) が使えない
+def get_cursor_direction(query: str) -> str | None:
+    order = get_query_order(query)
+    if order is None or order in ("id_desc",):
+        return "b"
+    elif order in ("id", "id_asc"):
+        return "a"
+    return None
+
+
+# 次に取得するページを決める (同期版と非同期版で共有する)
+class PagePlanner:
+    direction: str | None
+    use_cursor: bool
+
+    def __init__(
+        self,
+        query: str,
+        total_limit: int = 100,
+        limit_per_page: int = 200,
+        pagination: PAGINATION_MODE = "auto",
+        page_limit: int = NUMBERED_PAGE_LIMIT,
+        depth: int = 1,
+        start_page: int | str = 1,
+    ) -> None:
+        self.direction = get_cursor_direction(query)
+
+        if pagination == "cursor" and self.direction is None:
+            raise Exception("Cursor pagination is not available for query: " + query)
+
+        self.pagination = pagination
+        self.page_limit = page_limit
+        self.depth = max(depth, 1)
+
+        self.use_cursor = (
+            pagination == "cursor"
+            or pagination == "auto"
+            and self.direction is not None
+            and total_limit > page_limit * limit_per_page
+        )
+
+        # 途中から再開する場合は start_page から始める
+        self.start_page = start_page
+        if isinstance(start_page, str):
+            self.use_cursor = True
+
+        self._next_numbered_page = page_limit + 1 if self.use_cursor else start_page
+
+    def _numbered_pages(self, in_flight: int) -> list[int | str]:
+        pages: list[int | str] = []
+        while (
+            self._next_numbered_page <= self.page_limit
+            and in_flight + len(pages) < self.depth
+        ):
+            pages.append(self._next_numbered_page)
+            self._next_numbered_page += 1
+        return pages
+
+    def start(self) -> list[int | str]:
+        if self.use_cursor:
+            return [self.start_page]
+        return self._numbered_pages(0)
+
+    # このページの次のページ (None ならこれで最後)
+    def resume_point(
+        self, page: int | str, page_posts: list[DanbooruPost]
+    ) -> int | str | None:
+        if self.use_cursor or isinstance(page, str):
+            return _next_cursor(page_posts, self.direction)
+        elif page < self.page_limit:
+            return page + 1
+        elif self.pagination == "auto" and self.direction is not None:
+            # ページ番号の上限に達したらカーソルに切り替える
+            return _next_cursor(page_posts, self.direction)
+        return None
+
+    # ページを受け取ったら、次に取得すべきページを返す
+    def advance(
+        self, page: int | str, page_posts: list[DanbooruPost], in_flight: int
+    ) -> list[int | str]:
+        if self.direction == "a" and isinstance(page, str):
+            # a<id 形式は id 降順で返ってくるので昇順に戻す
+            page_posts.sort(key=lambda post: post.id)
+
+        next_page = self.resume_point(page, page_posts)
+
+        if next_page is None:
+            return []
+        elif isinstance(next_page, str):
+            return [next_page]
+        return self._numbered_pages(in_flight)
+
+
+def iter_post_pages(
+    scraper: DanbooruScraper,
+    query: str,
+    total_limit: int = 100,
+    limit_per_page: int = 200,
+    pagination: PAGINATION_MODE = "auto",
+    page_limit: int = NUMBERED_PAGE_LIMIT,
+    prefetch: int = 0,
+    start_page: int | str = 1,
+):
+    planner = PagePlanner(
+        query,
+        total_limit,
+        limit_per_page,
+        pagination,
+        page_limit,
+        depth=prefetch,
+        start_page=start_page,
+    )
+
+    # 先読み用 (prefetch が 0 なら取り出すときに取得する)
+    executor = ThreadPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+    pending: deque[tuple[int | str, Future | None]] = deque()
+
+    def submit(page: int | str):
+        future = (
+            executor.submit(scraper.get_posts, query, page, limit_per_page)
+            if executor is not None
+            else None
+        )
+        pending.append((page, future))
+
+    for page in planner.start():
+        submit(page)
+
+    try:
+        while len(pending) > 0:
+            page, future = pending.popleft()
+            page_posts = (
+                future.result()
+                if future is not None
+                else scraper.get_posts(query, page, limit_per_page)
+            )
+
+            if len(page_posts) == 0:
+                break
+
+            # 呼び出し側がフィルタリングしている間に次のページを取得しておく
+            for next_page in planner.advance(page, page_posts, len(pending)):
+                submit(next_page)
+
+            # 再開するときのために次のページも返す
+            yield page_posts, planner.resume_point(page, page_posts)
+    finally:
+        # 必要数に達したら残りのリクエストは捨てる
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _next_cursor(page_posts: list[DanbooruPost], direction: str | None) -> str:
+    if direction == "b":
+        return f"b{min(post.id for post in page_posts)}"
+    elif direction == "a":
+        return f"a{max(post.id for post in page_posts)}"
+    raise Exception(f"Invalid cursor direction: {direction}")
+
+
+def filter_page_posts(
+    page_posts: list[DanbooruPost | LazyPost], result_filter: CompiledResultFilter
+) -> list[DanbooruPostItem]:
+    items = []
+    for post in page_posts:
+        if post.md5 is None:
+            continue
+
+        # 判定は文字列のまま行い、残ったものだけ変換する
+        tags = DanbooruPostItem.parse_tags(post)
+        if not result_filter.match_tags(set(chain.from_iterable(tags.values()))):
+            continue
+
+        # 遅延読み込みした投稿は、残ったものだけ検証して、検証したものから作る
+        if isinstance(post, LazyPost):
+            post = post.validate()
+
+        items.append(DanbooruPostItem(post=PostSummary.parse(post), **tags))
+
+    return items
+
+
 def get_posts(
     scraper: DanbooruScraper,
     query: str,
@@ -226,64 +578,98 @@ def get_posts(
     fallback_search_result_filter: SearchResultFilterConfig,
     total_limit: int = 100,
     limit_per_page: int = 200,
+    pagination: PAGINATION_MODE = "auto",
+    prefetch: int = 2,
+    journal: ScrapeJournal | None = None,
+    journal_key: str | None = None,
 ) -> list[DanbooruPostItem]:
     posts: list[DanbooruPostItem] = []
-    page = 1
-    limit_per_page = 200
+    start_page: int | str = 1
+
+    # ドメインやフィルターが違う検索の途中経過を使わないように、呼び出し側で区別したキー
+    if journal_key is None:
+        journal_key = query
 
-    result_filter = (
+    result_filter = compile_result_filter(
         search_result_filter
         if search_result_filter is not None
         else fallback_search_result_filter
     )
 
-    with tqdm(total=total_limit) as pbar:
-        while len(posts) < total_limit:
-            new_posts = [
-                DanbooruPostItem.new(post)
-                for post in scraper.get_posts(query, page, limit_per_page)
-                if post.md5 is not None
-            ]
+    # 中断したところから再開する
+    if journal is not None:
+        state = journal.load_search(journal_key)
+        if state is not None:
+            posts = [DanbooruPostItem(**item) for item in state.items]
+            if state.done or len(posts) >= total_limit:
+                return posts[:total_limit]
+            start_page = state.next_page
+            print(f"Resuming from page {start_page} ({len(posts)} posts)")
+
+    with tqdm(total=total_limit, initial=min(len(posts), total_limit)) as pbar, closing(
+        iter_post_pages(
+            scraper,
+            query,
+            total_limit,
+            limit_per_page,
+            pagination,
+            prefetch=prefetch,
+            start_page=start_page,
+        )
+    ) as pages:
+        for page_posts, next_page in pages:
+            new_posts = filter_page_posts(page_posts, result_filter)
 
-            if len(new_posts) == 0:
-                break
+            # OKなら追加
+            posts.extend(new_posts)
+            pbar.update(min(len(new_posts), max(total_limit - pbar.n, 0)))
 
-            for post in new_posts:
-                all_tags = [
-                    *post.artist_tags,
-                    *post.copyright_tags,
-                    *post.character_tags,
-                    *post.general_tags,
-                    *post.meta_tags,
-                ]
+            if journal is not None:
+                journal.record_page(
+                    journal_key, [post.dict() for post in new_posts], next_page
+                )
 
-                if result_filter.include_any != [] and all(
-                    tag not in result_filter.include_any for tag in all_tags
-                ):
-                    continue  # どれも入っていなかったら
-                if result_filter.include_all != [] and any(
-                    tag not in result_filter.include_all for tag in all_tags
-                ):
-                    continue  # ひとつでも入っていなかったら
-                if result_filter.exclude_any != [] and any(
-                    tag in result_filter.exclude_any for tag in all_tags
-                ):
-                    continue  # どれか入っていたら
-                if result_filter.exclude_all != [] and all(
-                    tag in result_filter.exclude_all for tag in all_tags
-                ):
-                    continue  # 全部入っていたら
-
-                # OKなら追加
-                posts.append(post)
-
-                pbar.update(1)
-
-            page += 1
+            if len(posts) >= total_limit:
+                break
+        else:
+            if journal is not None and len(posts) < total_limit:
+                # 最後まで取得した
+                journal.record_page(journal_key, [], None)
 
     return posts[:total_limit]
 
 
+# キャッシュより新しい投稿を先頭に足し、取得し直した投稿で置き換える
+def merge_refreshed_posts(
+    cached: list[DanbooruPostItem],
+    new_posts: list[DanbooruPostItem],
+    rechecked: list[DanbooruPostItem],
+    checked_ids: set[int],
+    total_limit: int,
+) -> list[DanbooruPostItem]:
+    updated = {item.post.id: item for item in rechecked}
+    seen: set[int] = set()
+    posts = []
+
+    # どちらも新しい順なので、つなげればそのまま新しい順になる
+    for item in chain(new_posts, cached):
+        post_id = item.post.id
+        if post_id in seen:
+            continue
+        seen.add(post_id)
+
+        if post_id in checked_ids:
+            item = updated.get(post_id)
+            if item is None:
+                continue  # もうクエリやフィルターに一致しない
+
+        posts.append(item)
+        if len(posts) >= total_limit:
+            break
+
+    return posts
+
+
 def get_domain_and_post_id_from_url(url: str) -> tuple[AVAIABLE_DOMAINS, int]:
     parsed = parse.urlparse(url)
     if parsed.scheme != "https":
@@ -298,100 +684,649 @@ def get_domain_and_post_id_from_url(url: str) -> tuple[AVAIABLE_DOMAINS, int]:
         raise Exception("Invalid url: " + url)
 
 
+# ジャーナルに記録した PostListSubset の取得結果 (記録が無ければ None)
+def load_post_list_state(subset: PostListSubset) -> list[DanbooruPostItem] | None:
+    journal = open_journal(subset.save_state_path)
+    if journal is None:
+        return None
+
+    state = journal.load_search(POST_LIST_JOURNAL_KEY + subset.post_url_list_file)
+    if state is None or not state.done:
+        return None
+
+    return [DanbooruPostItem(**item) for item in state.items]
+
+
+def save_post_list_state(subset: PostListSubset, posts: list[DanbooruPostItem]) -> None:
+    journal = open_journal(subset.save_state_path)
+    if journal is not None:
+        journal.save_search(
+            POST_LIST_JOURNAL_KEY + subset.post_url_list_file,
+            [post.dict() for post in posts],
+        )
+
+
+# URL のリストからドメインごとにまとめて投稿を取得する (結果は入力順)
+def resolve_post_urls(
+    post_urls: list[str],
+    auth: AuthConfig | None,
+    max_workers: int = 4,
+) -> list[DanbooruPostItem]:
+    targets = [get_domain_and_post_id_from_url(url) for url in post_urls]
+
+    # 重複を除いて順序を保つ
+    post_ids_by_domain: dict[AVAIABLE_DOMAINS, list[int]] = {
+        domain: list(dict.fromkeys(post_id for d, post_id in targets if d == domain))
+        for domain in dict.fromkeys(domain for domain, _ in targets)
+    }
+
+    scrapers = {domain: DanbooruScraper(domain, auth) for domain in post_ids_by_domain}
+    batches = [
+        (domain, post_ids[i : i + MAX_POSTS_PER_PAGE])
+        for domain, post_ids in post_ids_by_domain.items()
+        for i in range(0, len(post_ids), MAX_POSTS_PER_PAGE)
+    ]
+
+    def resolve(batch: tuple[AVAIABLE_DOMAINS, list[int]]):
+        domain, post_ids = batch
+        return domain, scrapers[domain].get_posts_by_ids(post_ids)
+
+    found: dict[tuple[AVAIABLE_DOMAINS, int], DanbooruPost] = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for domain, posts in tqdm(executor.map(resolve, batches), total=len(batches)):
+            for post in posts:
+                found[(domain, post.id)] = post
+
+    items: list[DanbooruPostItem] = []
+    for target in targets:
+        if target not in found:
+            print(f"Post not found! (skipped: ID {target[1]})")
+            continue
+        items.append(DanbooruPostItem.new(found[target]))
+
+    return items
+
+
+# 書き込み中のファイルにつける拡張子
+PARTIAL_SUFFIX = ".part"
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadVerificationError(Exception):
+    pass
+
+
+# ストリーミングしながら md5 とサイズを検証する
+class DownloadVerifier:
+    expected_md5: str | None
+    expected_size: int | None
+
+    def __init__(
+        self, expected_md5: str | None = None, expected_size: int | None = None
+    ) -> None:
+        self.expected_md5 = expected_md5
+        self.expected_size = expected_size
+        self.size = 0
+        self._md5 = hashlib.md5() if expected_md5 is not None else None
+
+    def update(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self._md5 is not None:
+            self._md5.update(chunk)
+
+        # サイズを超えたら途中で打ち切る
+        if self.expected_size is not None and self.size > self.expected_size:
+            raise DownloadVerificationError(
+                f"Too large: {self.size} > {self.expected_size}"
+            )
+
+    def verify(self) -> None:
+        if self.expected_size is not None and self.size != self.expected_size:
+            raise DownloadVerificationError(
+                f"Size mismatch: {self.size} != {self.expected_size}"
+            )
+        if self._md5 is not None and self._md5.hexdigest() != self.expected_md5:
+            raise DownloadVerificationError(
+                f"MD5 mismatch: {self._md5.hexdigest()} != {self.expected_md5}"
+            )
+
+
 def download_image(
     url: str,
     output_dir: str | Path,
     filename: str,
     extension: str,
     headers: dict[str, str],
+    md5: str | None = None,
+    file_size: int | None = None,
+    max_attempts: int = 3,
+    index: DirectoryIndex | None = None,
 ) -> None:
     output_path = Path(output_dir) / f"{filename}.{extension}"
 
-    if output_path.exists():
+    if index.exists(output_path) if index is not None else output_path.exists():
+        return
+
+    # 一時ファイルに書き込んで、検証できたらリネームする
+    partial_path = output_path.with_name(output_path.name + PARTIAL_SUFFIX)
+
+    for attempt in range(max_attempts):
+        response = http_util.get(url, headers=headers, stream=True)
+        if response.status_code != 200:
+            response.close()
+            raise Exception("Error: " + str(response.status_code))
+
+        verifier = DownloadVerifier(md5, file_size)
+
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    verifier.update(chunk)
+                    f.write(chunk)
+            verifier.verify()
+        except (DownloadVerificationError, requests.RequestException) as e:
+            print(f"Retrying download ({attempt + 1}/{max_attempts}): {url} ({e})")
+            continue
+        finally:
+            response.close()
+
+        os.replace(partial_path, output_path)
         return
 
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception("Error: " + str(response.status_code))
+    partial_path.unlink(missing_ok=True)
+    raise Exception(f"Failed to download {url} after {max_attempts} attempts")
+
 
-    with open(output_path, "wb") as f:
-        f.write(response.content)
+# バリアントを選べる元画像の形式 (動画などはサンプルが静止画になってしまう)
+VARIANT_SOURCE_FILE_EXTS = [FileEXT.JPG, FileEXT.PNG, FileEXT.WEBP, FileEXT.AVIF]
 
 
-def download_post_images(
+def get_original_file(post: PostSummary) -> DownloadFile | None:
+    if post.file_url is not None:
+        return DownloadFile(
+            type=VariantTypeEnum.ORIGINAL.value,
+            url=post.file_url,
+            file_ext=post.file_ext.value,
+            md5=post.md5,
+            file_size=post.file_size,
+        )
+    if post.large_file_url is not None:
+        return DownloadFile(
+            type=VariantTypeEnum.SAMPLE.value,
+            url=post.large_file_url,
+            file_ext=Path(parse.urlparse(post.large_file_url).path).suffix[1:],
+        )
+    return None
+
+
+def meets_download_target(width: int, height: int, config: DownloadConfig) -> bool:
+    if config.min_side is not None and min(width, height) < config.min_side:
+        return False
+    if config.min_pixels is not None and width * height < config.min_pixels:
+        return False
+    return True
+
+
+def select_download_file(
+    post: PostSummary, config: DownloadConfig
+) -> DownloadFile | None:
+    if config.variant == "original" or post.file_ext not in VARIANT_SOURCE_FILE_EXTS:
+        return get_original_file(post)
+
+    candidates = [
+        variant
+        for variant in post.variants
+        if meets_download_target(variant.width, variant.height, config)
+    ]
+
+    if len(candidates) == 0:
+        return get_original_file(post)
+
+    # 同じ大きさなら元画像を優先する
+    variant = min(
+        candidates,
+        key=lambda variant: (
+            variant.width * variant.height,
+            variant.type != VariantTypeEnum.ORIGINAL,
+        ),
+    )
+
+    if variant.type == VariantTypeEnum.ORIGINAL:
+        return get_original_file(post)
+
+    return DownloadFile(
+        type=variant.type.value, url=variant.url, file_ext=variant.file_ext.value
+    )
+
+
+# 記録済みの選択を優先して、各投稿のダウンロードするファイルを決める
+def assign_download_files(
     items: list[DanbooruPostItem],
-    caches: list[ScrapeResultCache],
-    auth: AuthConfig | None,
-    pbar,
-) -> None:
+    config: DownloadConfig,
+    recorded: dict[str, DownloadFile],
+) -> dict[str, DownloadFile]:
+    for item in items:
+        post_id = str(item.post.id)
+
+        if post_id not in recorded:
+            download_file = select_download_file(item.post, config)
+            if download_file is None:
+                continue
+            recorded[post_id] = download_file
+
+        item.download_file = recorded[post_id]
+
+    return recorded
+
+
+def get_download_headers(auth: AuthConfig | None) -> dict[str, str]:
+    return {
+        "User-Agent": "Danbooru Scraper",
+        "Authorization": f"Basic {auth.basic_auth()}" if auth is not None else "",
+    }
+
+
+# 同じファイルを保存する出力先をまとめたもの (ダウンロードは一度だけ)
+class DownloadTask:
+    download_file: DownloadFile | None
+    targets: list[tuple[DanbooruPostItem, ScrapeResultCache]]
+
+    def __init__(
+        self,
+        download_file: DownloadFile | None,
+        targets: list[tuple[DanbooruPostItem, ScrapeResultCache]] | None = None,
+    ) -> None:
+        self.download_file = download_file
+        self.targets = targets if targets is not None else []
+
+    # 保存済みとして記録されておらず、ファイルも無い出力先
+    def pending_targets(
+        self, index: DirectoryIndex | None = None
+    ) -> list[tuple[DanbooruPostItem, ScrapeResultCache]]:
+        pending = []
+        for item, cache in self.targets:
+            journal = open_journal(cache.save_state_path)
+            if journal is not None and journal.is_completed(
+                "image", cache.output_path, item.post.id
+            ):
+                continue
+            if (
+                index is not None
+                and self.download_file is not None
+                and index.exists(self.output_path(item, cache))
+            ):
+                continue
+            pending.append((item, cache))
+        return pending
+
+    def output_path(self, item: DanbooruPostItem, cache: ScrapeResultCache) -> Path:
+        return Path(cache.output_path) / f"{item.post.id}.{self.download_file.file_ext}"
+
+    # 投稿の md5 で決まるストアでのパス (バリアントは種類を後ろにつける)
+    def blob_path(self, store_path: str | Path) -> Path | None:
+        md5 = self.targets[0][0].post.md5
+        if md5 is None:
+            return None
+
+        name = md5
+        if self.download_file.type != VariantTypeEnum.ORIGINAL.value:
+            name += f"-{self.download_file.type}"
+
+        return (
+            Path(store_path)
+            / md5[:2]
+            / md5[2:4]
+            / f"{name}.{self.download_file.file_ext}"
+        )
+
+
+# サブセットをまたいで、同じファイル (md5、無ければ URL) をひとつのタスクにまとめる
+def plan_download_tasks(
+    items: list[DanbooruPostItem], caches: list[ScrapeResultCache]
+) -> list[DownloadTask]:
+    tasks: list[DownloadTask] = []
+    tasks_by_key: dict[str, DownloadTask] = {}
+
     for item, cache in zip(items, caches):
-        output_dir = cache.output_path
+        download_file = item.download_file or get_original_file(item.post)
+        if download_file is None:
+            tasks.append(DownloadTask(None, [(item, cache)]))
+            continue
+
+        key = download_file.md5 or download_file.url
+        task = tasks_by_key.get(key)
+        if task is None:
+            task = DownloadTask(download_file)
+            tasks_by_key[key] = task
+            tasks.append(task)
+        task.targets.append((item, cache))
+
+    return tasks
+
+
+# ハードリンクを作り、できなければ (別のファイルシステムなど) コピーする
+def link_or_copy(source: Path, destination: Path) -> None:
+    try:
+        os.link(source, destination)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+
+    partial_path = destination.with_name(destination.name + PARTIAL_SUFFIX)
+    shutil.copyfile(source, partial_path)
+    os.replace(partial_path, destination)
+
+
+# ダウンロードしたファイル (または保存済みのもの) から残りの出力先を作り、保存済みにする
+def materialize_download_task(
+    source: Path,
+    paths: list[Path],
+    targets: list[tuple[DanbooruPostItem, ScrapeResultCache]],
+    index: DirectoryIndex | None = None,
+) -> None:
+    for path in paths:
+        if path != source:
+            link_or_copy(source, path)
+        if index is not None:
+            index.add(path)
+
+    for item, cache in targets:
+        journal = open_journal(cache.save_state_path)
+        if journal is not None:
+            journal.mark_completed("image", cache.output_path, item.post.id)
+
+
+# 保存済みのファイル (無ければ None) と、ダウンロードする先と、リンクを作るパスを返す
+def find_download_source(
+    task: DownloadTask,
+    paths: list[Path],
+    download_config: DownloadConfig,
+    index: DirectoryIndex | None = None,
+) -> tuple[Path | None, Path, list[Path]]:
+    # ストアを使う場合は、出力先はすべてストアからのリンクにする
+    blob_path = (
+        task.blob_path(download_config.store_path)
+        if download_config.store_path is not None
+        else None
+    )
+
+    # 既にストアや別のサブセットに保存されていれば、ダウンロードせずにそれを使う
+    candidates = paths + [task.output_path(item, cache) for item, cache in task.targets]
+
+    if blob_path is not None:
+        if index is not None:
+            index.ensure_dir(blob_path.parent)
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+        destination = blob_path
+        paths = [*paths, blob_path]
+    else:
+        destination = paths[0]
+
+    exists = index.exists if index is not None else os.path.exists
+    if blob_path is not None:
+        candidates = [blob_path, *candidates]
+    source = next((path for path in candidates if exists(path)), None)
+
+    return source, destination, paths
+
 
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
+def download_post_task(
+    task: DownloadTask,
+    auth: AuthConfig | None,
+    download_config: DownloadConfig = DownloadConfig(),
+    index: DirectoryIndex | None = None,
+) -> None:
+    targets = task.pending_targets(index)
+    if len(targets) == 0:
+        return
 
-        if item.post.file_url is None:
+    download_file = task.download_file
+    if download_file is None:
+        for item, _ in targets:
             print(f"file_url is None! (skipped: ID {item.post.id})")
-            pbar.update(1)
-            return
+        return
+
+    paths = [task.output_path(item, cache) for item, cache in targets]
+    for output_dir in dict.fromkeys(path.parent for path in paths):
+        if index is not None:
+            index.ensure_dir(output_dir)
+        else:
+            output_dir.mkdir(parents=True, exist_ok=True)
 
+    source, destination, paths = find_download_source(
+        task, paths, download_config, index
+    )
+    if source is None:
+        source = destination
         download_image(
-            item.post.file_url,
-            output_dir,
-            str(item.post.id),
-            item.post.file_ext,
-            {
-                "User-Agent": "Danbooru Scraper",
-                "Authorization": f"Basic {auth.basic_auth()}"
-                if auth is not None
-                else "",
-            },
+            download_file.url,
+            destination.parent,
+            destination.stem,
+            download_file.file_ext,
+            get_download_headers(auth),
+            md5=download_file.md5 if download_config.verify else None,
+            file_size=download_file.file_size if download_config.verify else None,
+            max_attempts=download_config.max_attempts,
+            index=index,
         )
-        pbar.update(1)
 
+    materialize_download_task(source, paths, targets, index)
+
+
+# 出力先がすべて保存済みのタスクを、スレッドに渡す前に取り除く
+def drop_completed_tasks(
+    tasks: list[DownloadTask], index: DirectoryIndex
+) -> list[DownloadTask]:
+    return [task for task in tasks if len(task.pending_targets(index)) > 0]
 
-def save_caption(
-    caption: str, output_dir: str | Path, filename: str, extension: str, overwrite: bool
-) -> None:
-    output_path = Path(output_dir) / f"{filename}.{extension}"
 
-    if output_path.exists() and not overwrite:
+# 大きいファイルから始めて、最後に大きいファイルだけが残らないようにする
+def sort_download_tasks(tasks: list[DownloadTask]) -> list[DownloadTask]:
+    return sorted(
+        tasks,
+        key=lambda task: (
+            task.download_file.file_size or 0 if task.download_file is not None else 0
+        ),
+        reverse=True,
+    )
+
+
+def report_download_failures(failures: list[tuple[DownloadTask, Exception]]) -> None:
+    if len(failures) == 0:
         return
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(caption)
+    post_ids = [str(task.targets[0][0].post.id) for task, _ in failures]
+    print(f"{len(failures)} downloads failed (IDs: {', '.join(post_ids)})")
 
 
-def save_post_captions(
-    items: list[DanbooruPostItem],
-    caches: list[ScrapeResultCache],
-    fallback_caption_config: CaptionConfig,
-) -> None:
-    for item, cache in zip(items, caches):
-        caption_config = (
-            cache.caption if cache.caption is not None else fallback_caption_config
-        )
+# 空いたスレッドが次のタスクを取る (1 件の失敗で残りを止めずに、失敗したタスクを返す)
+def download_post_tasks(
+    tasks: list[DownloadTask],
+    auth: AuthConfig | None,
+    pbar,
+    download_config: DownloadConfig = DownloadConfig(),
+    index: DirectoryIndex | None = None,
+    max_workers: int = 1,
+) -> list[tuple[DownloadTask, Exception]]:
+    queue = deque(sort_download_tasks(tasks))
+    failures: list[tuple[DownloadTask, Exception]] = []
 
-        output_dir = cache.output_path
+    def worker():
+        while True:
+            try:
+                task = queue.popleft()
+            except IndexError:
+                return
 
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
+            try:
+                download_post_task(task, auth, download_config, index)
+            except Exception as e:
+                failures.append((task, e))
+                item, _ = task.targets[0]
+                print(f"Failed to download ID {item.post.id}: {e}")
 
-        save_caption(
-            item.compose_tags(
-                caption_config.category_separator, caption_config.category_order
-            ),
-            output_dir,
-            str(item.post.id),
-            caption_config.extension,
-            caption_config.overwrite,
-        )
+            pbar.update(len(task.targets))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker) for _ in range(max_workers)]
+        for future in futures:
+            future.result()
 
+    return failures
 
-def save_from_cache(
-    chunk: list[DanbooruPostItem],
+
+# キャプションを書き込むスレッドの数
+CAPTION_WRITER_WORKERS = 4
+
+# ひとつのスレッドにまとめて渡す件数
+CAPTION_WRITE_BATCH_SIZE = 256
+
+
+# 作成済みのディレクトリを覚えておき、書き込みはまとめてスレッドプールで行う
+class CaptionWriter:
+    def __init__(
+        self,
+        max_workers: int = CAPTION_WRITER_WORKERS,
+        batch_size: int = CAPTION_WRITE_BATCH_SIZE,
+        index: DirectoryIndex | None = None,
+    ) -> None:
+        self.batch_size = batch_size
+        self.index = index
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: list[Future] = []
+        self._batch: list[tuple[str, str, bool, Callable[[], None] | None]] = []
+        self._created_dirs: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _ensure_dir(self, output_dir: str) -> None:
+        if self.index is not None:
+            self.index.ensure_dir(output_dir)
+            return
+        if output_dir in self._created_dirs:
+            return
+        with self._lock:
+            if output_dir not in self._created_dirs:
+                Path(output_dir).mkdir(parents=True, exist_ok=True)
+                self._created_dirs.add(output_dir)
+
+    def _write_batch(
+        self,
+        batch: list[tuple[str, str, bool, Callable[[], None] | None]],
+    ) -> None:
+        for path, caption, overwrite, on_done in batch:
+            try:
+                # 上書きしない場合は、存在確認と作成を 1 回で行う
+                with open(path, "w" if overwrite else "x", encoding="utf-8") as f:
+                    f.write(caption)
+            except FileExistsError:
+                pass
+
+            # 書き込めたものだけ登録する
+            if self.index is not None:
+                self.index.add(path)
+
+            if on_done is not None:
+                on_done()
+
+    def _submit(self) -> None:
+        if len(self._batch) == 0:
+            return
+        self._futures.append(self._executor.submit(self._write_batch, self._batch))
+        self._batch = []
+
+    def write(
+        self,
+        caption: str,
+        output_dir: str,
+        filename: str,
+        extension: str,
+        overwrite: bool,
+        on_done: Callable[[], None] | None = None,
+    ) -> None:
+        self._ensure_dir(output_dir)
+        path = os.path.join(output_dir, f"{filename}.{extension}")
+        self._batch.append((path, caption, overwrite, on_done))
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    # すべて書き終わるまで待つ (失敗したものがあれば例外を投げる)
+    def close(self) -> None:
+        self._submit()
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def save_post_captions(
+    items: list[DanbooruPostItem],
     caches: list[ScrapeResultCache],
-    config: ScrapeConfig,
-    pbar,
+    fallback_caption_config: CaptionConfig,
+    index: DirectoryIndex | None = None,
 ) -> None:
-    save_post_captions(chunk, caches, config.caption)
+    # 同じキャッシュの投稿をまとめてから、キャプションを一度に作る
+    groups: dict[int, tuple[ScrapeResultCache, list[DanbooruPostItem]]] = {}
+    for item, cache in zip(items, caches):
+        groups.setdefault(id(cache), (cache, []))[1].append(item)
+
+    with CaptionWriter(index=index) as writer:
+        for cache, cache_items in groups.values():
+            caption_config = (
+                cache.caption if cache.caption is not None else fallback_caption_config
+            )
+
+            output_dir = cache.output_path
+            journal = open_journal(cache.save_state_path)
+
+            if journal is not None and not caption_config.overwrite:
+                cache_items = [
+                    item
+                    for item in cache_items
+                    if not journal.is_completed("caption", output_dir, item.post.id)
+                ]
 
-    download_post_images(chunk, caches, config.auth, pbar)
+            # 書き込むまでもなく保存済みのものは、キャプションも作らない
+            if index is not None and not caption_config.overwrite:
+                cache_items = [
+                    item
+                    for item in cache_items
+                    if not index.exists(
+                        os.path.join(
+                            output_dir, f"{item.post.id}.{caption_config.extension}"
+                        )
+                    )
+                ]
+
+            captions = compose_captions(
+                cache_items,
+                caption_config.category_separator,
+                caption_config.category_order,
+            )
+
+            for item, caption in zip(cache_items, captions):
+                writer.write(
+                    caption,
+                    output_dir,
+                    str(item.post.id),
+                    caption_config.extension,
+                    caption_config.overwrite,
+                    (
+                        partial(
+                            journal.mark_completed, "caption", output_dir, item.post.id
+                        )
+                        if journal is not None
+                        else None
+                    ),
+                )
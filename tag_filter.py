@@ -0,0 +1,63 @@
+from hashlib import sha256
+from itertools import chain
+import json
+from tag_lists import resolve_tag_set
+from scrape_config import SearchResultFilterConfig
+
+
+# SearchResultFilterConfig を一度だけ集合に変換して使い回す
+class CompiledResultFilter:
+    __slots__ = ("include_any", "include_all", "exclude_any", "exclude_all")
+
+    include_any: frozenset[str] | None
+    include_all: frozenset[str] | None
+    exclude_any: frozenset[str] | None
+    exclude_all: frozenset[str] | None
+
+    def __init__(self, config: SearchResultFilterConfig) -> None:
+        # str はファイルパスとみなす (ファイルが無ければそのタグひとつ)。空なら判定しない
+        self.include_any = resolve_tag_set(config.include_any) or None
+        self.include_all = resolve_tag_set(config.include_all) or None
+        self.exclude_any = resolve_tag_set(config.exclude_any) or None
+        self.exclude_all = resolve_tag_set(config.exclude_all) or None
+
+    # 同じ結果になるフィルターなら同じ値 (検索結果のキャッシュなどのキーに使う)
+    def digest(self) -> str:
+        tag_sets = [
+            self.include_any,
+            self.include_all,
+            self.exclude_any,
+            self.exclude_all,
+        ]
+        data = json.dumps([sorted(tags or []) for tags in tag_sets])
+        return sha256(data.encode("utf-8")).hexdigest()[:16]
+
+    def match_tags(self, tags: set[str] | frozenset[str]) -> bool:
+        if self.include_any is not None and self.include_any.isdisjoint(tags):
+            return False  # どれも入っていなかったら
+        if self.include_all is not None and not self.include_all <= tags:
+            return False  # ひとつでも入っていなかったら
+        if self.exclude_any is not None and not self.exclude_any.isdisjoint(tags):
+            return False  # どれか入っていたら
+        if self.exclude_all is not None and self.exclude_all <= tags:
+            return False  # 全部入っていたら
+
+        return True
+
+    def match(self, post) -> bool:
+        return self.match_tags(
+            set(
+                chain(
+                    post.artist_tags,
+                    post.copyright_tags,
+                    post.character_tags,
+                    post.general_tags,
+                    post.meta_tags,
+                )
+            )
+        )
+
+
+# 検索ごとに一度だけ呼ばれるので、タグのファイルが更新されていれば読み直すように毎回解決する
+def compile_result_filter(config: SearchResultFilterConfig) -> CompiledResultFilter:
+    return CompiledResultFilter(config)
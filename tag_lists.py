@@ -0,0 +1,112 @@
+from pathlib import Path
+import os
+import stat
+import threading
+import time
+
+import utils
+
+# 同じファイルの更新を確認する間隔 (秒)
+CHECK_INTERVAL = 1.0
+
+
+class TagList:
+    __slots__ = ("mtime", "checked_at", "tags", "ordered")
+
+    mtime: float | None
+    checked_at: float
+    tags: frozenset[str]
+    ordered: tuple[str, ...]
+
+    def __init__(self, mtime: float | None, lines: list[str]) -> None:
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+        self.tags = frozenset(lines)
+        self.ordered = tuple(lines)
+
+
+# タグのファイルを一度だけ読み込み、更新されたときだけ読み直す
+class TagListRegistry:
+    def __init__(self, check_interval: float = CHECK_INTERVAL) -> None:
+        self.check_interval = check_interval
+        self._entries: dict[str, TagList] = {}
+        self._lock = threading.Lock()
+
+        # 読み込み済みのファイルを読み直すたびに増える
+        self._generation = 0
+        self._checked_at = time.monotonic()
+
+    def _mtime(self, path: str) -> float | None:
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return st.st_mtime if stat.S_ISREG(st.st_mode) else None
+
+    # ファイルでなければ None (mtime が None のものは「ファイルではない」という記録)
+    def get(self, path: str | Path) -> TagList | None:
+        key = str(path)
+
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry.checked_at >= self.check_interval:
+            with self._lock:
+                entry = self._entries.get(key)
+                mtime = self._mtime(key)
+
+                if entry is None or entry.mtime != mtime:
+                    if entry is not None:
+                        self._generation += 1
+                    lines = utils.load_file_lines(key) if mtime is not None else []
+                    entry = TagList(mtime, lines)
+                    self._entries[key] = entry
+                else:
+                    entry.checked_at = time.monotonic()
+
+        return entry if entry.mtime is not None else None
+
+    # タグを解決して作ったものを使い回すときに、作ったときと比べる
+    # (check_interval ごとに読み込み済みのファイルをすべて確認する)
+    def generation(self) -> int:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            for key in list(self._entries):
+                self.get(key)
+            self._checked_at = time.monotonic()
+        return self._generation
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+REGISTRY = TagListRegistry()
+
+
+def load_tag_set(path: str | Path) -> frozenset[str]:
+    entry = REGISTRY.get(path)
+    if entry is None:
+        raise FileNotFoundError(path)
+    return entry.tags
+
+
+# 順番が意味を持つ場合 (挿入するタグなど)
+def load_tag_lines(path: str | Path) -> list[str]:
+    entry = REGISTRY.get(path)
+    if entry is None:
+        raise FileNotFoundError(path)
+    return list(entry.ordered)
+
+
+# str はファイルパスとみなす (ファイルが無ければそのタグひとつ)
+def resolve_tags(tags: str | list[str]) -> list[str]:
+    if isinstance(tags, str):
+        entry = REGISTRY.get(tags)
+        return list(entry.ordered) if entry is not None else [tags]
+    return tags
+
+
+def resolve_tag_set(tags: str | list[str]) -> frozenset[str]:
+    if isinstance(tags, str):
+        entry = REGISTRY.get(tags)
+        return entry.tags if entry is not None else frozenset([tags])
+    return frozenset(tags)
@@ -0,0 +1,64 @@
+from array import array
+from typing import Iterable
+import threading
+
+# 空のカテゴリは配列を作らずにこれを共有する
+EMPTY_TAG_IDS: tuple[int, ...] = ()
+
+TagIds = array | tuple[int, ...]
+
+
+# タグ文字列と整数 id の対応表 (プロセス全体で共有する)
+class TagVocabulary:
+    def __init__(self) -> None:
+        self._ids: dict[str, int] = {}
+        self._tags: list[str] = []
+        self._lock = threading.Lock()
+
+        # 空白だけのタグ (キャプションでは取り除く)
+        self.blank_ids: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def id(self, tag: str) -> int:
+        tag_id = self._ids.get(tag)
+        if tag_id is not None:
+            return tag_id
+
+        with self._lock:
+            tag_id = self._ids.get(tag)
+            if tag_id is None:
+                tag_id = len(self._tags)
+                self._tags.append(tag)
+                self._ids[tag] = tag_id
+                if tag.strip() == "":
+                    self.blank_ids.add(tag_id)
+            return tag_id
+
+    def ids(self, tags: Iterable[str]) -> TagIds:
+        if not isinstance(tags, list):
+            tags = list(tags)
+        if len(tags) == 0:
+            return EMPTY_TAG_IDS
+
+        # ほとんどのタグは登録済みなので、まずはロックなしで引く
+        get = self._ids.get
+        tag_ids = [get(tag) for tag in tags]
+        if None in tag_ids:
+            tag_ids = [self.id(tag) for tag in tags]
+
+        return array("I", tag_ids)
+
+    def id_set(self, tags: Iterable[str]) -> frozenset[int]:
+        return frozenset(self.id(tag) for tag in tags)
+
+    def tag(self, tag_id: int) -> str:
+        return self._tags[tag_id]
+
+    def tags(self, tag_ids: TagIds) -> list[str]:
+        tags = self._tags
+        return [tags[tag_id] for tag_id in tag_ids]
+
+
+VOCAB = TagVocabulary()
@@ -1,8 +1,6 @@
 from typing import Literal
 
-import os
-
-import utils
+from tag_lists import REGISTRY, resolve_tags, resolve_tag_set
 
 from danbooru_post import Rating
 from scrape_util import DanbooruPostItem
@@ -11,7 +9,6 @@ from scrape_config import (
     CaptionPostProcessConfig,
     RatingTagConfig,
     CaptionConfig,
-    QualityTagConfig,
     FILETYPE,
 )
 
@@ -21,195 +18,213 @@ DEFAULT_FILETYPES: list[FILETYPE] = ["jpg", "png", "webp", "avif"]
 
 
 def normalize_tags(tags: str | list[str]) -> list[str]:
-    if isinstance(tags, str):
-        if os.path.isfile(tags):
-            return utils.load_file_lines(tags)
-        else:
-            return [tags]
-    else:
-        return tags
-
-
-def is_nsfw(
-    tags: list[str],
-    nsfw_tags: str | list[str] | None,
-) -> bool:
-    if nsfw_tags is None:
-        return False
-    return any(tag in normalize_tags(nsfw_tags) for tag in tags)
-
-
-def process_replace(
-    original: list[str], _from: str | list[str] | None, to: str
-) -> list[str]:
-    if _from is None:
-        return original
-
-    for i, tag in enumerate(original):
-        for f in normalize_tags(_from):
-            if tag == f:
-                original[i] = to
-                break
-
-    return original
-
+    return resolve_tags(tags)
 
-def process_keep(original: list[str], keep: str | list[str] | None) -> list[str]:
-    if keep is None:
-        return original
 
-    new_tags = []
-
-    for tag in original:
-        if tag in normalize_tags(keep):
-            new_tags.append(tag)
-
-    return new_tags
+## TODO: フォールバックするしくみをつける
+def do_all_caption_post_process(item: DanbooruPostItem, config: bool | CaptionConfig):
+    return compile_caption_config(config)(item)
+
+
+def _resolve_tag_set(tags: str | list[str] | None) -> frozenset[str] | None:
+    if tags is None:
+        return None
+    return resolve_tag_set(tags)
+
+
+# CaptionPostProcessConfig を一度だけ解決して、1 回の走査で適用できる形にする
+class CompiledPostProcess:
+    __slots__ = ("enabled", "replaces", "keeps", "deletes", "prefix", "suffix")
+
+    enabled: bool
+    replaces: dict[str, str] | None
+    keeps: frozenset[str] | None
+    deletes: frozenset[str] | None
+    prefix: list[str]
+    suffix: list[str]
+
+    def __init__(self, config: CaptionPostProcessConfig | bool) -> None:
+        self.enabled = not (isinstance(config, bool) and not config)
+        self.replaces = None
+        self.keeps = None
+        self.deletes = None
+        self.prefix = []
+        self.suffix = []
+
+        if isinstance(config, bool):
+            return
+
+        # 置換は順番に適用されるので、連続した置換をひとつの対応表にまとめる
+        replaces: dict[str, str] = {}
+        for replace in config.replaces:
+            _from = _resolve_tag_set(replace.tags)
+            for tag, to in replaces.items():
+                if to in _from:
+                    replaces[tag] = replace.to
+            for tag in _from:
+                if tag not in replaces:
+                    replaces[tag] = replace.to
+        self.replaces = replaces or None
+
+        for keep in config.keeps:
+            tags = _resolve_tag_set(keep.tags)
+            self.keeps = tags if self.keeps is None else self.keeps & tags
+
+        for delete in config.deletes:
+            tags = _resolve_tag_set(delete.tags)
+            self.deletes = tags if self.deletes is None else self.deletes | tags
+
+        for insert in config.inserts:
+            tags = normalize_tags(insert.tags)
+            if insert.position == "start":
+                self.prefix = tags + self.prefix
+            elif insert.position == "end":
+                self.suffix = self.suffix + tags
+            else:
+                raise Exception("Invalid position: " + insert.position)
+
+    def __call__(self, original: list[str]) -> list[str]:
+        if not self.enabled:
+            return []
 
+        replaces, keeps, deletes = self.replaces, self.keeps, self.deletes
 
-def process_delete(original: list[str], delete: str | list[str] | None) -> list[str]:
-    if delete is None:
-        return original
+        tags = []
+        for tag in original:
+            if replaces is not None:
+                tag = replaces.get(tag, tag)
+            if keeps is not None and tag not in keeps:
+                continue
+            if deletes is not None and tag in deletes:
+                continue
+            tags.append(tag)
 
-    new_tags = []
+        if len(self.prefix) > 0 or len(self.suffix) > 0:
+            return self.prefix + tags + self.suffix
+        return tags
 
-    for tag in original:
-        if tag not in normalize_tags(delete):
-            new_tags.append(tag)
 
-    return new_tags
+class CompiledRatingTag:
+    __slots__ = ("type", "nsfw_tags", "insert_tags", "by_rating")
 
+    type: str
+    nsfw_tags: frozenset[str] | None
+    insert_tags: list[str]
+    by_rating: dict[Rating, list[str]]
 
-def process_insert(
-    original: list[str], insert: str | list[str] | None, position: INSERT_POSITION
-) -> list[str]:
-    if insert is None:
-        return original
+    def __init__(self, config: RatingTagConfig | bool) -> None:
+        if isinstance(config, bool):
+            config = RatingTagConfig() if config else RatingTagConfig(type="none")
 
-    insert = normalize_tags(insert)
+        self.type = config.type
+        self.nsfw_tags = _resolve_tag_set(config.nsfw_tags)
+        self.insert_tags = (
+            normalize_tags(config.insert_tags) if config.insert_tags is not None else []
+        )
+        self.by_rating = {
+            rating: normalize_tags(tags) if tags is not None else []
+            for rating, tags in [
+                (Rating.EXPLICIT, config.explicit),
+                (Rating.SENSITIVE, config.sensitive),
+                (Rating.QUESTIONABLE, config.questionable),
+                (Rating.GENERAL, config.general),
+            ]
+        }
+
+    def __call__(self, original: list[str], post_item: DanbooruPostItem) -> list[str]:
+        if self.type == "none":
+            return []
 
-    if position == "start":
-        return insert + original
-    elif position == "end":
-        return original + insert
-    else:
-        raise Exception("Invalid position: " + position)
+        elif self.type == "by_tag":
+            if self.nsfw_tags is not None and not self.nsfw_tags.isdisjoint(original):
+                return self.insert_tags
+            return []
 
+        elif self.type == "by_rating":
+            tags = self.by_rating.get(post_item.post.rating)
+            if tags is None:
+                raise Exception("Invalid rating: " + post_item.post.rating)
+            return tags
 
-def do_caption_post_process(
-    original: list[str], config: CaptionPostProcessConfig | bool
-) -> list[str]:
-    tags = original
+        raise Exception(f"Unexpected config type: {self.type}")
 
-    if isinstance(config, bool):
-        if config:
-            return tags
-        else:
-            return []
 
-    for replace in config.replaces:
-        tags = process_replace(tags, replace.tags, replace.to)
+# CaptionConfig をまとめて解決したもの (do_all_caption_post_process と同じ結果になる)
+class CompiledCaptionConfig:
+    enabled: bool
 
-    for keep in config.keeps:
-        tags = process_keep(tags, keep.tags)
+    def __init__(self, config: CaptionConfig | bool) -> None:
+        self.enabled = not (isinstance(config, bool) and not config)
+        if isinstance(config, bool):
+            config = CaptionConfig()
 
-    for delete in config.deletes:
-        tags = process_delete(tags, delete.tags)
+        self.rating = CompiledRatingTag(config.rating)
+        self.quality = list(config.quality.items()) if config.quality else []
 
-    for insert in config.inserts:
-        tags = process_insert(tags, insert.tags, insert.position)
+        self.artist = CompiledPostProcess(config.artist)
+        self.copyright = CompiledPostProcess(config.copyright)
+        self.character = CompiledPostProcess(config.character)
+        self.general = CompiledPostProcess(config.general)
+        self.meta = CompiledPostProcess(config.meta)
 
-    return tags
+        self.common = (
+            CompiledPostProcess(config.common) if config.common is not None else None
+        )
 
+    def create_quality_tag(self, post_item: DanbooruPostItem) -> list[str]:
+        for quality_tag, score in self.quality:
+            if post_item.post.score >= score:
+                return [quality_tag]
+        return []
 
-## TODO: フォールバックするしくみをつける
-def do_all_caption_post_process(item: DanbooruPostItem, config: bool | CaptionConfig):
-    if isinstance(config, bool):
-        if not config:
+    def __call__(self, item: DanbooruPostItem) -> DanbooruPostItem:
+        if not self.enabled:
             return item
-        else:
-            config = CaptionConfig()
 
-    item.rating_tags = create_rating_tag(item.general_tags, item, config.rating)
-    item.quality_tags = create_quality_tag(item, config.quality)
+        general_tags = item.general_tags
 
-    item.artist_tags = do_caption_post_process(item.artist_tags, config.artist)
-    item.copyright_tags = do_caption_post_process(item.copyright_tags, config.copyright)
-    item.character_tags = do_caption_post_process(item.character_tags, config.character)
-    item.general_tags = do_caption_post_process(item.general_tags, config.general)
-    item.meta_tags = do_caption_post_process(item.meta_tags, config.meta)
+        item.rating_tags = self.rating(general_tags, item)
+        item.quality_tags = self.create_quality_tag(item)
 
-    # 共通の処理
-    if config.common is not None:
-        item.artist_tags = do_caption_post_process(item.artist_tags, config.common)
-        item.copyright_tags = do_caption_post_process(
-            item.copyright_tags, config.common
-        )
-        item.character_tags = do_caption_post_process(
-            item.character_tags, config.common
-        )
-        item.general_tags = do_caption_post_process(item.general_tags, config.common)
-        item.meta_tags = do_caption_post_process(item.meta_tags, config.common)
+        artist_tags = self.artist(item.artist_tags)
+        copyright_tags = self.copyright(item.copyright_tags)
+        character_tags = self.character(item.character_tags)
+        general_tags = self.general(general_tags)
+        meta_tags = self.meta(item.meta_tags)
 
-    return item
+        # 共通の処理
+        if self.common is not None:
+            artist_tags = self.common(artist_tags)
+            copyright_tags = self.common(copyright_tags)
+            character_tags = self.common(character_tags)
+            general_tags = self.common(general_tags)
+            meta_tags = self.common(meta_tags)
 
+        item.artist_tags = artist_tags
+        item.copyright_tags = copyright_tags
+        item.character_tags = character_tags
+        item.general_tags = general_tags
+        item.meta_tags = meta_tags
 
-def create_rating_tag(
-    original: list[str], post_item: DanbooruPostItem, config: bool | RatingTagConfig
-) -> list[str]:
-    if isinstance(config, bool):
-        if not config:  # false
-            return []
-        else:  # true
-            config = RatingTagConfig()  # デフォルト設定
+        return item
 
-    if config.type == "none":
-        return []
 
-    elif config.type == "by_tag":
-        if is_nsfw(original, config.nsfw_tags):
-            return (
-                normalize_tags(config.insert_tags)
-                if config.insert_tags is not None
-                else []
-            )
-        else:
-            return []
+# 最近コンパイルした (設定, タグのファイルの世代, コンパイルしたもの)
+_compiled: list[tuple[CaptionConfig | bool, int, CompiledCaptionConfig]] = []
 
-    elif config.type == "by_rating":
-        if post_item.post.rating == Rating.EXPLICIT:
-            return (
-                normalize_tags(config.explicit) if config.explicit is not None else []
-            )
-        elif post_item.post.rating == Rating.SENSITIVE:
-            return (
-                normalize_tags(config.sensitive) if config.sensitive is not None else []
-            )
-        elif post_item.post.rating == Rating.QUESTIONABLE:
-            return (
-                normalize_tags(config.questionable)
-                if config.questionable is not None
-                else []
-            )
-        elif post_item.post.rating == Rating.GENERAL:
-            return normalize_tags(config.general) if config.general is not None else []
-        else:
-            raise Exception("Invalid rating: " + post_item.post.rating)
-
-    raise Exception(f"Unexpected config type: {config.type}")
-
-
-def create_quality_tag(
-    post_item: DanbooruPostItem, config: QualityTagConfig | None
-) -> list[str]:
-    if config is None:
-        return []
+# 投稿ごとに呼ばれる設定はサブセットごとのものと全体のものくらいなので、少しだけ覚えておく
+MAX_COMPILED_CONFIGS = 8
 
-    tags = []
 
-    for quality_tag, score in config.items():
-        if post_item.post.score >= score:
-            tags.append(quality_tag)
-            break
+# 同じ設定オブジェクトで、タグのファイルも更新されていなければ前回コンパイルしたものを返す
+def compile_caption_config(config: CaptionConfig | bool) -> CompiledCaptionConfig:
+    generation = REGISTRY.generation()
+    for cached_config, cached_generation, compiled in _compiled:
+        if cached_config is config and cached_generation == generation:
+            return compiled
 
-    return tags
+    compiled = CompiledCaptionConfig(config)
+    _compiled[:] = [cached for cached in _compiled if cached[0] is not config]
+    _compiled.append((config, generation, compiled))
+    del _compiled[:-MAX_COMPILED_CONFIGS]
+    return compiled
@@ -0,0 +1,294 @@
+import unittest
+
+import sys
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.append("..")
+
+from async_scrape import (
+    get_posts,
+    refresh_search_cache,
+    report_query_plan,
+    download_image,
+    create_session,
+)
+from scrape_config import (
+    AuthConfig,
+    CacheConfig,
+    SearchFilterConfig,
+    SearchResultFilterConfig,
+)
+from query import QueryPlan, plan_query
+from scrape_util import PagePlanner
+
+
+class FakeAsyncScraper:
+    def __init__(self, ids: list[int]) -> None:
+        self.ids = sorted(ids, reverse=True)
+        self.pages = []
+
+    async def get_posts(self, query, page=1, limit_per_page=20):
+        self.pages.append(page)
+        if isinstance(page, int):
+            ids = self.ids[(page - 1) * limit_per_page : page * limit_per_page]
+        else:
+            ids = [id for id in self.ids if id < int(page[1:])][:limit_per_page]
+        return [SimpleNamespace(id=id, md5=str(id)) for id in ids]
+
+
+# 検索クエリ末尾の id:>N と id:a,b,c だけ解釈する
+class FakeRefreshScraper:
+    def __init__(self, ids: list[int]) -> None:
+        self.domain = "danbooru.donmai.us"
+        self.ids = sorted(ids, reverse=True)
+        self.queries = []
+
+    async def get_posts(self, query, page=1, limit_per_page=20):
+        self.queries.append(query)
+        id_query = query.split()[-1][len("id:") :]
+        if id_query.startswith(">"):
+            ids = [id for id in self.ids if id > int(id_query[1:])]
+        else:
+            ids = [id for id in self.ids if str(id) in id_query.split(",")]
+
+        if isinstance(page, int):
+            ids = ids[(page - 1) * limit_per_page : page * limit_per_page]
+        else:
+            ids = [id for id in ids if id < int(page[1:])][:limit_per_page]
+        return [SimpleNamespace(id=id, md5=str(id)) for id in ids]
+
+
+class FakeCountScraper:
+    def __init__(self) -> None:
+        self.queries = []
+
+    async def count_posts(self, query):
+        self.queries.append(query)
+        return 1000
+
+
+# 最初のチャンクを返したあとでタイムアウトする
+class TimeoutClient:
+    @asynccontextmanager
+    async def get(self, url, headers=None):
+        async def iter_chunked(size):
+            yield b"image"
+            raise asyncio.TimeoutError()
+
+        yield SimpleNamespace(
+            status=200, content=SimpleNamespace(iter_chunked=iter_chunked)
+        )
+
+
+def new_item(post):
+    return SimpleNamespace(
+        post=post,
+        artist_tags=[],
+        copyright_tags=[],
+        character_tags=[],
+        general_tags=["odd" if post.id % 2 else "even"],
+        meta_tags=[],
+    )
+
+
+def filter_posts(page_posts, result_filter):
+    return [item for item in map(new_item, page_posts) if result_filter.match(item)]
+
+
+class TestAsyncScrape(unittest.IsolatedAsyncioTestCase):
+    async def test_get_posts_with_filter(self):
+        scraper = FakeAsyncScraper(list(range(1, 101)))
+
+        with mock.patch("async_scrape.filter_page_posts", filter_posts):
+            items = await get_posts(
+                scraper,
+                "1girl",
+                None,
+                SearchResultFilterConfig(exclude_any=["odd"]),
+                total_limit=30,
+                limit_per_page=10,
+                prefetch=3,
+            )
+
+        self.assertEqual([item.post.id for item in items], list(range(100, 40, -2)))
+        # 先読みしたページ以上は取得しない
+        self.assertLessEqual(len(scraper.pages), 9)
+
+    async def test_get_posts_records_done(self):
+        scraper = FakeAsyncScraper(list(range(1, 101)))
+        journal = mock.Mock()
+        journal.load_search.return_value = None
+
+        def to_items(page_posts, result_filter):
+            return [SimpleNamespace(post=post, dict=lambda: {}) for post in page_posts]
+
+        # ページ番号の上限に達したら、空のページを取得せずに終わる
+        with mock.patch("async_scrape.filter_page_posts", to_items), mock.patch(
+            "async_scrape.PagePlanner", partial(PagePlanner, page_limit=2)
+        ):
+            items = await get_posts(
+                scraper,
+                "1girl",
+                None,
+                SearchResultFilterConfig(),
+                total_limit=100,
+                limit_per_page=10,
+                pagination="page",
+                journal=journal,
+            )
+
+        self.assertEqual(len(items), 20)
+        journal.record_page.assert_called_with("1girl", [], None)
+
+    async def test_download_timeout_removes_partial(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(Exception):
+                await download_image(
+                    TimeoutClient(),
+                    "https://cdn.donmai.us/original/1.png",
+                    tmp_dir,
+                    "1",
+                    "png",
+                    {},
+                    max_attempts=2,
+                )
+
+            self.assertEqual(list(Path(tmp_dir).iterdir()), [])
+
+    async def test_session_timeout(self):
+        config = SimpleNamespace(
+            http=SimpleNamespace(limit_per_host=None, timeout=5), max_workers=4
+        )
+
+        # 時間のかかるダウンロードでも、読み込みが続いていれば打ち切らない
+        async with create_session(config) as session:
+            self.assertIsNone(session.timeout.total)
+            self.assertEqual(session.timeout.sock_read, 5)
+            self.assertEqual(session.timeout.sock_connect, 5)
+
+    async def test_refresh_search_cache(self):
+        # 11, 12 が新しく投稿され、9 はクエリに一致しなくなった
+        scraper = FakeRefreshScraper([1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12])
+        cached = [new_item(SimpleNamespace(id=id)) for id in range(10, 0, -1)]
+        result_filter = SearchResultFilterConfig(push_down=False)
+
+        with mock.patch("async_scrape.filter_page_posts", filter_posts), mock.patch(
+            "cache_util.save_search_cache"
+        ) as save_search_cache:
+            items = await refresh_search_cache(
+                scraper,
+                QueryPlan("1girl", "1girl", result_filter, []),
+                cached,
+                SimpleNamespace(
+                    auth=None, search_result_filter=result_filter, pagination="auto"
+                ),
+                CacheConfig(refresh=True, recheck_recent=3),
+                SimpleNamespace(output_path="output", limit=10),
+            )
+
+        self.assertEqual(
+            [item.post.id for item in items], [12, 11, 10, 8, 7, 6, 5, 4, 3, 2, 1]
+        )
+        self.assertEqual(set(scraper.queries), {"1girl id:>10", "1girl id:10,9,8"})
+        # 読み込んだ 10 件だけを置き換える
+        save_search_cache.assert_called_once_with(
+            "output", mock.ANY, items, replace_prefix=10
+        )
+        self.assertEqual(save_search_cache.call_args.args[1].query, "1girl")
+
+    async def test_refresh_pushed_down(self):
+        scraper = FakeRefreshScraper([1, 2, 3, 11])
+        cached = [new_item(SimpleNamespace(id=id)) for id in [3, 2, 1]]
+        result_filter = SearchResultFilterConfig(exclude_any=["comic"])
+        auth = AuthConfig(username="a", api_key="b", level="gold")
+        plan = plan_query(
+            "1girl",
+            None,
+            SearchFilterConfig(),
+            result_filter,
+            SearchResultFilterConfig(),
+            auth,
+            reserved_tags=1,
+        )
+        self.assertEqual(plan.query, "1girl -comic")
+
+        with mock.patch("async_scrape.filter_page_posts", filter_posts), mock.patch(
+            "cache_util.save_search_cache"
+        ):
+            items = await refresh_search_cache(
+                scraper,
+                plan,
+                cached,
+                SimpleNamespace(
+                    auth=auth, search_result_filter=result_filter, pagination="auto"
+                ),
+                CacheConfig(refresh=True),
+                SimpleNamespace(output_path="output", limit=10),
+            )
+
+        self.assertEqual([item.post.id for item in items], [11, 3, 2, 1])
+        self.assertIn("1girl -comic id:>3", scraper.queries)
+
+    async def test_refresh_too_many_new_posts(self):
+        scraper = FakeRefreshScraper(list(range(1, 31)))
+        cached = [new_item(SimpleNamespace(id=id)) for id in range(10, 0, -1)]
+        result_filter = SearchResultFilterConfig(push_down=False)
+
+        with mock.patch("async_scrape.filter_page_posts", filter_posts), mock.patch(
+            "cache_util.save_search_cache"
+        ) as save_search_cache:
+            items = await refresh_search_cache(
+                scraper,
+                QueryPlan("1girl", "1girl", result_filter, []),
+                cached,
+                SimpleNamespace(
+                    auth=None, search_result_filter=result_filter, pagination="auto"
+                ),
+                CacheConfig(refresh=True),
+                SimpleNamespace(output_path="output", limit=10),
+            )
+
+        # 11 から 20 はまだ取得していないので、古いキャッシュにはつなげない
+        self.assertEqual([item.post.id for item in items], list(range(30, 20, -1)))
+        save_search_cache.assert_called_once_with("output", mock.ANY, items)
+        self.assertEqual(save_search_cache.call_args.args[1].query, "1girl")
+
+    async def test_cannot_refresh_custom_order(self):
+        scraper = FakeRefreshScraper([1, 2])
+        result_filter = SearchResultFilterConfig(push_down=False)
+
+        items = await refresh_search_cache(
+            scraper,
+            QueryPlan("1girl", "1girl order:score", result_filter, []),
+            [],
+            SimpleNamespace(
+                auth=None, search_result_filter=result_filter, pagination="auto"
+            ),
+            CacheConfig(refresh=True),
+            SimpleNamespace(output_path="output", limit=10),
+        )
+
+        self.assertIsNone(items)
+        self.assertEqual(scraper.queries, [])
+
+    async def test_report_query_plan(self):
+        scraper = FakeCountScraper()
+        result_filter = SearchResultFilterConfig(exclude_any=["comic"])
+        plan = QueryPlan("1girl", "1girl -comic", result_filter, ["-comic"])
+
+        # 1 ページで足りるなら数えない
+        await report_query_plan(scraper, plan, 100)
+        self.assertEqual(scraper.queries, [])
+
+        await report_query_plan(scraper, plan, 1000)
+        self.assertEqual(set(scraper.queries), {"1girl", "1girl -comic"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import sys
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+sys.path.append("..")
+
+from dir_index import DirectoryIndex
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_scandir_once(self):
+        (self.root / "1.png").touch()
+        (self.root / "2.txt").touch()
+        index = DirectoryIndex()
+
+        with mock.patch("dir_index.os.scandir", wraps=os.scandir) as scandir:
+            self.assertTrue(index.exists(self.root / "1.png"))
+            self.assertTrue(index.exists(str(self.root / "2.txt")))
+            self.assertFalse(index.exists(self.root / "3.png"))
+            self.assertTrue(index.exists(f"{self.root}/./1.png"))
+
+        self.assertEqual(scandir.call_count, 1)
+
+    def test_missing_directory(self):
+        index = DirectoryIndex()
+
+        self.assertFalse(index.exists(self.root / "missing" / "1.png"))
+
+    def test_add(self):
+        index = DirectoryIndex()
+        self.assertFalse(index.exists(self.root / "1.png"))
+
+        (self.root / "1.png").touch()
+        index.add(self.root / "1.png")
+        index.add(self.root / "other" / "1.png")
+
+        self.assertTrue(index.exists(self.root / "1.png"))
+        self.assertFalse(index.exists(self.root / "other" / "1.png"))
+
+    def test_ensure_dir(self):
+        index = DirectoryIndex()
+        directory = self.root / "a" / "b"
+
+        index.ensure_dir(directory)
+        self.assertTrue(directory.is_dir())
+
+        with mock.patch("dir_index.os.makedirs") as makedirs:
+            index.ensure_dir(f"{directory}/")
+
+        makedirs.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.append("..")
+
+import http_cache
+from http_cache import CachedResponse, ResponseCache
+from scrape_util import DanbooruScraper
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        http_cache.configure(None)
+        self.tmp_dir.cleanup()
+
+    def test_save_and_load(self):
+        cache = ResponseCache(self.tmp_dir.name, max_age=60)
+        cache.save("key", CachedResponse("https://example.com", "[]", etag='"a"'))
+
+        entry = cache.load("key")
+        self.assertEqual(entry.body, "[]")
+        self.assertEqual(entry.validators(), {"If-None-Match": '"a"'})
+        self.assertTrue(cache.is_fresh(entry))
+        self.assertIsNone(cache.load("other"))
+
+        entry.fetched_at = time.time() - 120
+        self.assertFalse(cache.is_fresh(entry))
+
+    def test_revalidate(self):
+        http_cache.configure(self.tmp_dir.name, max_age=0)
+        scraper = DanbooruScraper()
+        sent_headers = []
+
+        def get(url, headers=None, stream=False):
+            sent_headers.append(headers)
+            if "If-None-Match" in headers:
+                return SimpleNamespace(status_code=304, text="", headers={})
+            return SimpleNamespace(status_code=200, text="[]", headers={"ETag": '"a"'})
+
+        with mock.patch("http_util.get", get):
+            self.assertEqual(scraper.get_posts("1girl"), [])
+            self.assertEqual(scraper.get_posts("1girl"), [])
+
+        self.assertNotIn("If-None-Match", sent_headers[0])
+        self.assertEqual(sent_headers[1]["If-None-Match"], '"a"')
+
+    def test_fresh_without_request(self):
+        http_cache.configure(self.tmp_dir.name, max_age=60)
+        scraper = DanbooruScraper()
+
+        get = mock.Mock(
+            return_value=SimpleNamespace(status_code=200, text="[]", headers={})
+        )
+        with mock.patch("http_util.get", get):
+            scraper.get_posts("1girl")
+            scraper.get_posts("1girl")
+            scraper.get_posts("1girl", page=2)
+
+        self.assertEqual(get.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append("..")
+
+from http_util import HttpClient, parse_retry_after
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    failures = 2
+    requests = 0
+
+    def do_GET(self):
+        FlakyHandler.requests += 1
+        if FlakyHandler.requests <= FlakyHandler.failures:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpUtil(unittest.TestCase):
+    def setUp(self):
+        FlakyHandler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("3"), 3.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+    def test_backoff(self):
+        client = HttpClient(backoff_factor=0.5, max_backoff=3)
+        self.assertEqual(client.backoff(0), 0.5)
+        self.assertEqual(client.backoff(2), 2.0)
+        self.assertEqual(client.backoff(10), 3)
+
+    def test_retry_until_success(self):
+        client = HttpClient(max_retries=3, backoff_factor=0)
+        response = client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, "ok")
+        self.assertEqual(FlakyHandler.requests, 3)
+
+    def test_give_up_after_max_retries(self):
+        client = HttpClient(max_retries=1, backoff_factor=0)
+        response = client.get(self.url)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(FlakyHandler.requests, 2)
+
+    def test_session_per_thread(self):
+        client = HttpClient()
+        sessions = []
+
+        def collect():
+            sessions.append(client.session)
+
+        threads = [threading.Thread(target=collect) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIs(client.session, client.session)
+        self.assertIsNot(sessions[0], sessions[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
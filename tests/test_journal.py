@@ -0,0 +1,81 @@
+import unittest
+
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append("..")
+
+from journal import ScrapeJournal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "state" / "journal.sqlite"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume_search(self):
+        journal = ScrapeJournal(self.path)
+        self.assertIsNone(journal.load_search("1girl"))
+
+        journal.record_page("1girl", [{"id": 3}, {"id": 2}], 2)
+        journal.record_page("1girl", [{"id": 1}], "b1")
+        journal.close()
+
+        journal = ScrapeJournal(self.path)
+        state = journal.load_search("1girl")
+
+        self.assertEqual(state.items, [{"id": 3}, {"id": 2}, {"id": 1}])
+        self.assertEqual(state.next_page, "b1")
+        self.assertFalse(state.done)
+
+        journal.record_page("1girl", [], None)
+        state = journal.load_search("1girl")
+
+        self.assertEqual(len(state.items), 3)
+        self.assertIsNone(state.next_page)
+        self.assertTrue(state.done)
+        journal.close()
+
+    def test_save_search(self):
+        journal = ScrapeJournal(self.path)
+        journal.record_page("posts", [{"id": 1}, {"id": 2}], 2)
+        journal.save_search("posts", [{"id": 5}])
+
+        state = journal.load_search("posts")
+        self.assertEqual(state.items, [{"id": 5}])
+        self.assertTrue(state.done)
+        journal.close()
+
+    def test_completed(self):
+        journal = ScrapeJournal(self.path)
+        journal.mark_completed("image", "./output", 1)
+
+        self.assertTrue(journal.is_completed("image", "./output", 1))
+        self.assertFalse(journal.is_completed("caption", "./output", 1))
+        self.assertFalse(journal.is_completed("image", "./other", 1))
+        journal.close()
+
+        journal = ScrapeJournal(self.path)
+        self.assertTrue(journal.is_completed("image", "./output", 1))
+        journal.close()
+
+    def test_clear_searches(self):
+        journal = ScrapeJournal(self.path)
+        journal.record_page("1girl", [{"id": 1}], None)
+        journal.mark_completed("image", "./output", 1)
+        journal.clear_searches()
+        journal.close()
+
+        # 検索は最初からやり直すが、保存済みのファイルの記録は残す
+        journal = ScrapeJournal(self.path)
+        self.assertIsNone(journal.load_search("1girl"))
+        self.assertTrue(journal.is_completed("image", "./output", 1))
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
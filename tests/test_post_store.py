@@ -0,0 +1,306 @@
+import unittest
+
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append("..")
+
+import post_store
+from post_store import PostStore
+from cache_util import (
+    load_search_cache,
+    save_search_cache,
+    save_cache,
+    gc_search_caches,
+    _calc_query_hash,
+)
+from scrape_util import DanbooruPostItem
+from query import SearchKey, plan_query, search_key
+from scrape_config import SearchFilterConfig, SearchResultFilterConfig
+import cache
+from danbooru_post import PostSummary
+
+
+def make_item(post_id: int, score: int = 10) -> DanbooruPostItem:
+    return DanbooruPostItem(
+        post=PostSummary(
+            id=post_id,
+            file_ext="png",
+            file_size=1000,
+            rating="g",
+            score=score,
+            created_at="2024-01-01T00:00:00.000+09:00",
+        ),
+        general_tags=["1girl", "solo"],
+    )
+
+
+def key(query: str, domain: str = "danbooru.donmai.us") -> SearchKey:
+    return SearchKey(domain, query, "")
+
+
+class TestPostStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = PostStore(Path(self.tmp_dir.name) / "posts.sqlite")
+
+    def tearDown(self):
+        self.store.close()
+        post_store.configure(None)
+        self.tmp_dir.cleanup()
+
+    def test_save_and_load(self):
+        items = [make_item(i).dict() for i in [5, 3, 9]]
+        self.store.save(key("1girl"), items)
+
+        self.assertEqual(self.store.load(key("1girl")), items)
+        self.assertIsNone(self.store.load(key("2girls")))
+        self.assertEqual(self.store.get_query(key("1girl")).count, 3)
+
+    def test_posts_stored_once(self):
+        self.store.save(key("a"), [make_item(i).dict() for i in [1, 2, 3]])
+        self.store.save(key("b"), [make_item(i).dict() for i in [3, 2, 4]])
+
+        (count,) = self.store._conn.execute("SELECT COUNT(*) FROM posts").fetchone()
+        self.assertEqual(count, 4)
+        self.assertEqual(
+            [item["post"]["id"] for item in self.store.load(key("b"))], [3, 2, 4]
+        )
+
+    def test_overwrite(self):
+        self.store.save(key("a"), [make_item(i).dict() for i in [1, 2, 3]])
+        self.store.save(key("a"), [make_item(i, score=20).dict() for i in [4, 1]])
+
+        items = self.store.load(key("a"))
+        self.assertEqual([item["post"]["id"] for item in items], [4, 1])
+        self.assertEqual(items[1]["post"]["score"], 20)
+
+    def test_search_cache(self):
+        output_dir = Path(self.tmp_dir.name) / "output"
+        post_store.configure(Path(self.tmp_dir.name) / "store.sqlite")
+
+        save_search_cache(output_dir, key("1girl"), [make_item(1), make_item(2)])
+
+        items = load_search_cache(output_dir, key("1girl"))
+        self.assertEqual([item.post.id for item in items], [1, 2])
+        self.assertFalse((output_dir / "cache").exists())
+
+    def test_legacy_search_cache(self):
+        output_dir = Path(self.tmp_dir.name) / "output"
+        save_cache(output_dir, _calc_query_hash("1girl"), [make_item(7).dict()])
+        post_store.configure(Path(self.tmp_dir.name) / "store.sqlite")
+
+        items = load_search_cache(output_dir, key("1girl"))
+        self.assertEqual([item.post.id for item in items], [7])
+
+        # ストアに移される
+        self.assertFalse(
+            (output_dir / "cache" / f"{_calc_query_hash('1girl')}.json").exists()
+        )
+        self.assertEqual(post_store.get_store().get_query(key("1girl")).count, 1)
+
+    def test_search_cache_limit(self):
+        output_dir = Path(self.tmp_dir.name) / "output"
+        post_store.configure(Path(self.tmp_dir.name) / "store.sqlite")
+
+        save_search_cache(output_dir, key("1girl"), [make_item(i) for i in range(10)])
+        items = load_search_cache(output_dir, key("1girl"), limit=3)
+
+        self.assertEqual([item.post.id for item in items], [0, 1, 2])
+
+    def test_load_limit(self):
+        self.store.save(key("a"), [make_item(i).dict() for i in [5, 4, 3, 2, 1]])
+
+        items = self.store.load(key("a"), limit=2)
+        self.assertEqual([item["post"]["id"] for item in items], [5, 4])
+
+    def test_replace_prefix(self):
+        self.store.save(key("a"), [make_item(i).dict() for i in [5, 4, 3, 2, 1]])
+        self.store.save(
+            key("a"), [make_item(i).dict() for i in [7, 6, 5, 3]], replace_prefix=3
+        )
+
+        items = self.store.load(key("a"))
+        self.assertEqual([item["post"]["id"] for item in items], [7, 6, 5, 3, 2, 1])
+        self.assertEqual(self.store.get_query(key("a")).count, 6)
+
+    def test_item_format(self):
+        item = make_item(1).dict()
+        self.store.save(key("a"), [item])
+
+        (blob,) = self.store._conn.execute("SELECT item FROM posts").fetchone()
+        self.assertIsInstance(blob, bytes)
+        self.assertLess(len(blob), len(json.dumps(item)))
+        self.assertEqual(self.store.load(key("a")), [item])
+
+    def test_ttl(self):
+        self.store.save(key("a"), [make_item(1).dict()])
+        self.store.ttl = 60
+
+        self.assertIsNotNone(self.store.load(key("a")))
+        self.store._conn.execute("UPDATE queries SET updated_at = updated_at - 120")
+        self.assertIsNone(self.store.load(key("a")))
+
+    def test_access_time(self):
+        self.store.save(key("a"), [make_item(1).dict()])
+        self.store.save(key("b"), [make_item(2).dict()])
+        self.store._conn.execute("UPDATE queries SET accessed_at = 0")
+
+        self.store.load(key("a"))
+        self.assertEqual(
+            [entry.key.query for entry in self.store.queries()], ["b", "a"]
+        )
+
+    def test_remove_orphans(self):
+        self.store.save(key("a"), [make_item(i).dict() for i in [1, 2]])
+        self.store.save(key("b"), [make_item(i).dict() for i in [2, 3]])
+        size = self.store.size()
+
+        freed = self.store.remove(self.store.get_query(key("a")).id)
+
+        self.assertGreater(freed, 0)
+        self.assertEqual(self.store.size(), size - freed)
+        self.assertIsNone(self.store.load(key("a")))
+        self.assertEqual(
+            [item["post"]["id"] for item in self.store.load(key("b"))], [2, 3]
+        )
+
+    def test_keys(self):
+        self.store.save(key("1girl"), [make_item(1).dict()])
+        self.store.save(key("1girl", "safebooru.donmai.us"), [make_item(2).dict()])
+        self.store.save(SearchKey("danbooru.donmai.us", "1girl", "f"), [])
+
+        self.assertEqual(
+            [item["post"]["id"] for item in self.store.load(key("1girl"))], [1]
+        )
+        self.assertEqual(
+            self.store.load(key("1girl", "safebooru.donmai.us"))[0]["post"]["id"], 2
+        )
+        self.assertEqual(
+            self.store.load(SearchKey("danbooru.donmai.us", "1girl", "f")), []
+        )
+
+
+# 結果のフィルターを検索クエリに移しても、以前の形式のファイルは移す前のクエリの名前
+class TestLegacyPushDown(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = Path(self.tmp_dir.name) / "output"
+        self.store_path = Path(self.tmp_dir.name) / "store.sqlite"
+        self.result_filter = {
+            "include_any": [],
+            "include_all": [],
+            "exclude_any": ["comic"],
+            "exclude_all": [],
+        }
+        self.plan = plan_query(
+            "1girl",
+            None,
+            SearchFilterConfig(),
+            SearchResultFilterConfig(**self.result_filter),
+            SearchResultFilterConfig(),
+            None,
+        )
+        self.legacy_file = (
+            self.output_dir / "cache" / f"{_calc_query_hash('1girl')}.json"
+        )
+        save_cache(self.output_dir, _calc_query_hash("1girl"), [make_item(7).dict()])
+
+    def tearDown(self):
+        post_store.configure(None)
+        self.tmp_dir.cleanup()
+
+    def test_load(self):
+        self.assertEqual(self.plan.query, "1girl -comic")
+        post_store.configure(self.store_path)
+
+        items = load_search_cache(
+            self.output_dir, search_key("danbooru.donmai.us", self.plan)
+        )
+
+        self.assertEqual([item.post.id for item in items], [7])
+        self.assertFalse(self.legacy_file.exists())
+
+    def test_migrate(self):
+        config_file = Path(self.tmp_dir.name) / "config.json"
+        with open(config_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "subsets": [
+                        {
+                            "query": "1girl",
+                            "output_path": str(self.output_dir),
+                            "limit": 10,
+                            "search_result_filter": self.result_filter,
+                        }
+                    ],
+                    "cache": {"search_result_path": str(self.store_path)},
+                },
+                f,
+            )
+
+        cache.migrate(str(config_file))
+
+        self.assertFalse(self.legacy_file.exists())
+        store = PostStore(self.store_path)
+        entry = store.get_query(search_key("danbooru.donmai.us", self.plan))
+        self.assertEqual(entry.count, 1)
+        store.close()
+
+
+class TestSearchCacheGc(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = PostStore(Path(self.tmp_dir.name) / "posts.sqlite")
+        self.output_dir = Path(self.tmp_dir.name) / "output"
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def test_ttl(self):
+        self.store.save(key("new"), [make_item(1).dict()])
+        self.store.save(key("old"), [make_item(2).dict()])
+        self.store._conn.execute(
+            "UPDATE queries SET updated_at = 0 WHERE query = 'old'"
+        )
+
+        result = gc_search_caches(self.store, [], ttl=60, max_bytes=None)
+
+        self.assertEqual(result.removed, 1)
+        self.assertIsNone(self.store.get_query(key("old")))
+        self.assertIsNotNone(self.store.get_query(key("new")))
+
+    def test_lru(self):
+        for i, query in enumerate(["a", "b", "c"]):
+            self.store.save(key(query), [make_item(i).dict()])
+            self.store._conn.execute(
+                "UPDATE queries SET accessed_at = ? WHERE query = ?", (i, query)
+            )
+
+        # 以前の形式のファイルが一番古い
+        save_cache(self.output_dir, _calc_query_hash("d"), [make_item(3).dict()])
+        legacy_file = self.output_dir / "cache" / f"{_calc_query_hash('d')}.json"
+        os.utime(legacy_file, (-1, time.time()))
+        save_cache(self.output_dir, "download_files", {})
+
+        max_bytes = self.store.size() - 1
+        result = gc_search_caches(
+            self.store, [self.output_dir], ttl=None, max_bytes=max_bytes
+        )
+
+        self.assertEqual(result.removed, 2)
+        self.assertFalse(legacy_file.exists())
+        self.assertTrue((self.output_dir / "cache" / "download_files.json").exists())
+        self.assertEqual(
+            [entry.key.query for entry in self.store.queries()], ["b", "c"]
+        )
+        self.assertLessEqual(result.size, max_bytes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+
+import sys
+
+sys.path.append("..")
+
+from query import (
+    can_refresh,
+    count_query_tags,
+    post_ids_query,
+    since_id_query,
+    estimate_saved_pages,
+    get_tag_limit,
+    plan_query,
+    push_down_result_filter,
+    search_key,
+    to_query_tag,
+)
+from scrape_config import AuthConfig, SearchFilterConfig, SearchResultFilterConfig
+
+
+def result_filter(**kwargs) -> SearchResultFilterConfig:
+    values = {
+        "include_any": [],
+        "include_all": [],
+        "exclude_any": [],
+        "exclude_all": [],
+    }
+    values.update(kwargs)
+    return SearchResultFilterConfig(**values)
+
+
+class TestPushDown(unittest.TestCase):
+    def test_tag_limit(self):
+        self.assertEqual(get_tag_limit(None), 2)
+        self.assertEqual(get_tag_limit(AuthConfig(username="a", api_key="b")), 2)
+        self.assertEqual(
+            get_tag_limit(AuthConfig(username="a", api_key="b", level="gold")), 6
+        )
+
+    def test_count_query_tags(self):
+        self.assertEqual(count_query_tags("1girl order:score rating:g"), 1)
+        self.assertEqual(count_query_tags("1girl score:>=10 -solo ~a ~b"), 5)
+        self.assertEqual(count_query_tags(""), 0)
+
+    def test_to_query_tag(self):
+        kaomoji = frozenset(["^_^"])
+
+        self.assertEqual(
+            to_query_tag("looking at viewer", kaomoji), "looking_at_viewer"
+        )
+        self.assertEqual(to_query_tag("^_^", kaomoji), "^_^")
+        self.assertIsNone(to_query_tag("looking_at_viewer", kaomoji))
+        self.assertIsNone(to_query_tag("rating:e", kaomoji))
+        self.assertIsNone(to_query_tag("-solo", kaomoji))
+
+    def test_exclude_within_budget(self):
+        plan = push_down_result_filter(
+            "1girl order:score",
+            result_filter(exclude_any=["comic", "text only", "monochrome"]),
+            6,
+        )
+
+        self.assertEqual(plan.query, "1girl order:score -comic -text_only -monochrome")
+        self.assertEqual(plan.result_filter.exclude_any, [])
+        self.assertEqual(plan.base_query, "1girl order:score")
+
+    def test_residual(self):
+        plan = push_down_result_filter(
+            "1girl",
+            result_filter(
+                include_all=["solo"],
+                exclude_any=["comic", "text only", "monochrome"],
+                exclude_all=["a", "b"],
+            ),
+            3,
+        )
+
+        self.assertEqual(plan.pushed, ["solo", "-comic"])
+        self.assertEqual(plan.result_filter.include_all, [])
+        self.assertEqual(plan.result_filter.exclude_any, ["text only", "monochrome"])
+        self.assertEqual(plan.result_filter.exclude_all, ["a", "b"])
+        self.assertFalse(plan.result_filter.push_down)
+
+    def test_include_any_all_or_nothing(self):
+        config = result_filter(include_any=["cat ears", "dog ears", "fox ears"])
+
+        plan = push_down_result_filter("1girl", config, 4)
+        self.assertEqual(plan.pushed, ["~cat_ears", "~dog_ears", "~fox_ears"])
+        self.assertEqual(plan.result_filter.include_any, [])
+
+        plan = push_down_result_filter("1girl", config, 3)
+        self.assertEqual(plan.pushed, [])
+        self.assertIs(plan.result_filter, config)
+
+    def test_disabled(self):
+        config = result_filter(exclude_any=["comic"], push_down=False)
+
+        plan = push_down_result_filter("1girl", config, 6)
+
+        self.assertEqual(plan.query, "1girl")
+        self.assertIs(plan.result_filter, config)
+
+    def test_plan_query(self):
+        plan = plan_query(
+            "1girl",
+            None,
+            SearchFilterConfig(),
+            None,
+            result_filter(exclude_any=["comic"]),
+            None,
+        )
+
+        self.assertEqual(plan.query, "1girl -comic")
+
+    def test_reserved_tags(self):
+        auth = AuthConfig(username="a", api_key="b", level="gold")
+        config = result_filter(exclude_any=["comic", "gif", "sketch", "text", "lowres"])
+
+        plan = plan_query("1girl", None, SearchFilterConfig(), config, config, auth)
+        self.assertFalse(can_refresh(plan.query, get_tag_limit(auth)))
+
+        # キャッシュを更新するなら、id: のためにひとつ空けておく
+        plan = plan_query(
+            "1girl", None, SearchFilterConfig(), config, config, auth, reserved_tags=1
+        )
+        self.assertEqual(plan.query, "1girl -comic -gif -sketch -text")
+        self.assertTrue(can_refresh(plan.query, get_tag_limit(auth)))
+
+    def test_search_key(self):
+        pushed = push_down_result_filter(
+            "1girl", result_filter(exclude_any=["comic"]), 6
+        )
+        kept = push_down_result_filter(
+            "1girl", result_filter(exclude_any=["comic"], push_down=False), 6
+        )
+        other = push_down_result_filter("1girl", result_filter(exclude_any=["gif"]), 6)
+
+        # 移す前のクエリとフィルターで決まる
+        self.assertEqual(search_key("danbooru.donmai.us", pushed).query, "1girl")
+        self.assertEqual(pushed.filter_key, kept.filter_key)
+        self.assertNotEqual(pushed.filter_key, other.filter_key)
+        self.assertNotEqual(
+            str(search_key("danbooru.donmai.us", pushed)),
+            str(search_key("safebooru.donmai.us", pushed)),
+        )
+
+    def test_estimate_saved_pages(self):
+        # 10% しか残らない場合、1000 件集めるには 10000 件 (50 ページ) 見る必要がある
+        self.assertEqual(estimate_saved_pages(100_000, 10_000, 1000, 200), 45)
+        self.assertEqual(estimate_saved_pages(100_000, 100_000, 1000, 200), 0)
+        self.assertEqual(estimate_saved_pages(500, 0, 1000, 200), 3)
+        self.assertEqual(estimate_saved_pages(0, 0, 1000, 200), 0)
+
+
+class TestRefresh(unittest.TestCase):
+    def test_can_refresh(self):
+        self.assertTrue(can_refresh("1girl", 2))
+        self.assertTrue(can_refresh("1girl order:id_desc rating:g", 2))
+        self.assertFalse(can_refresh("1girl solo", 2))
+        self.assertFalse(can_refresh("1girl order:score", 6))
+        self.assertFalse(can_refresh("ordfav:someone", 6))
+
+    def test_queries(self):
+        self.assertEqual(since_id_query("1girl", 100), "1girl id:>100")
+        self.assertEqual(post_ids_query("1girl", [3, 2, 1]), "1girl id:3,2,1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import sys
+
+sys.path.append("..")
+
+import rate_limit
+from rate_limit import AdaptiveRateLimiter
+from scrape_config import RateLimitConfig, HostRateLimitConfig
+
+
+class TestRateLimit(unittest.TestCase):
+    def tearDown(self):
+        rate_limit.configure(None)
+
+    def test_burst(self):
+        limiter = AdaptiveRateLimiter(1.0, burst=3)
+
+        self.assertEqual([limiter.reserve() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertGreater(limiter.reserve(), 0.9)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveRateLimiter(8.0, min_rate=1.0, cooldown=0)
+
+        limiter.on_response(429)
+        self.assertEqual(limiter.rate, 4.0)
+        limiter.on_response(503)
+        limiter.on_response(429)
+        limiter.on_response(429)
+        self.assertEqual(limiter.rate, 1.0)
+
+    def test_cooldown(self):
+        limiter = AdaptiveRateLimiter(8.0, cooldown=60)
+
+        limiter.on_response(429)
+        limiter.on_response(429)
+        self.assertEqual(limiter.rate, 4.0)
+
+    def test_additive_increase(self):
+        limiter = AdaptiveRateLimiter(2.0, increase_step=0.5, cooldown=0)
+
+        limiter.on_response(429)
+        limiter.on_response(200)
+        self.assertEqual(limiter.rate, 1.5)
+        limiter.on_response(200)
+        limiter.on_response(200)
+        self.assertEqual(limiter.rate, 2.0)
+
+    def test_shared_per_host(self):
+        rate_limit.configure(
+            RateLimitConfig(
+                requests_per_second=5,
+                hosts={
+                    "cdn.donmai.us": HostRateLimitConfig(requests_per_second=20),
+                    "safebooru.donmai.us": HostRateLimitConfig(),
+                },
+            )
+        )
+
+        limiter = rate_limit.get_limiter("danbooru.donmai.us")
+        self.assertIs(limiter, rate_limit.get_limiter("danbooru.donmai.us"))
+        self.assertEqual(limiter.rate, 5)
+        self.assertEqual(rate_limit.get_limiter("cdn.donmai.us").rate, 20)
+        self.assertIsNone(rate_limit.get_limiter("safebooru.donmai.us"))
+
+    def test_disabled(self):
+        rate_limit.configure(None)
+
+        self.assertIsNone(rate_limit.get_limiter("danbooru.donmai.us"))
+
+
+if __name__ == "__main__":
+    unittest.main()
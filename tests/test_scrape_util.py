@@ -1,12 +1,48 @@
 import unittest
 
 import sys
+import hashlib
+import os
+import json
+import tempfile
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
 sys.path.append("..")
 
 import utils
-from scrape_util import DanbooruScraper, get_posts
-from scrape_config import SearchResultFilterConfig
+from scrape_util import (
+    DanbooruScraper,
+    get_posts,
+    iter_post_pages,
+    resolve_post_urls,
+    download_image,
+    select_download_file,
+    DanbooruPostItem,
+    ScrapeResultCache,
+    compose_captions,
+    save_post_captions,
+    CaptionWriter,
+    filter_page_posts,
+    merge_refreshed_posts,
+    plan_download_tasks,
+    download_post_tasks,
+    drop_completed_tasks,
+)
+from dir_index import DirectoryIndex
+from danbooru_post import DanbooruPost, LazyPost, PostSummary, Rating
+from scrape_config import (
+    SearchResultFilterConfig,
+    DownloadConfig,
+    CaptionConfig,
+    ScrapeSubset,
+)
+from journal import open_journal, close_journals
+from tag_filter import CompiledResultFilter
+from pydantic import ValidationError
 from default_tags import EXCLUSION_TAGS_FILE, SENSITIVE_TAGS_FILE, VIOLENCE_TAGS_FILE
 
 
@@ -60,5 +96,735 @@ class TestScrapeUtil(unittest.TestCase):
             )
 
 
+class FakeScraper:
+    def __init__(self, ids: list[int]) -> None:
+        self.ids = sorted(ids, reverse=True)
+        self.pages = []
+
+    def get_posts(self, query, page=1, limit_per_page=20):
+        self.pages.append(page)
+        if isinstance(page, int):
+            ordered = sorted(self.ids) if "order:id" in query else self.ids
+            ids = ordered[(page - 1) * limit_per_page : page * limit_per_page]
+        elif page.startswith("b"):
+            ids = [id for id in self.ids if id < int(page[1:])][:limit_per_page]
+        else:
+            ids = [id for id in reversed(self.ids) if id > int(page[1:])]
+            ids = list(reversed(ids[:limit_per_page]))
+        return [SimpleNamespace(id=id) for id in ids]
+
+
+class TestPagination(unittest.TestCase):
+    def collect(self, scraper, query, **kwargs):
+        return [
+            post.id
+            for page, _ in iter_post_pages(scraper, query, **kwargs)
+            for post in page
+        ]
+
+    def test_numbered_pages(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(scraper, "1girl", total_limit=20, limit_per_page=10)
+
+        self.assertEqual(ids, list(range(25, 0, -1)))
+        self.assertEqual(scraper.pages, [1, 2, 3, 4])
+
+    def test_switch_to_cursor_after_page_limit(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(
+            scraper, "1girl", total_limit=20, limit_per_page=10, page_limit=2
+        )
+
+        self.assertEqual(ids, list(range(25, 0, -1)))
+        self.assertEqual(scraper.pages, [1, 2, "b6", "b1"])
+
+    def test_cursor_for_large_limit(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(
+            scraper, "1girl", total_limit=100, limit_per_page=10, page_limit=2
+        )
+
+        self.assertEqual(ids, list(range(25, 0, -1)))
+        self.assertEqual(scraper.pages, [1, "b16", "b6", "b1"])
+
+    def test_ascending_cursor(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(
+            scraper, "1girl order:id", pagination="cursor", limit_per_page=10
+        )
+
+        self.assertEqual(ids, list(range(1, 26)))
+        self.assertEqual(scraper.pages, [1, "a10", "a20", "a25"])
+
+    def test_resume_from_page(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(
+            scraper, "1girl", total_limit=20, limit_per_page=10, start_page="b16"
+        )
+
+        self.assertEqual(ids, list(range(15, 0, -1)))
+        self.assertEqual(scraper.pages, ["b16", "b6", "b1"])
+
+    def test_prefetch(self):
+        for kwargs in [
+            {"total_limit": 20},
+            {"total_limit": 20, "page_limit": 2},
+            {"total_limit": 100, "page_limit": 2},
+        ]:
+            scraper = FakeScraper(list(range(1, 26)))
+            ids = self.collect(
+                scraper, "1girl", limit_per_page=10, prefetch=3, **kwargs
+            )
+
+            self.assertEqual(ids, list(range(25, 0, -1)))
+
+    def test_prefetch_stops_when_closed(self):
+        scraper = FakeScraper(list(range(1, 1001)))
+        pages = iter_post_pages(scraper, "1girl", limit_per_page=10, prefetch=2)
+
+        first, next_page = next(pages)
+        pages.close()
+
+        self.assertEqual(len(first), 10)
+        self.assertEqual(next_page, 2)
+        self.assertLessEqual(len(scraper.pages), 3)
+
+    def test_no_cursor_for_custom_order(self):
+        scraper = FakeScraper(list(range(1, 26)))
+        ids = self.collect(
+            scraper, "1girl order:score", limit_per_page=10, page_limit=2
+        )
+
+        self.assertEqual(len(ids), 20)
+        self.assertEqual(scraper.pages, [1, 2])
+
+
+class TestResolvePostUrls(unittest.TestCase):
+    def test_resolve_in_input_order(self):
+        requested = []
+
+        def get_posts_by_ids(scraper, post_ids):
+            requested.append((scraper.domain, list(post_ids)))
+            # 存在しない投稿 (3) は返らない
+            return [
+                SimpleNamespace(id=post_id)
+                for post_id in reversed(post_ids)
+                if post_id != 3
+            ]
+
+        urls = [
+            "https://danbooru.donmai.us/posts/5",
+            "https://safebooru.donmai.us/posts/2",
+            "https://danbooru.donmai.us/posts/3",
+            "https://danbooru.donmai.us/posts/1",
+            "https://danbooru.donmai.us/posts/5",
+        ]
+
+        with mock.patch.object(
+            DanbooruScraper, "get_posts_by_ids", get_posts_by_ids
+        ), mock.patch("scrape_util.DanbooruPostItem.new", lambda post: post):
+            items = resolve_post_urls(urls, None, max_workers=2)
+
+        self.assertEqual([item.id for item in items], [5, 2, 1, 5])
+        self.assertEqual(
+            sorted(requested),
+            [("danbooru.donmai.us", [5, 3, 1]), ("safebooru.donmai.us", [2])],
+        )
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    body = b"image" * 1000
+    requests = 0
+
+    def do_GET(self):
+        ImageHandler.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadImage(unittest.TestCase):
+    def setUp(self):
+        ImageHandler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/image.png"
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_download_verified(self):
+        download_image(
+            self.url,
+            self.tmp_dir.name,
+            "1",
+            "png",
+            {},
+            md5=hashlib.md5(ImageHandler.body).hexdigest(),
+            file_size=len(ImageHandler.body),
+        )
+
+        output_path = Path(self.tmp_dir.name) / "1.png"
+        self.assertEqual(output_path.read_bytes(), ImageHandler.body)
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [output_path])
+
+    def test_download_mismatch(self):
+        with self.assertRaises(Exception):
+            download_image(
+                self.url,
+                self.tmp_dir.name,
+                "1",
+                "png",
+                {},
+                md5="0" * 32,
+                max_attempts=2,
+            )
+
+        # 壊れたファイルは残さない
+        self.assertEqual(list(Path(self.tmp_dir.name).iterdir()), [])
+        self.assertEqual(ImageHandler.requests, 2)
+
+
+class TestDownloadTasks(unittest.TestCase):
+    def setUp(self):
+        ImageHandler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        close_journals()
+        self.tmp_dir.cleanup()
+
+    def make_cache(self, name: str, post_ids: list[int]) -> ScrapeResultCache:
+        items = [
+            DanbooruPostItem(
+                post=make_summary(
+                    id=post_id,
+                    md5=f"{post_id:032x}",
+                    file_url=f"{self.url}/{post_id}.png",
+                )
+            )
+            for post_id in post_ids
+        ]
+        return ScrapeResultCache(
+            items,
+            SimpleNamespace(
+                output_path=str(Path(self.tmp_dir.name) / name),
+                save_state_path=str(Path(self.tmp_dir.name) / "state.sqlite"),
+                caption=None,
+            ),
+        )
+
+    def test_plan_download_tasks(self):
+        a = self.make_cache("a", [1, 2, 3])
+        b = self.make_cache("b", [2, 3, 4])
+
+        tasks = plan_download_tasks(a.items + b.items, [a] * 3 + [b] * 3)
+
+        self.assertEqual(
+            [[item.post.id for item, _ in task.targets] for task in tasks],
+            [[1], [2, 2], [3, 3], [4]],
+        )
+
+    def test_download_once(self):
+        a = self.make_cache("a", [1, 2])
+        b = self.make_cache("b", [2, 3])
+        tasks = plan_download_tasks(a.items + b.items, [a, a, b, b])
+
+        download_post_tasks(tasks, None, mock.Mock(), DownloadConfig(verify=False))
+
+        self.assertEqual(ImageHandler.requests, 3)
+
+        a_path = Path(a.output_path) / "2.png"
+        b_path = Path(b.output_path) / "2.png"
+        self.assertEqual(b_path.read_bytes(), ImageHandler.body)
+        self.assertTrue(a_path.samefile(b_path))
+
+        journal = open_journal(a.save_state_path)
+        self.assertTrue(journal.is_completed("image", b.output_path, 2))
+
+    def test_drop_completed_tasks(self):
+        a = self.make_cache("a", [1, 2])
+        b = self.make_cache("b", [2])
+        Path(a.output_path).mkdir(parents=True)
+        Path(b.output_path).mkdir(parents=True)
+        (Path(a.output_path) / "1.png").write_bytes(ImageHandler.body)
+        (Path(a.output_path) / "2.png").write_bytes(ImageHandler.body)
+
+        tasks = drop_completed_tasks(
+            plan_download_tasks(a.items + b.items, [a, a, b]), DirectoryIndex()
+        )
+
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(
+            [item.post.id for item, _ in tasks[0].pending_targets()], [2, 2]
+        )
+
+    def test_failures_do_not_stop_queue(self):
+        a = self.make_cache("a", [1, 2, 3, 4])
+        tasks = plan_download_tasks(a.items, [a] * 4)
+        done = []
+
+        def download(task, *args):
+            item, _ = task.targets[0]
+            if item.post.id == 2:
+                raise Exception("broken")
+            done.append(item.post.id)
+
+        pbar = mock.Mock()
+        with mock.patch("scrape_util.download_post_task", side_effect=download):
+            failures = download_post_tasks(
+                tasks, None, pbar, DownloadConfig(), max_workers=3
+            )
+
+        self.assertEqual(sorted(done), [1, 3, 4])
+        self.assertEqual(len(failures), 1)
+        self.assertIs(failures[0][0], tasks[1])
+        self.assertEqual(str(failures[0][1]), "broken")
+        self.assertEqual(pbar.update.call_count, 4)
+
+    def test_link_from_saved_file(self):
+        a = self.make_cache("a", [1])
+        b = self.make_cache("b", [1])
+
+        download_post_tasks(
+            plan_download_tasks(a.items, [a]),
+            None,
+            mock.Mock(),
+            DownloadConfig(verify=False),
+        )
+        download_post_tasks(
+            plan_download_tasks(a.items + b.items, [a, b]),
+            None,
+            mock.Mock(),
+            DownloadConfig(verify=False),
+        )
+
+        self.assertEqual(ImageHandler.requests, 1)
+        self.assertTrue((Path(b.output_path) / "1.png").exists())
+
+    def test_blob_store(self):
+        store_path = Path(self.tmp_dir.name) / "store"
+        config = DownloadConfig(verify=False, store_path=str(store_path))
+        a = self.make_cache("a", [1])
+
+        download_post_tasks(
+            plan_download_tasks(a.items, [a]), None, mock.Mock(), config
+        )
+
+        md5 = f"{1:032x}"
+        blob_path = store_path / md5[:2] / md5[2:4] / f"{md5}.png"
+        self.assertTrue(blob_path.samefile(Path(a.output_path) / "1.png"))
+
+        # 別の出力先を作り直してもダウンロードしない
+        b = self.make_cache("b", [1])
+        download_post_tasks(
+            plan_download_tasks(b.items, [b]), None, mock.Mock(), config
+        )
+
+        self.assertEqual(ImageHandler.requests, 1)
+        self.assertTrue(blob_path.samefile(Path(b.output_path) / "1.png"))
+
+    def test_index_avoids_stat(self):
+        store_path = Path(self.tmp_dir.name) / "store"
+        config = DownloadConfig(verify=False, store_path=str(store_path))
+        a = self.make_cache("a", [1, 2])
+        b = self.make_cache("b", [2])
+
+        # 存在の確認はすべてディレクトリの一覧から行う
+        with mock.patch.object(Path, "exists", side_effect=AssertionError):
+            failures = download_post_tasks(
+                plan_download_tasks(a.items + b.items, [a, a, b]),
+                None,
+                mock.Mock(),
+                config,
+                DirectoryIndex(),
+            )
+
+        self.assertEqual(failures, [])
+        self.assertEqual(ImageHandler.requests, 2)
+        self.assertTrue((Path(b.output_path) / "2.png").exists())
+
+    def test_blob_store_adopts_saved_file(self):
+        a = self.make_cache("a", [1])
+        download_post_tasks(
+            plan_download_tasks(a.items, [a]),
+            None,
+            mock.Mock(),
+            DownloadConfig(verify=False),
+        )
+
+        store_path = Path(self.tmp_dir.name) / "store"
+        b = self.make_cache("b", [1])
+        download_post_tasks(
+            plan_download_tasks(a.items + b.items, [a, b]),
+            None,
+            mock.Mock(),
+            DownloadConfig(verify=False, store_path=str(store_path)),
+        )
+
+        self.assertEqual(ImageHandler.requests, 1)
+        self.assertEqual(len(list(store_path.rglob("*.png"))), 1)
+
+    def test_copy_fallback(self):
+        a = self.make_cache("a", [1])
+        b = self.make_cache("b", [1])
+
+        with mock.patch("os.link", side_effect=OSError("cross-device link")):
+            download_post_tasks(
+                plan_download_tasks(a.items + b.items, [a, b]),
+                None,
+                mock.Mock(),
+                DownloadConfig(verify=False),
+            )
+
+        b_path = Path(b.output_path) / "1.png"
+        self.assertEqual(b_path.read_bytes(), ImageHandler.body)
+        self.assertFalse(b_path.samefile(Path(a.output_path) / "1.png"))
+
+
+def make_post(**kwargs) -> DanbooruPost:
+    values = {
+        "id": 1,
+        "created_at": "2024-01-01T00:00:00.000+09:00",
+        "uploader_id": 1,
+        "score": 10,
+        "source": "",
+        "rating": "g",
+        "image_width": 4000,
+        "image_height": 6000,
+        "tag_string": "1girl solo",
+        "fav_count": 0,
+        "file_ext": "png",
+        "has_children": False,
+        "tag_count_general": 2,
+        "tag_count_artist": 0,
+        "tag_count_character": 0,
+        "tag_count_copyright": 0,
+        "file_size": 1000,
+        "up_score": 10,
+        "down_score": 0,
+        "is_pending": False,
+        "is_flagged": False,
+        "is_deleted": False,
+        "tag_count": 2,
+        "updated_at": "2024-01-01T00:00:00.000+09:00",
+        "is_banned": False,
+        "has_active_children": False,
+        "bit_flags": 0,
+        "tag_count_meta": 0,
+        "has_large": True,
+        "has_visible_children": False,
+        "media_asset": {
+            "id": 1,
+            "created_at": "2024-01-01T00:00:00.000+09:00",
+            "updated_at": "2024-01-01T00:00:00.000+09:00",
+            "md5": "abc",
+            "file_ext": "png",
+            "file_size": 1000,
+            "image_width": 4000,
+            "image_height": 6000,
+            "status": "active",
+            "is_public": True,
+            "pixel_hash": "",
+            "variants": [
+                {
+                    "type": "360x360",
+                    "url": "https://cdn/360.jpg",
+                    "width": 240,
+                    "height": 360,
+                    "file_ext": "jpg",
+                },
+                {
+                    "type": "720x720",
+                    "url": "https://cdn/720.webp",
+                    "width": 480,
+                    "height": 720,
+                    "file_ext": "webp",
+                },
+                {
+                    "type": "sample",
+                    "url": "https://cdn/sample.jpg",
+                    "width": 850,
+                    "height": 1275,
+                    "file_ext": "jpg",
+                },
+                {
+                    "type": "original",
+                    "url": "https://cdn/original.png",
+                    "width": 4000,
+                    "height": 6000,
+                    "file_ext": "png",
+                },
+            ],
+        },
+        "tag_string_general": "1girl solo",
+        "tag_string_character": "",
+        "tag_string_copyright": "",
+        "tag_string_artist": "",
+        "tag_string_meta": "",
+        "md5": "abc",
+        "file_url": "https://cdn/original.png",
+        "large_file_url": "https://cdn/sample.jpg",
+    }
+    values.update(kwargs)
+    return DanbooruPost(**values)
+
+
+def make_summary(**kwargs) -> PostSummary:
+    return PostSummary.from_post(make_post(**kwargs))
+
+
+class TestDanbooruPostItem(unittest.TestCase):
+    def test_new(self):
+        item = DanbooruPostItem.new(make_post())
+
+        self.assertEqual(item.post.id, 1)
+        self.assertEqual(item.post.rating, Rating.GENERAL)
+        self.assertEqual(item.general_tags, ["1girl", "solo"])
+        self.assertEqual(len(item.post.variants), 4)
+
+    def test_shared_vocabulary(self):
+        a = DanbooruPostItem.new(make_post(id=1))
+        b = DanbooruPostItem.new(make_post(id=2))
+
+        self.assertEqual(a._general_tags, b._general_tags)
+        self.assertIs(a.general_tags[0], b.general_tags[0])
+
+    def test_assign_tags(self):
+        item = DanbooruPostItem.new(make_post())
+
+        item.general_tags = ["solo"]
+        item.rating_tags = ["sensitive"]
+
+        self.assertEqual(item.general_tags, ["solo"])
+        self.assertEqual(item.rating_tags, ["sensitive"])
+
+    def test_dict_roundtrip(self):
+        item = DanbooruPostItem.new(make_post())
+        item.quality_tags = ["best quality"]
+
+        data = json.loads(json.dumps(item.dict()))
+        loaded = DanbooruPostItem(**data)
+
+        self.assertEqual(loaded.dict(), item.dict())
+        self.assertNotIn("media_asset", data["post"])
+
+    def test_legacy_cache(self):
+        # 以前は DanbooruPost をそのまま保存していた
+        data = {
+            "post": json.loads(make_post().json()),
+            "general_tags": ["1girl", "solo"],
+            "download_file": None,
+        }
+        item = DanbooruPostItem(**data)
+
+        self.assertEqual(item.post.file_url, "https://cdn/original.png")
+        self.assertEqual(item.post.variants[0].type, "360x360")
+        self.assertEqual(item.general_tags, ["1girl", "solo"])
+
+
+class TestCaptions(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        close_journals()
+        self.tmp_dir.cleanup()
+
+    def make_item(self, post_id: int = 1) -> DanbooruPostItem:
+        return DanbooruPostItem(
+            post=make_summary(id=post_id),
+            artist_tags=["artist"],
+            character_tags=["character"],
+            copyright_tags=["copyright"],
+            general_tags=["solo", "1girl", ""],
+            meta_tags=[],
+            quality_tags=["best quality"],
+            rating_tags=["sensitive"],
+        )
+
+    def test_compose_captions(self):
+        items = [self.make_item()]
+
+        self.assertEqual(
+            compose_captions(items),
+            ["sensitive, best quality, artist, character, solo, 1girl"],
+        )
+        self.assertEqual(
+            compose_captions(items, " | ", "naidv3"),
+            [
+                "1girl | artist | character | copyright | solo | best quality | sensitive"
+            ],
+        )
+        self.assertEqual(
+            compose_captions(items, ", ", "animaginexlv3"),
+            ["1girl, character, copyright, solo, best quality, sensitive"],
+        )
+        self.assertEqual(items[0].compose_tags(), compose_captions(items)[0])
+
+    def test_save_post_captions(self):
+        output_dir = Path(self.tmp_dir.name) / "out" / "nested"
+        state_path = Path(self.tmp_dir.name) / "state.sqlite"
+        cache = ScrapeResultCache(
+            [self.make_item(i) for i in range(1, 4)],
+            ScrapeSubset(output_path=str(output_dir), save_state_path=str(state_path)),
+        )
+        open_journal(state_path).mark_completed("caption", str(output_dir), 3)
+
+        save_post_captions(cache.items, [cache] * len(cache.items), CaptionConfig())
+
+        self.assertEqual(
+            sorted(path.name for path in output_dir.iterdir()), ["1.txt", "2.txt"]
+        )
+        self.assertEqual(
+            (output_dir / "1.txt").read_text(encoding="utf-8"),
+            "sensitive, best quality, artist, character, solo, 1girl",
+        )
+        self.assertTrue(
+            open_journal(state_path).is_completed("caption", str(output_dir), 2)
+        )
+
+
+    def test_writer_index(self):
+        output_dir = str(Path(self.tmp_dir.name) / "out")
+        index = DirectoryIndex()
+        index.ensure_dir(output_dir)
+        self.assertFalse(index.exists(os.path.join(output_dir, "1.txt")))
+
+        # 書き込めなかったものは登録しない
+        writer = CaptionWriter(index=index)
+        with mock.patch("scrape_util.open", side_effect=OSError, create=True):
+            writer.write("caption", output_dir, "1", "txt", True)
+            with self.assertRaises(OSError):
+                writer.close()
+        self.assertFalse(index.exists(os.path.join(output_dir, "1.txt")))
+
+        with CaptionWriter(index=index) as writer:
+            writer.write("caption", output_dir, "2", "txt", True)
+        self.assertTrue(index.exists(os.path.join(output_dir, "2.txt")))
+
+class TestLazyPost(unittest.TestCase):
+    def make_data(self, **kwargs) -> dict:
+        data = json.loads(make_post(**kwargs).json(exclude_none=True))
+        return data
+
+    def test_fields(self):
+        post = LazyPost(self.make_data())
+
+        self.assertEqual(post.id, 1)
+        self.assertEqual(post.rating, Rating.GENERAL)
+        self.assertEqual(post.file_ext, "png")
+        self.assertIsNone(post.parent_id)
+        self.assertEqual(post.media_asset.variants[0].type, "360x360")
+        with self.assertRaises(AttributeError):
+            post.unknown_field
+
+    def test_same_item(self):
+        data = self.make_data()
+
+        self.assertEqual(
+            DanbooruPostItem.new(LazyPost(data)).dict(),
+            DanbooruPostItem.new(DanbooruPost(**data)).dict(),
+        )
+
+    def test_validate_only_survivors(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(exclude_any=["comic"])
+        )
+        valid = self.make_data(id=1)
+        filtered = self.make_data(id=2, tag_string_general="comic")
+        del filtered["uploader_id"]
+
+        items = filter_page_posts([LazyPost(valid), LazyPost(filtered)], result_filter)
+        self.assertEqual([item.post.id for item in items], [1])
+        self.assertEqual(
+            items[0].dict(),
+            filter_page_posts([DanbooruPost(**valid)], result_filter)[0].dict(),
+        )
+
+        invalid = self.make_data(id=3)
+        del invalid["uploader_id"]
+        with self.assertRaises(ValidationError):
+            filter_page_posts([LazyPost(invalid)], result_filter)
+
+
+class TestMergeRefreshedPosts(unittest.TestCase):
+    def items(self, ids: list[int], score: int = 10) -> list[DanbooruPostItem]:
+        return [DanbooruPostItem(post=make_summary(id=id, score=score)) for id in ids]
+
+    def ids(self, items: list[DanbooruPostItem]) -> list[int]:
+        return [item.post.id for item in items]
+
+    def test_prepend_new_posts(self):
+        posts = merge_refreshed_posts(
+            self.items([5, 4, 3]), self.items([8, 6]), [], set(), 4
+        )
+
+        self.assertEqual(self.ids(posts), [8, 6, 5, 4])
+
+    def test_rechecked(self):
+        posts = merge_refreshed_posts(
+            self.items([5, 4, 3]), [], self.items([5], score=99), {5, 4}, 10
+        )
+
+        self.assertEqual(self.ids(posts), [5, 3])
+        self.assertEqual(posts[0].post.score, 99)
+
+
+class TestSelectDownloadFile(unittest.TestCase):
+    def test_original(self):
+        file = select_download_file(make_summary(), DownloadConfig())
+
+        self.assertEqual(file.type, "original")
+        self.assertEqual(file.md5, "abc")
+
+    def test_smallest_variant(self):
+        file = select_download_file(
+            make_summary(), DownloadConfig(variant="smallest", min_side=700)
+        )
+
+        self.assertEqual(file.type, "sample")
+        self.assertEqual(file.url, "https://cdn/sample.jpg")
+        self.assertEqual(file.file_ext, "jpg")
+        self.assertIsNone(file.md5)
+
+        file = select_download_file(
+            make_summary(), DownloadConfig(variant="smallest", min_pixels=300_000)
+        )
+        self.assertEqual(file.type, "720x720")
+
+    def test_smallest_requires_target(self):
+        with self.assertRaises(ValidationError):
+            DownloadConfig(variant="smallest")
+
+    def test_fallback_to_original(self):
+        file = select_download_file(
+            make_summary(), DownloadConfig(variant="smallest", min_side=2000)
+        )
+
+        self.assertEqual(file.type, "original")
+        self.assertEqual(file.file_size, 1000)
+
+    def test_no_variants_for_video(self):
+        file = select_download_file(
+            make_summary(file_ext="mp4", file_url="https://cdn/original.mp4"),
+            DownloadConfig(variant="smallest", min_side=100),
+        )
+
+        self.assertEqual(file.url, "https://cdn/original.mp4")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+import sys
+import os
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.append("..")
+
+from tag_filter import CompiledResultFilter, compile_result_filter
+from tag_lists import REGISTRY
+from scrape_config import SearchResultFilterConfig
+
+
+def make_item(*general_tags: str, meta_tags: list[str] = []):
+    return SimpleNamespace(
+        artist_tags=["artist"],
+        copyright_tags=[],
+        character_tags=[],
+        general_tags=list(general_tags),
+        meta_tags=meta_tags,
+    )
+
+
+class TestTagFilter(unittest.TestCase):
+    def test_include_any(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(include_any=["solo", "1girl"], exclude_any=[])
+        )
+
+        self.assertTrue(result_filter.match(make_item("solo", "smile")))
+        self.assertFalse(result_filter.match(make_item("2girls")))
+
+    def test_include_all(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(include_all=["solo", "1girl"], exclude_any=[])
+        )
+
+        self.assertTrue(result_filter.match(make_item("solo", "1girl", "smile")))
+        self.assertFalse(result_filter.match(make_item("solo", "smile")))
+
+    def test_exclude_any(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(exclude_any=["2girls", "comic"])
+        )
+
+        self.assertTrue(result_filter.match(make_item("solo")))
+        self.assertFalse(result_filter.match(make_item("solo", meta_tags=["comic"])))
+
+    def test_exclude_all(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(
+                exclude_all=["monochrome", "comic"], exclude_any=[]
+            )
+        )
+
+        self.assertTrue(result_filter.match(make_item("monochrome")))
+        self.assertFalse(result_filter.match(make_item("monochrome", "comic")))
+
+    def test_file_path(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "exclusion.txt"
+            path.write_text("2girls\n3girls\n", encoding="utf-8")
+
+            result_filter = CompiledResultFilter(
+                SearchResultFilterConfig(exclude_any=str(path))
+            )
+
+        self.assertEqual(result_filter.exclude_any, frozenset(["2girls", "3girls"]))
+        self.assertFalse(result_filter.match(make_item("3girls")))
+
+    def test_single_tag_string(self):
+        result_filter = CompiledResultFilter(
+            SearchResultFilterConfig(include_any="solo", exclude_any=[])
+        )
+
+        self.assertTrue(result_filter.match(make_item("solo")))
+        self.assertFalse(result_filter.match(make_item("s", "o", "l")))
+
+    def test_compile_reloads_tag_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "exclude.txt"
+            path.write_text("solo\n")
+            config = SearchResultFilterConfig(exclude_any=str(path))
+
+            self.assertFalse(compile_result_filter(config).match(make_item("solo")))
+
+            path.write_text("1girl\n")
+            os.utime(path, (0, path.stat().st_mtime + 10))
+
+            with mock.patch.object(REGISTRY, "check_interval", 0):
+                self.assertTrue(compile_result_filter(config).match(make_item("solo")))
+
+
+if __name__ == "__main__":
+    unittest.main()
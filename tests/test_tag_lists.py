@@ -0,0 +1,76 @@
+import unittest
+
+import sys
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+sys.path.append("..")
+
+import tag_lists
+from tag_lists import TagListRegistry, resolve_tags, resolve_tag_set
+
+
+class TestTagLists(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "tags.txt"
+        self.path.write_text("b\na\n\nc\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_load_once(self):
+        registry = TagListRegistry()
+
+        with mock.patch(
+            "utils.load_file_lines", wraps=tag_lists.utils.load_file_lines
+        ) as load:
+            entry = registry.get(self.path)
+            self.assertIs(registry.get(self.path), entry)
+            self.assertEqual(load.call_count, 1)
+
+        self.assertEqual(entry.tags, frozenset(["a", "b", "c"]))
+        self.assertEqual(entry.ordered, ("b", "a", "c"))
+
+    def test_reload_on_mtime_change(self):
+        registry = TagListRegistry(check_interval=0)
+        entry = registry.get(self.path)
+
+        self.assertIs(registry.get(self.path), entry)
+
+        self.path.write_text("d\n")
+        os.utime(self.path, (0, entry.mtime + 10))
+
+        self.assertEqual(registry.get(self.path).ordered, ("d",))
+
+    def test_generation(self):
+        registry = TagListRegistry(check_interval=0)
+        entry = registry.get(self.path)
+        registry.get(Path(self.tmp_dir.name) / "other.txt")
+        generation = registry.generation()
+
+        self.assertEqual(registry.generation(), generation)
+
+        self.path.write_text("d\n")
+        os.utime(self.path, (0, entry.mtime + 10))
+
+        # 読み込み済みのファイルは get しなくても確認される
+        self.assertGreater(registry.generation(), generation)
+
+    def test_not_a_file(self):
+        registry = TagListRegistry()
+
+        self.assertIsNone(registry.get(Path(self.tmp_dir.name) / "missing.txt"))
+        self.assertIsNone(registry.get(self.tmp_dir.name))
+
+    def test_resolve(self):
+        self.assertEqual(resolve_tags(str(self.path)), ["b", "a", "c"])
+        self.assertEqual(resolve_tags("1girl"), ["1girl"])
+        self.assertEqual(resolve_tag_set(["a", "a"]), frozenset(["a"]))
+        self.assertEqual(resolve_tag_set("1girl"), frozenset(["1girl"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,378 @@
+import unittest
+
+import sys
+import os
+import random
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+sys.path.append("..")
+
+from tags import (
+    INSERT_POSITION,
+    CompiledPostProcess,
+    compile_caption_config,
+    do_all_caption_post_process,
+)
+from tag_lists import REGISTRY
+import utils
+from scrape_util import DanbooruPostItem
+from danbooru_post import PostSummary, Rating
+from scrape_config import (
+    CaptionConfig,
+    CaptionPostProcessConfig,
+    DeleteConfig,
+    InsertConfig,
+    KeepConfig,
+    QualityTagConfig,
+    RatingTagConfig,
+    ReplaceConfig,
+)
+
+VOCABULARY = [f"tag_{i}" for i in range(30)]
+
+
+# ここから以前の tags.py の実装をそのまま写したもの (コンパイルしたものと結果を比べる)
+# (do_all_caption_post_process だけ名前を変えている)
+def normalize_tags(tags: str | list[str]) -> list[str]:
+    if isinstance(tags, str):
+        if os.path.isfile(tags):
+            return utils.load_file_lines(tags)
+        else:
+            return [tags]
+    else:
+        return tags
+
+
+def is_nsfw(
+    tags: list[str],
+    nsfw_tags: str | list[str] | None,
+) -> bool:
+    if nsfw_tags is None:
+        return False
+    return any(tag in normalize_tags(nsfw_tags) for tag in tags)
+
+
+def process_replace(
+    original: list[str], _from: str | list[str] | None, to: str
+) -> list[str]:
+    if _from is None:
+        return original
+
+    for i, tag in enumerate(original):
+        for f in normalize_tags(_from):
+            if tag == f:
+                original[i] = to
+                break
+
+    return original
+
+
+def process_keep(original: list[str], keep: str | list[str] | None) -> list[str]:
+    if keep is None:
+        return original
+
+    new_tags = []
+
+    for tag in original:
+        if tag in normalize_tags(keep):
+            new_tags.append(tag)
+
+    return new_tags
+
+
+def process_delete(original: list[str], delete: str | list[str] | None) -> list[str]:
+    if delete is None:
+        return original
+
+    new_tags = []
+
+    for tag in original:
+        if tag not in normalize_tags(delete):
+            new_tags.append(tag)
+
+    return new_tags
+
+
+def process_insert(
+    original: list[str], insert: str | list[str] | None, position: INSERT_POSITION
+) -> list[str]:
+    if insert is None:
+        return original
+
+    insert = normalize_tags(insert)
+
+    if position == "start":
+        return insert + original
+    elif position == "end":
+        return original + insert
+    else:
+        raise Exception("Invalid position: " + position)
+
+
+def do_caption_post_process(
+    original: list[str], config: CaptionPostProcessConfig | bool
+) -> list[str]:
+    tags = original
+
+    if isinstance(config, bool):
+        if config:
+            return tags
+        else:
+            return []
+
+    for replace in config.replaces:
+        tags = process_replace(tags, replace.tags, replace.to)
+
+    for keep in config.keeps:
+        tags = process_keep(tags, keep.tags)
+
+    for delete in config.deletes:
+        tags = process_delete(tags, delete.tags)
+
+    for insert in config.inserts:
+        tags = process_insert(tags, insert.tags, insert.position)
+
+    return tags
+
+
+def legacy_all_caption_post_process(
+    item: DanbooruPostItem, config: bool | CaptionConfig
+):
+    if isinstance(config, bool):
+        if not config:
+            return item
+        else:
+            config = CaptionConfig()
+
+    item.rating_tags = create_rating_tag(item.general_tags, item, config.rating)
+    item.quality_tags = create_quality_tag(item, config.quality)
+
+    item.artist_tags = do_caption_post_process(item.artist_tags, config.artist)
+    item.copyright_tags = do_caption_post_process(item.copyright_tags, config.copyright)
+    item.character_tags = do_caption_post_process(item.character_tags, config.character)
+    item.general_tags = do_caption_post_process(item.general_tags, config.general)
+    item.meta_tags = do_caption_post_process(item.meta_tags, config.meta)
+
+    # 共通の処理
+    if config.common is not None:
+        item.artist_tags = do_caption_post_process(item.artist_tags, config.common)
+        item.copyright_tags = do_caption_post_process(
+            item.copyright_tags, config.common
+        )
+        item.character_tags = do_caption_post_process(
+            item.character_tags, config.common
+        )
+        item.general_tags = do_caption_post_process(item.general_tags, config.common)
+        item.meta_tags = do_caption_post_process(item.meta_tags, config.common)
+
+    return item
+
+
+def create_rating_tag(
+    original: list[str], post_item: DanbooruPostItem, config: bool | RatingTagConfig
+) -> list[str]:
+    if isinstance(config, bool):
+        if not config:  # false
+            return []
+        else:  # true
+            config = RatingTagConfig()  # デフォルト設定
+
+    if config.type == "none":
+        return []
+
+    elif config.type == "by_tag":
+        if is_nsfw(original, config.nsfw_tags):
+            return (
+                normalize_tags(config.insert_tags)
+                if config.insert_tags is not None
+                else []
+            )
+        else:
+            return []
+
+    elif config.type == "by_rating":
+        if post_item.post.rating == Rating.EXPLICIT:
+            return (
+                normalize_tags(config.explicit) if config.explicit is not None else []
+            )
+        elif post_item.post.rating == Rating.SENSITIVE:
+            return (
+                normalize_tags(config.sensitive) if config.sensitive is not None else []
+            )
+        elif post_item.post.rating == Rating.QUESTIONABLE:
+            return (
+                normalize_tags(config.questionable)
+                if config.questionable is not None
+                else []
+            )
+        elif post_item.post.rating == Rating.GENERAL:
+            return normalize_tags(config.general) if config.general is not None else []
+        else:
+            raise Exception("Invalid rating: " + post_item.post.rating)
+
+    raise Exception(f"Unexpected config type: {config.type}")
+
+
+def create_quality_tag(
+    post_item: DanbooruPostItem, config: QualityTagConfig | None
+) -> list[str]:
+    if config is None:
+        return []
+
+    tags = []
+
+    for quality_tag, score in config.items():
+        if post_item.post.score >= score:
+            tags.append(quality_tag)
+            break
+
+    return tags
+
+
+def make_item(rng: random.Random) -> DanbooruPostItem:
+    return DanbooruPostItem(
+        post=PostSummary(
+            id=rng.randrange(1000),
+            file_ext="png",
+            file_size=1000,
+            rating=rng.choice(["g", "s", "q", "e"]),
+            score=rng.randrange(100),
+        ),
+        artist_tags=rng.sample(VOCABULARY, 1),
+        character_tags=rng.sample(VOCABULARY, 2),
+        copyright_tags=rng.sample(VOCABULARY, 1),
+        general_tags=rng.sample(VOCABULARY, 10),
+        meta_tags=rng.sample(VOCABULARY, 2),
+    )
+
+
+class TestCaptionPostProcess(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tag_file = Path(self.tmp_dir.name) / "tags.txt"
+        self.tag_file.write_text("\n".join(VOCABULARY[:10]))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def random_tags(self, rng: random.Random) -> str | list[str]:
+        if rng.random() < 0.2:
+            return str(self.tag_file)
+        if rng.random() < 0.2:
+            return rng.choice(VOCABULARY)
+        return rng.sample(VOCABULARY, rng.randrange(1, 15))
+
+    def random_config(self, rng: random.Random) -> CaptionPostProcessConfig | bool:
+        if rng.random() < 0.1:
+            return rng.random() < 0.5
+
+        return CaptionPostProcessConfig(
+            replaces=[
+                ReplaceConfig(tags=self.random_tags(rng), to=rng.choice(VOCABULARY))
+                for _ in range(rng.randrange(4))
+            ],
+            keeps=[
+                KeepConfig(tags=self.random_tags(rng)) for _ in range(rng.randrange(2))
+            ],
+            deletes=[
+                DeleteConfig(tags=self.random_tags(rng))
+                for _ in range(rng.randrange(3))
+            ],
+            inserts=[
+                InsertConfig(
+                    tags=self.random_tags(rng), position=rng.choice(["start", "end"])
+                )
+                for _ in range(rng.randrange(3))
+            ],
+        )
+
+    def test_chained_replace(self):
+        config = CaptionPostProcessConfig(
+            replaces=[
+                ReplaceConfig(tags=["a"], to="b"),
+                ReplaceConfig(tags=["b"], to="c"),
+                ReplaceConfig(tags=["a"], to="d"),
+            ]
+        )
+
+        self.assertEqual(CompiledPostProcess(config)(["a", "b", "x"]), ["c", "c", "x"])
+
+    def test_same_as_legacy(self):
+        rng = random.Random(0)
+
+        for _ in range(500):
+            config = self.random_config(rng)
+            tags = rng.sample(VOCABULARY, 15)
+
+            self.assertEqual(
+                CompiledPostProcess(config)(list(tags)),
+                do_caption_post_process(list(tags), config),
+            )
+
+    def test_all_same_as_legacy(self):
+        rng = random.Random(1)
+
+        for _ in range(100):
+            config = CaptionConfig(
+                artist=self.random_config(rng),
+                character=self.random_config(rng),
+                copyright=self.random_config(rng),
+                general=self.random_config(rng),
+                meta=self.random_config(rng),
+                common=rng.choice([None, self.random_config(rng)]),
+                rating=rng.choice(
+                    [
+                        False,
+                        RatingTagConfig(
+                            type="by_tag",
+                            nsfw_tags=self.random_tags(rng),
+                            insert_tags=["nsfw"],
+                        ),
+                        RatingTagConfig(type="by_rating"),
+                    ]
+                ),
+                quality={"masterpiece": 80, "best quality": 50},
+            )
+            seed = rng.random()
+
+            compiled = do_all_caption_post_process(
+                make_item(random.Random(seed)), config
+            )
+            legacy = legacy_all_caption_post_process(
+                make_item(random.Random(seed)), config
+            )
+
+            self.assertEqual(compiled.dict(), legacy.dict())
+
+    def test_compile_once(self):
+        config = CaptionConfig()
+
+        self.assertIs(compile_caption_config(config), compile_caption_config(config))
+        self.assertIs(compile_caption_config(True), compile_caption_config(True))
+
+    def test_compile_reloads_tag_file(self):
+        config = CaptionConfig(
+            general=CaptionPostProcessConfig(
+                deletes=[DeleteConfig(tags=str(self.tag_file))]
+            )
+        )
+        item = make_item(random.Random(0))
+        item.general_tags = ["tag_0", "tag_20"]
+
+        self.assertEqual(
+            compile_caption_config(config).general(item.general_tags), ["tag_20"]
+        )
+
+        self.tag_file.write_text("tag_20\n")
+        os.utime(self.tag_file, (0, self.tag_file.stat().st_mtime + 10))
+
+        with mock.patch.object(REGISTRY, "check_interval", 0):
+            self.assertEqual(
+                compile_caption_config(config).general(item.general_tags), ["tag_0"]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()